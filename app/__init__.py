@@ -87,4 +87,4 @@ def create_app(config_class=Config):
     return app
 
 # Import models to ensure they are registered with SQLAlchemy
-from app.models import user, job, credential, log
+from app.models import user, job, credential, log, manifest
@@ -23,6 +23,7 @@ class SftpCredentialForm(FlaskForm):
     private_key_passphrase = PasswordField('Private Key Passphrase (leave blank to keep unchanged)', validators=[Optional()])
     base_dir = StringField('Base Directory', validators=[Optional()], default='/')
     disable_host_key_checking = BooleanField('Disable Host Key Checking', default=False)
+    bandwidth_limit_kbps = IntegerField('Bandwidth Limit (KB/s)', validators=[Optional(), NumberRange(min=0)], default=0)
     submit = SubmitField('Save')
 
 class MssqlCredentialForm(FlaskForm):
@@ -1,6 +1,7 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, SelectField, BooleanField, SubmitField, IntegerField
-from wtforms.validators import DataRequired, Length, Optional, NumberRange
+from wtforms import Form, StringField, TextAreaField, SelectField, BooleanField, SubmitField, IntegerField, FieldList, FormField
+from wtforms.validators import DataRequired, Length, Optional, NumberRange, ValidationError
+from app.utils.rule_utils import FileFilter, RenamePlan, parse_rules
 
 class JobForm(FlaskForm):
     name = StringField('Job Name', validators=[DataRequired(), Length(min=1, max=100)])
@@ -31,6 +32,10 @@ class JobForm(FlaskForm):
                                description="Glob pattern to match files (e.g. *.txt)")
     submit = SubmitField('Save')
 
+class ExtraDestinationForm(Form):
+    credential_id = SelectField('Credentials', validators=[Optional()], coerce=int, default=0)
+    path = StringField('Directory', validators=[Optional()])
+
 class SftpTransferConfigForm(FlaskForm):
     source_credential_id = SelectField('Source Credentials', 
                                      validators=[DataRequired()], 
@@ -48,12 +53,25 @@ class SftpTransferConfigForm(FlaskForm):
                                validators=[Optional()],
                                default='*',
                                description="Glob pattern to match files (e.g. *.txt)")
+    include_patterns = TextAreaField('Include Rules',
+                                     validators=[Optional()],
+                                     description="One rule per line; files must match at least one. Globs, or regular expressions prefixed with re:")
+    exclude_patterns = TextAreaField('Exclude Rules',
+                                     validators=[Optional()],
+                                     description="One rule per line; files matching any of them are skipped")
     file_rename_pattern = StringField('File Rename Pattern', 
                                      validators=[Optional()],
                                      description="Pattern to rename files during transfer")
+    file_rename_match = StringField('Rename Match (Regex)',
+                                    validators=[Optional()],
+                                    description="Regular expression whose capture groups the rename pattern can use as {1}, {2} or {name}")
     recursive = BooleanField('Search Recursively', default=False)
     create_directories = BooleanField('Create Destination Directories', default=True)
     overwrite_existing = BooleanField('Overwrite Existing Files', default=False)
+    atomic_uploads = BooleanField('Upload Under Temporary Name', default=True)
+    sync_mode = BooleanField('Sync Mode (Only New or Changed Files)', default=False)
+    sync_delete_orphans = BooleanField('Delete Destination Files Missing From Source', default=False)
+    extra_destinations = FieldList(FormField(ExtraDestinationForm), min_entries=3, max_entries=10)
     delete_after_download = BooleanField('Delete Files After Transfer', default=False)
     max_file_age_days = IntegerField('Maximum File Age (Days)', 
                                     validators=[Optional()], 
@@ -63,9 +81,125 @@ class SftpTransferConfigForm(FlaskForm):
                                     validators=[Optional(), NumberRange(min=0)],
                                     default=0,
                                     description="Maximum number of files to transfer per run (0 = no limit)")
+    file_selection_order = SelectField('Files Picked First', choices=[
+        ('oldest', 'Oldest first'),
+        ('newest', 'Newest first')
+    ], default='oldest')
     fail_on_empty = BooleanField('Fail if No Files Found', default=False)
     preserve_timestamps = BooleanField('Preserve File Timestamps', default=True)
+    skip_unchanged = BooleanField('Skip Previously Delivered Files', default=True)
+    watch_mode = BooleanField('Run When New Files Arrive', default=False)
+    watch_interval_seconds = IntegerField('Watch Poll Interval (Seconds)',
+                                          validators=[Optional(), NumberRange(min=1, max=3600)],
+                                          default=15,
+                                          description="How often the source directory listing is checked for new or changed files")
+    watch_settle_seconds = IntegerField('Settle Time (Seconds)',
+                                        validators=[Optional(), NumberRange(min=0, max=86400)],
+                                        default=30,
+                                        description="A file is picked up once its size and timestamp stop changing for this long")
+    transfer_mode = SelectField('Transfer Mode', choices=[
+        ('relay', 'Relay (stream directly, no local disk)'),
+        ('staged', 'Staged (download to memory or local disk, then upload)')
+    ], default='relay')
+    server_side_copy = BooleanField('Copy On The Server When Possible', default=True)
+    tail_mode = BooleanField('Send Only Appended Data', default=False)
+    tail_delivery = SelectField('Appended Data Delivery', choices=[
+        ('append', 'Append to the destination file'),
+        ('delta', 'Separate file per run (name.start-end)')
+    ], default='append')
+    bundle_format = SelectField('Bundle Files Into', choices=[
+        ('none', 'Separate files'),
+        ('tar.gz', 'tar.gz archive'),
+        ('zip', 'zip archive')
+    ], default='none')
+    bundle_name = StringField('Bundle Name',
+                              validators=[Optional()],
+                              description="Archive name without extension; {timestamp}, {date}, {time} and {uuid} are filled in (default bundle_{timestamp})")
+    bundle_volume_mb = IntegerField('Bundle Volume Size (MB)',
+                                    validators=[Optional(), NumberRange(min=0)],
+                                    default=0,
+                                    description="Start a new numbered archive once one reaches this size (0 = a single archive)")
+    parallel_files = IntegerField('Parallel Files',
+                                  validators=[Optional(), NumberRange(min=1, max=64)],
+                                  default=4,
+                                  description="Number of files to transfer at the same time")
+    max_source_connections = IntegerField('Max Source Connections',
+                                          validators=[Optional(), NumberRange(min=1, max=64)],
+                                          default=4,
+                                          description="Maximum concurrent sessions to the source host")
+    max_destination_connections = IntegerField('Max Destination Connections',
+                                               validators=[Optional(), NumberRange(min=1, max=64)],
+                                               default=4,
+                                               description="Maximum concurrent sessions to the destination host")
+    adaptive_concurrency = BooleanField('Adapt Parallel Files Per Host', default=False)
+    adaptive_max_parallel = IntegerField('Adaptive Ceiling',
+                                         validators=[Optional(), NumberRange(min=1, max=64)],
+                                         default=8,
+                                         description="Most files adaptive concurrency may move at once per host, within the worker's connection pool")
+    multistream_threshold_mb = IntegerField('Multi-Stream Threshold (MB)',
+                                            validators=[Optional(), NumberRange(min=0)],
+                                            default=0,
+                                            description="Split files at least this large into parallel byte-range streams (0 = off)")
+    multistream_streams = IntegerField('Streams Per Large File',
+                                       validators=[Optional(), NumberRange(min=1, max=32)],
+                                       default=4,
+                                       description="Number of parallel streams used for each large file")
+    bandwidth_limit_kbps = IntegerField('Bandwidth Limit (KB/s)',
+                                        validators=[Optional(), NumberRange(min=0)],
+                                        default=0,
+                                        description="Maximum transfer rate for this job across all workers (0 = no limit)")
+    staging_memory_threshold_mb = IntegerField('Stage In Memory Below (MB)',
+                                               validators=[Optional(), NumberRange(min=0)],
+                                               description="Staged mode keeps smaller files in memory; blank uses the worker default")
+    staging_dir = StringField('Staging Directory',
+                              validators=[Optional()],
+                              description="Where staged mode spools larger files, e.g. a tmpfs mount; blank uses the worker's temp folder")
+    compression = SelectField('Compression', choices=[
+        ('none', 'None'),
+        ('gzip', 'gzip (.gz)'),
+        ('zstd', 'Zstandard (.zst)')
+    ], default='none')
+    compression_level = IntegerField('Compression Level',
+                                     validators=[Optional(), NumberRange(min=1, max=22)],
+                                     description="gzip 1-9 (default 6), zstd 1-22 (default 3); leave blank for the default")
+    checksum_algorithm = SelectField('Checksum Algorithm', choices=[
+        ('sha256', 'SHA-256'),
+        ('xxh64', 'xxHash64 (faster)'),
+        ('xxh3_128', 'XXH3-128 (faster)'),
+        ('none', 'None')
+    ], default='sha256')
+    verify_remote_checksum = BooleanField('Verify Checksum On Server', default=False)
+    max_retries = IntegerField('Retries On Failure',
+                               validators=[Optional(), NumberRange(min=0, max=10)],
+                               default=0,
+                               description="Retry a failed run this many times; retries resume partially transferred files")
+    retry_delay_seconds = IntegerField('Retry Delay (Seconds)',
+                                       validators=[Optional(), NumberRange(min=1, max=86400)],
+                                       default=60,
+                                       description="How long to wait before retrying a failed run")
+    checkpoint_interval_mb = IntegerField('Checkpoint Every (MB)',
+                                          validators=[Optional(), NumberRange(min=1)],
+                                          default=8,
+                                          description="How often progress on a file is saved so a retry can resume it")
     submit = SubmitField('Save Configuration')
+    
+    def validate_include_patterns(self, field):
+        try:
+            FileFilter(include=parse_rules(field.data))
+        except ValueError as e:
+            raise ValidationError(str(e))
+    
+    def validate_exclude_patterns(self, field):
+        try:
+            FileFilter(exclude=parse_rules(field.data))
+        except ValueError as e:
+            raise ValidationError(str(e))
+    
+    def validate_file_rename_match(self, field):
+        try:
+            RenamePlan('', field.data)
+        except ValueError as e:
+            raise ValidationError(str(e))
 
 class SqlToCsvConfigForm(FlaskForm):
     source_credential_id = SelectField('Source MSSQL Server', 
@@ -87,4 +221,24 @@ class SqlToCsvConfigForm(FlaskForm):
                                 validators=[Optional()],
                                 default=',')
     include_headers = BooleanField('Include Column Headers', default=True)
+    atomic_uploads = BooleanField('Upload Under Temporary Name', default=True)
+    compression = SelectField('Compression', choices=[
+        ('none', 'None'),
+        ('gzip', 'gzip (.gz)'),
+        ('zstd', 'Zstandard (.zst)')
+    ], default='none')
+    compression_level = IntegerField('Compression Level',
+                                     validators=[Optional(), NumberRange(min=1, max=22)],
+                                     description="gzip 1-9 (default 6), zstd 1-22 (default 3); leave blank for the default")
+    checksum_algorithm = SelectField('Checksum Algorithm', choices=[
+        ('sha256', 'SHA-256'),
+        ('xxh64', 'xxHash64 (faster)'),
+        ('xxh3_128', 'XXH3-128 (faster)'),
+        ('none', 'None')
+    ], default='sha256')
+    verify_remote_checksum = BooleanField('Verify Checksum On Server', default=False)
+    bandwidth_limit_kbps = IntegerField('Bandwidth Limit (KB/s)',
+                                        validators=[Optional(), NumberRange(min=0)],
+                                        default=0,
+                                        description="Maximum transfer rate for this job across all workers (0 = no limit)")
     submit = SubmitField('Save Configuration')
@@ -1,6 +1,7 @@
 from app import scheduler, db, celery
 from app.models.job import Job
 from app.jobs.executor import execute_job
+from app.jobs.watcher import poll_watched_job, reset_watch_state, DEFAULT_WATCH_INTERVAL_SECONDS
 from datetime import datetime, timedelta
 import traceback
 import logging
@@ -18,20 +19,10 @@ def initialize_jobs():
         
         # Add each job to scheduler
         for job in active_jobs:
-            if job.schedule:
-                try:
-                    # Create a scheduler job that will dispatch a Celery task
-                    scheduler.add_job(
-                        func=dispatch_celery_job,
-                        trigger='cron',
-                        id=f'job_{job.id}_{job.name}',
-                        args=[job.id],
-                        replace_existing=True,
-                        **parse_cron_expression(job.schedule)
-                    )
-                    logger.info(f"Scheduled job {job.name} (ID: {job.id}) with schedule: {job.schedule}")
-                except Exception as e:
-                    logger.error(f"Error scheduling job {job.name} (ID: {job.id}): {str(e)}")
+            try:
+                schedule_job(job)
+            except Exception as e:
+                logger.error(f"Error scheduling job {job.name} (ID: {job.id}): {str(e)}")
         
         # Add daily report job
         scheduler.add_job(
@@ -49,6 +40,43 @@ def initialize_jobs():
         logger.error(traceback.format_exc())
         return False
 
+def is_watched(job):
+    """Return True if the job runs when files arrive rather than on its cron schedule."""
+    return job.job_type == 'sftp_transfer' and bool(job.get_config().get('watch_mode'))
+
+def schedule_job(job):
+    """Add a job to the scheduler; returns False if it has neither a schedule nor watch mode."""
+    if is_watched(job):
+        # Poll the source directory; a Celery task is only dispatched when files arrive
+        interval = int(job.get_config().get('watch_interval_seconds') or DEFAULT_WATCH_INTERVAL_SECONDS)
+        scheduler.add_job(
+            func=poll_watched_job,
+            trigger='interval',
+            id=f'job_{job.id}_{job.name}',
+            args=[job.id],
+            replace_existing=True,
+            seconds=max(1, interval),
+            max_instances=1,
+            coalesce=True
+        )
+        logger.info(f"Watching source of job {job.name} (ID: {job.id}) every {interval}s")
+        return True
+    
+    if not job.schedule:
+        return False
+    
+    # Create a scheduler job that will dispatch a Celery task
+    scheduler.add_job(
+        func=dispatch_celery_job,
+        trigger='cron',
+        id=f'job_{job.id}_{job.name}',
+        args=[job.id],
+        replace_existing=True,
+        **parse_cron_expression(job.schedule)
+    )
+    logger.info(f"Scheduled job {job.name} (ID: {job.id}) with schedule: {job.schedule}")
+    return True
+
 def parse_cron_expression(cron_expr):
     """Parse a cron expression into kwargs for APScheduler."""
     # Basic parsing for common cron expressions
@@ -76,18 +104,12 @@ def update_job_schedule(job_id):
         scheduler.remove_job(f'job_{job.id}_{job.name}')
     except:
         pass  # Job may not exist in scheduler
+    reset_watch_state(job.id)
     
-    # If job is active and has a schedule, add it to scheduler
-    if job.is_active and job.schedule:
+    # If job is active and has a schedule or watch mode, add it to scheduler
+    if job.is_active:
         try:
-            scheduler.add_job(
-                func=dispatch_celery_job,
-                trigger='cron',
-                id=f'job_{job.id}_{job.name}',
-                args=[job.id],
-                replace_existing=True,
-                **parse_cron_expression(job.schedule)
-            )
+            schedule_job(job)
             return True
         except Exception as e:
             logger.error(f"Error scheduling job {job.name} (ID: {job.id}): {str(e)}")
@@ -1,245 +1,1557 @@
+import hashlib
+import io
 import os
-import pysftp
-import fnmatch
-import tempfile
+import stat
+import threading
+import time
+import heapq
+from collections import namedtuple
+from contextlib import ExitStack
+from operator import attrgetter
 from paramiko.ssh_exception import SSHException
-import datetime
-import uuid
-import random
+from sqlalchemy.exc import SQLAlchemyError
+from config import Config
+from app.models.credential import Credential
+from app.models.manifest import TransferManifest
+from app.utils.checkpoint_utils import TransferCheckpoints
+from app.utils.archive_utils import ArchiveStream, normalize_archive_format, ARCHIVE_EXTENSIONS
+from app.utils.compression_utils import normalize_compression, compressed_name, new_compressor
+from app.utils.checksum_utils import new_hasher, format_digest, HashingWriter, RemoteHasher, verify_digest
+from app.utils.rule_utils import FileFilter, RenamePlan
+from app.utils.progress_utils import TransferProgress, DEFAULT_PROGRESS_INTERVAL_MS
+from app.utils.bandwidth_utils import limiter_for, throttled_reader, throttled_writer
+from app.utils.stream_utils import relay_stream, fan_out_stream, split_ranges, LimitedReader, DEFAULT_CHUNK_SIZE, DEFAULT_BUFFER_CHUNKS
+from app.utils.concurrency_utils import (ThreadSessions, get_host_limiter, get_adaptive_limiter, adaptive_key,
+                                        is_congestion_error, run_parallel, iter_parallel)
+from app.utils.sftp_pool import sftp_pool, credential_pool_key
+from app.utils.sftp_utils import (sftp_exists, sftp_makedirs, sftp_replace, part_path, is_part_file, sftp_cleanup_parts,
+                                  PipelinedRemover, ServerSideCopier, same_server_account)
+from app.utils.sftp_walk import RemoteTreeWalker
+from app.utils.staging_utils import get_staging_area
+
+# Default number of files moved at once
+DEFAULT_PARALLEL_FILES = 4
+
+# Default cap on concurrent sessions to a single source or destination host
+DEFAULT_HOST_CONNECTIONS = 4
+
+# Default number of files adaptive concurrency may move at once per host
+DEFAULT_ADAPTIVE_MAX_PARALLEL = 8
+
+# Default number of byte-range streams used for files above the multi-stream threshold
+DEFAULT_MULTISTREAM_STREAMS = 4
+
+# Part files older than this are treated as abandoned and removed
+DEFAULT_STALE_PART_HOURS = 24
+
+# Default number of threads listing source directories during a recursive walk
+DEFAULT_LISTING_WORKERS = 4
+
+# Files up to this size are read ahead in parallel when bundling; larger ones are streamed in when reached
+DEFAULT_BUNDLE_PREFETCH_BYTES = 1024 * 1024
+
+# Name given to bundles when the job does not set one; rename pattern tokens are filled in
+DEFAULT_BUNDLE_NAME = 'bundle_{timestamp}'
+
+# Default seconds a watched job's files must go unmodified before a run picks them up
+DEFAULT_WATCH_SETTLE_SECONDS = 30
+
+# Bytes just before the delivered size that are compared to tell an appended-to file from a replaced one
+TAIL_PROBE_BYTES = 4096
+
+# A file on the source server, as returned by the listing stage; rel_path is relative to the source directory
+RemoteFile = namedtuple('RemoteFile', ['name', 'rel_path', 'path', 'size', 'mtime'])
+
+# A server and directory files are delivered to; dirs holds the directories already created there this run
+Destination = namedtuple('Destination', ['name', 'session', 'path', 'limiter', 'dirs'])
+
+# An archive volume being written to the destination; files holds the RemoteFiles added to it so far
+BundleVolume = namedtuple('BundleVolume', ['name', 'path', 'upload_path', 'handle', 'archive', 'hasher', 'files'])
+
+def watch_settle_seconds(config):
+    """Settle time configured for a watched job; zero is a valid setting."""
+    settle_seconds = config.get('watch_settle_seconds')
+    return DEFAULT_WATCH_SETTLE_SECONDS if settle_seconds in (None, '') else int(settle_seconds)
 
 class SftpTransfer:
     """Handler for SFTP to SFTP file transfers."""
     
-    def __init__(self, job, source_credential, destination_credential):
+    def __init__(self, job, source_credential, destination_credential, settled_files=None):
         self.job = job
         self.source_credential = source_credential
         self.destination_credential = destination_credential
         self.config = job.get_config()
         self.transferred_files = []
+        self.delivered_files = []
+        self.delete_errors = {}
+        self.moved_files = []
+        self.checksums = {}
+        self.checksum_algorithm = self.config.get('checksum_algorithm', 'sha256')
+        self.compression = None
+        self.bundle_format = None
+        self.bundles = []
+        self.tail_mode = False
+        self.tail_digests = {}
+        self.appended_files = []
+        self.atomic_uploads = self.config.get('atomic_uploads', True)
+        self.remote_hasher = RemoteHasher(self.checksum_algorithm) if self.config.get('verify_remote_checksum', False) else None
+        self.source_limiter = None
+        self.dest_limiter = None
+        self.destinations = []
+        self.adaptive_limiters = []
+        # Transfer sessions per adaptive limiter key, so a congestion error is charged to the host that failed
+        self._host_sessions = {}
+        # Shared host limiters this run registered with, by (role, host, port)
+        self._host_limiters = {}
+        self.destination_results = {}
+        self.progress = TransferProgress(job.id, self.config.get('progress_interval_ms') or DEFAULT_PROGRESS_INTERVAL_MS)
+        self._dest_targets = {}
+        self._source_remover = None
+        self.skipped_files = []
+        self.matched_count = 0
+        self.deferred_count = 0
+        self.unsettled_count = 0
+        # {rel_path: [size, mtime]} the watcher saw settle, for runs it dispatched
+        self.settled_files = settled_files
+        self.plan = []
+        self.file_filter = None
+        self.rename_plan = None
+        self._dest_names = {}
+        self._dest_orphans = {}
+        self._aged_out = set()
+        self.listing_errors = []
+        self._dest_dirs = set()
+        self._dest_dirs_lock = threading.Lock()
         
     def execute(self):
-        """Execute the SFTP transfer job."""
+        """Execute the SFTP transfer job, publishing its progress while it runs."""
+        self.progress.start()
+        try:
+            result = self._execute()
+        except Exception:
+            self.progress.finish('failed')
+            raise
+        finally:
+            for limiter in self._host_limiters.values():
+                limiter.unregister()
+        self.progress.finish()
+        return result
+    
+    def _execute(self):
+        """Run the transfer and build the job result."""
         # Get configuration
         source_path = self.config.get('source_directory') or self.config.get('source_path')
         dest_path = self.config.get('destination_directory') or self.config.get('destination_path')
         file_pattern = self.config.get('file_pattern', '*')
-        delete_after = self.config.get('delete_after_transfer', False)
+        # The form saves 'delete_after_download'; older configs used 'delete_after_transfer'
+        delete_after = self.config.get('delete_after_download', self.config.get('delete_after_transfer', False))
         file_rename_pattern = self.config.get('file_rename_pattern', '')
+        transfer_mode = self.config.get('transfer_mode', 'relay')
+        skip_unchanged = self.config.get('skip_unchanged', True)
+        fail_on_empty = self.config.get('fail_on_empty', False)
+        sync_mode = self.config.get('sync_mode', False)
+        overwrite_existing = self.config.get('overwrite_existing', False)
+        self.preserve_timestamps = self.config.get('preserve_timestamps', True)
         
         if not source_path or not dest_path:
             raise ValueError("Source or destination path not specified")
         
-        # Create temporary directory for file transfers
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Connect to source SFTP
-            source_files = self._download_from_source(source_path, temp_dir, file_pattern)
-            
-            if not source_files:
-                return {
-                    'message': 'No files found matching the pattern',
-                    'details': f"Path: {source_path}, Pattern: {file_pattern}"
-                }
-            
-            # Upload to destination SFTP
-            self._upload_to_destination(temp_dir, dest_path, source_files, file_rename_pattern)
+        # Filter and rename rules are compiled once; the run's timestamp is frozen so a batch is named consistently
+        self.file_filter = FileFilter.from_config(self.config)
+        self.rename_plan = RenamePlan(file_rename_pattern, self.config.get('file_rename_match'))
+        
+        # Optional compression applied while files stream to the destination
+        self.compression = normalize_compression(self.config.get('compression'))
+        
+        # Optionally pack all files into archives instead of delivering them one by one
+        self.bundle_format = normalize_archive_format(self.config.get('bundle_format'))
+        if self.bundle_format and self.compression:
+            print("Bundling files into archives; per-file compression does not apply")
+            self.compression = None
+        
+        # Resolve pooled connection settings once, in the calling thread
+        self.source_session = (credential_pool_key(self.source_credential), self.source_credential.get_credentials())
+        self.dest_session = (credential_pool_key(self.destination_credential), self.destination_credential.get_credentials())
+        
+        # Shared bandwidth limits; relayed bytes count against the job once, as they are read
+        self.source_limiter = limiter_for([self.source_credential], self.job)
+        self.dest_limiter = limiter_for([self.destination_credential], self.job if transfer_mode == 'staged' else None)
+        
+        # The job's own destination first, then any extra destinations the same files fan out to
+        self.destinations = [Destination(f"{self.destination_credential.name}:{dest_path}", self.dest_session,
+                                         dest_path, self.dest_limiter, self._dest_dirs)]
+        self.destinations.extend(self._load_extra_destinations())
+        fan_out = len(self.destinations) > 1
+        if fan_out and self.bundle_format:
+            raise ValueError("Bundled transfers cannot be sent to extra destinations")
+        
+        # Send only what was appended to each file since it was last delivered
+        self.tail_mode = self.config.get('tail_mode', False)
+        if self.tail_mode:
+            if fan_out or self.bundle_format:
+                raise ValueError("Tail transfers cannot be combined with extra destinations or bundling")
+            if self.compression:
+                print("Sending appended data only; per-file compression does not apply")
+                self.compression = None
+        if fan_out and transfer_mode == 'staged':
+            print("Streaming files to multiple destinations; staged transfer mode does not apply")
+        
+        # With one account on one server the files never need to leave it; compressed output still has to be streamed
+        server_side = (not fan_out and not self.compression and not self.bundle_format and not self.tail_mode and self.config.get('server_side_copy', True)
+                       and self._same_server_account())
+        if server_side:
+            print("Source and destination are the same account on the same server; copying on the server")
+        
+        # Walk the source and drop files that are already on the destination or were
+        # delivered unchanged by an earlier run; files are handed to the transfer stage
+        # while the walk is still running
+        # Tail transfers keep the size each file was delivered at in the manifest
+        track_deliveries = skip_unchanged or self.tail_mode
+        manifest = TransferManifest.load_for_job(self.job.id) if track_deliveries else {}
+        
+        # Progress saved by an earlier, interrupted run of this job
+        self.checkpoints = TransferCheckpoints(self.job.id, int(self.config.get('checkpoint_interval_mb') or 8) * 1024 * 1024)
+        self.checkpoints.load()
+        
+        pending_files = self._iter_source_files(source_path)
+        # Bundled files have no destination file of their own to compare against, and tailed files are
+        # expected to be there already
+        if (sync_mode or not overwrite_existing) and not self.bundle_format and not self.tail_mode:
+            pending_files = self._diff_destination(pending_files, sync_mode)
+        pending_files = self._skip_delivered(pending_files, manifest)
+        pending_files = self.progress.track(self._select_files(pending_files))
+        
+        if delete_after:
+            # Source files are deleted in the background as each one is delivered
+            self._source_remover = PipelinedRemover(lambda: sftp_pool.open_sftp_with(*self.source_session))
+        
+        try:
+            # Files moved at once per host follow what the hosts can take, up to the adaptive ceiling;
+            # registered here so the finally below always unregisters this job
+            if self.config.get('adaptive_concurrency', False):
+                self.adaptive_limiters = self._get_adaptive_limiters()
+                print("Adaptive concurrency: " + ", ".join(f"{limiter.name} at {limiter.limit}" for limiter in self.adaptive_limiters))
             
-            # Delete source files if configured
-            if delete_after and self.transferred_files:
-                self._delete_source_files(source_path)
+            if self.bundle_format:
+                # Pack the files into archives streamed straight to the destination
+                self._bundle_files(pending_files, dest_path)
+            elif self.tail_mode:
+                # Send each file's new tail, copying files that were truncated or replaced in full
+                self._tail_files(pending_files, dest_path, transfer_mode, manifest)
+            elif fan_out:
+                # Read each source file once and write it to every destination at the same time
+                self._fan_out_files(pending_files)
+            elif server_side:
+                # Copy or move each file on the server, streaming only those it cannot handle
+                self._copy_on_server(pending_files, dest_path, transfer_mode)
+            elif transfer_mode == 'staged':
+                # Download each file to local staging, then upload it from there
+                self._stage_files(pending_files, dest_path)
+            else:
+                # Stream each file from the source handle to the destination handle
+                self._relay_files(pending_files, dest_path)
+        finally:
+            for limiter in self.adaptive_limiters:
+                limiter.remove_user(self._adaptive_max_parallel())
+            if self._source_remover is not None:
+                self.delete_errors = self._source_remover.close()
+            if self.atomic_uploads:
+                self._cleanup_stale_parts()
+            # Remember what made it across, even if some files failed
+            if track_deliveries:
+                self._record_manifest(self.delivered_files, manifest)
+        
+        if self.listing_errors:
+            lines = [f"{path}: {str(error)}" for path, error in self.listing_errors]
+            raise RuntimeError(f"Failed to list {len(lines)} source directories:\n" + '\n'.join(lines))
+        
+        if not self.matched_count:
+            if fail_on_empty:
+                raise RuntimeError(f"No files found matching the pattern (Path: {source_path}, Pattern: {file_pattern})")
+            return {
+                'message': 'No files found matching the pattern',
+                'details': f"Path: {source_path}, Pattern: {file_pattern}"
+            }
+        
+        # Remove destination files whose source is gone, now that every transfer succeeded
+        if sync_mode and self.config.get('sync_delete_orphans', False) and not self.bundle_format and not self.tail_mode:
+            self._delete_dest_orphans()
+        
+        if not self.transferred_files:
+            return {
+                'message': 'No new or changed files to transfer',
+                'details': self._summarize_skips() + self._format_plan(),
+                'plan': self.plan
+            }
+        
+        details = '\n'.join(self.transferred_files)
+        skips = self._summarize_skips()
+        if skips:
+            details += '\n' + skips
+        if self.deferred_count:
+            details += f"\nLeft {self.deferred_count} files for the next run (max files per run reached)"
+        if self.moved_files:
+            details += f"\nMoved {len(self.moved_files)} files on the server"
+        if self.appended_files:
+            details += f"\nSent only the new tail of {len(self.appended_files)} files"
+        if self._source_remover is not None and self._source_remover.removed:
+            details += f"\nDeleted {len(self._source_remover.removed)} source files"
+        if self.delete_errors:
+            lines = [f"{path}: {str(error)}" for path, error in self.delete_errors.items()]
+            details += f"\nFailed to delete {len(lines)} source files:\n" + '\n'.join(lines)
+        
+        if fan_out:
+            details += '\n\nDestinations:\n' + '\n'.join(
+                f"{name}: {len(outcome['delivered'])} delivered, {len(outcome['failed'])} failed"
+                for name, outcome in self.destination_results.items()
+            )
+        
+        if self.bundles:
+            details += '\n\nBundles:\n' + '\n'.join(
+                f"{bundle['name']} ({self._format_size(bundle['size'])}): {len(bundle['files'])} files"
+                for bundle in self.bundles
+            )
+        
+        if self.checksums:
+            details += '\n\nChecksums:\n' + '\n'.join(f"{name}: {digest}" for name, digest in sorted(self.checksums.items()))
         
         return {
             'message': f'Successfully transferred {len(self.transferred_files)} files',
-            'details': '\n'.join(self.transferred_files),
-            'files': self.transferred_files
+            'details': details + self._format_plan(),
+            'files': self.transferred_files,
+            'checksums': self.checksums,
+            'destinations': {
+                name: {'delivered': outcome['delivered'], 'failed': {f: str(e) for f, e in outcome['failed'].items()}}
+                for name, outcome in self.destination_results.items()
+            },
+            'bundles': self.bundles,
+            'plan': self.plan
         }
     
-    def _download_from_source(self, source_path, temp_dir, file_pattern):
-        """Download files from source SFTP to local temp directory."""
-        source_creds = self.source_credential.get_credentials()
-        source_files = []
+    def _iter_source_files(self, source_path):
+        """Return an iterator over the source files that pass the filter and age limit."""
+        return self._filter_by_age(self._list_source_files(source_path))
+    
+    def _list_source_files(self, source_path):
+        """Return an iterator over the source files that pass the filter."""
+        try:
+            with sftp_pool.sftp_session(*self.source_session) as sftp:
+                attr = sftp.stat(source_path)
+        except SSHException as e:
+            raise RuntimeError(f"SFTP connection error: {str(e)}")
+        
+        if stat.S_ISDIR(attr.st_mode or 0):
+            return self._walk_source_files(source_path)
+        
+        # Single file - check if it passes the filter
+        filename = os.path.basename(source_path)
+        if self.file_filter.matches(filename):
+            return iter([RemoteFile(filename, filename, source_path, attr.st_size, attr.st_mtime)])
+        return iter([])
+    
+    def _walk_source_files(self, source_path):
+        """Yield matching files as their directories are listed, descending into subdirectories if recursive."""
+        recursive = bool(self.config.get('recursive', False))
+        listing_workers = int(self.config.get('listing_workers') or DEFAULT_LISTING_WORKERS)
         
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None  # Disable host key checking - not recommended for production
+        # Listing channels get their own per-host cap so they never wait on busy transfer workers
+        with self._open_sessions(self.source_session, 'max_source_connections', role='listing') as sessions:
+            listing_workers = min(listing_workers, self._session_limiter(self.source_session, 'max_source_connections', 'listing').limit)
+            # Filtered-out names are dropped by the listing threads as each batch arrives
+            walker = RemoteTreeWalker(sessions, source_path, recursive, listing_workers,
+                                      match=lambda rel_dir, attr: self.file_filter.matches(attr.filename, rel_dir))
+            for rel_dir, attr in walker:
+                rel_path = os.path.join(rel_dir, attr.filename).replace('\\', '/')
+                yield RemoteFile(attr.filename, rel_path, os.path.join(source_path, rel_path).replace('\\', '/'),
+                                 attr.st_size, attr.st_mtime)
         
-        # Setup connection parameters
-        conn_params = {
-            'host': source_creds.get('host'),
-            'port': source_creds.get('port', 22),
-            'username': source_creds.get('username'),
-            'cnopts': cnopts
-        }
+        self.listing_errors.extend(walker.errors)
+    
+    def _filter_by_age(self, files):
+        """Count the listed files, dropping those older than max_file_age_days using the mtime from the listing.
         
-        # Add either password or private key
-        if source_creds.get('password'):
-            conn_params['password'] = source_creds.get('password')
-        elif source_creds.get('private_key'):
-            private_key_file = os.path.join(temp_dir, 'source_key')
-            with open(private_key_file, 'w') as f:
-                f.write(source_creds.get('private_key'))
-            os.chmod(private_key_file, 0o600)
-            conn_params['private_key'] = private_key_file
-            if source_creds.get('private_key_pass'):
-                conn_params['private_key_pass'] = source_creds.get('private_key_pass')
-        
-        try:
-            with pysftp.Connection(**conn_params) as sftp:
-                # Check if source is a directory or file
-                if sftp.isdir(source_path):
-                    # List directory and filter by pattern
-                    all_files = sftp.listdir(source_path)
-                    matching_files = [f for f in all_files if fnmatch.fnmatch(f, file_pattern)]
-                    
-                    # Download each matching file
-                    for filename in matching_files:
-                        remote_path = os.path.join(source_path, filename).replace('\\', '/')
-                        local_path = os.path.join(temp_dir, filename)
-                        sftp.get(remote_path, local_path)
-                        source_files.append(filename)
+        Watched jobs also leave files that may still be being written. Runs the
+        watcher dispatched take only the files it saw settle, as listed then; other
+        runs leave files modified within the settle time. The watcher dispatches
+        another run once the rest settle.
+        """
+        max_age_days = int(self.config.get('max_file_age_days') or 0)
+        cutoff = time.time() - max_age_days * 86400 if max_age_days > 0 else None
+        settle_cutoff = None
+        if self.settled_files is None and self.config.get('watch_mode'):
+            settle_cutoff = time.time() - watch_settle_seconds(self.config)
+        for remote_file in files:
+            if cutoff is not None and remote_file.mtime < cutoff:
+                # Still on the source, so its destination copy is not an orphan
+                self._aged_out.add(remote_file.rel_path)
+                continue
+            self.matched_count += 1
+            if self.settled_files is not None:
+                settled = self.settled_files.get(remote_file.rel_path)
+                unsettled = settled is None or tuple(settled) != (remote_file.size, remote_file.mtime)
+            else:
+                unsettled = settle_cutoff is not None and remote_file.mtime > settle_cutoff
+            if unsettled:
+                self._aged_out.add(remote_file.rel_path)
+                self.unsettled_count += 1
+                continue
+            yield remote_file
+    
+    def _diff_destination(self, files, sync_mode):
+        """Compare files against one attribute listing per destination directory and pass on those to transfer.
+        
+        Without sync mode any file already on the destination is skipped; in sync
+        mode it is transferred again only if its size differs or the source is newer.
+        With several destinations a file is passed on if any of them needs it, and
+        only those destinations are written to. Destination entries left unmatched
+        are kept as candidate orphans.
+        """
+        listings = {destination.name: {} for destination in self.destinations}
+        with ExitStack() as stack:
+            sessions = [stack.enter_context(sftp_pool.sftp_session(*destination.session)) for destination in self.destinations]
+            for remote_file in files:
+                dest_name = self._dest_name(remote_file)
+                rel_dir, name = os.path.split(dest_name)
+                
+                reasons = {}
+                for destination, sftp in zip(self.destinations, sessions):
+                    dir_listings = listings[destination.name]
+                    if rel_dir not in dir_listings:
+                        dir_listings[rel_dir] = self._list_dest_dir(sftp, os.path.join(destination.path, rel_dir).replace('\\', '/'))
+                    existing = dir_listings[rel_dir].pop(name, None)
+                    checkpoint = self.checkpoints.get(remote_file, os.path.join(destination.path, dest_name).replace('\\', '/'))
+                    reasons[destination.name] = self._diff_reason(remote_file, existing, checkpoint, sync_mode)
+                
+                needed = [name for name, reason in reasons.items() if reason in ('new', 'resume', 'changed')]
+                if needed:
+                    entry = {'file': remote_file.rel_path, 'action': 'transfer', 'reason': reasons[needed[0]]}
+                    if len(self.destinations) > 1:
+                        entry['destinations'] = needed
+                        self._dest_targets[remote_file.path] = needed
+                    self.plan.append(entry)
+                    yield remote_file
                 else:
-                    # Single file - check if it matches pattern
-                    filename = os.path.basename(source_path)
-                    if fnmatch.fnmatch(filename, file_pattern):
-                        local_path = os.path.join(temp_dir, filename)
-                        sftp.get(source_path, local_path)
-                        source_files.append(filename)
+                    self.plan.append({'file': remote_file.rel_path, 'action': 'skip', 'reason': reasons[self.destinations[0].name]})
+        
+        self._dest_orphans = listings
+    
+    def _diff_reason(self, remote_file, existing, checkpoint, sync_mode):
+        """Why a file is or is not transferred to one destination, given its entry there (or None)."""
+        if existing is None:
+            return 'new'
+        if checkpoint and not checkpoint.get('done'):
+            # Left partially written by an interrupted run
+            return 'resume'
+        if not self.atomic_uploads and not self.compression and existing.st_size != remote_file.size:
+            # Uploads land under the final name, so a short file may be one an interrupted run left behind
+            # without a checkpoint (Redis down, or too little written to save one)
+            return 'resume' if existing.st_size < remote_file.size else 'changed'
+        if not sync_mode:
+            return 'exists'
+        if (self.compression or existing.st_size == remote_file.size) and (existing.st_mtime or 0) >= remote_file.mtime:
+            # Compressed copies never match the source size, so only their age is compared
+            return 'unchanged'
+        return 'changed'
+    
+    def _list_dest_dir(self, sftp, remote_dir):
+        """Return {name: attributes} for the files in a destination directory; empty if it does not exist."""
+        try:
+            return {
+                attr.filename: attr
+                for attr in sftp.listdir_attr(remote_dir)
+                if not stat.S_ISDIR(attr.st_mode or 0) and not is_part_file(attr.filename)
+            }
+        except IOError:
+            return {}
+    
+    def _delete_dest_orphans(self):
+        """Delete destination files in the compared directories that no longer exist on the source."""
+        if self.rename_plan.pattern:
+            # Renamed files cannot be matched back to source names reliably
+            print("Skipping orphan deletion because a rename pattern is set")
+            return
+        
+        for destination in self.destinations:
+            orphans = [
+                os.path.join(rel_dir, name).replace('\\', '/')
+                for rel_dir, entries in self._dest_orphans.get(destination.name, {}).items()
+                for name in entries
+                if self.file_filter.matches(name, rel_dir)
+            ]
+            orphans = [rel_path for rel_path in orphans if rel_path not in self._aged_out]
+            if not orphans:
+                continue
+            
+            with sftp_pool.sftp_session(*destination.session) as sftp:
+                for rel_path in orphans:
+                    sftp.remove(os.path.join(destination.path, rel_path).replace('\\', '/'))
+                    entry = {'file': rel_path, 'action': 'delete', 'reason': 'orphan'}
+                    if len(self.destinations) > 1:
+                        entry['destinations'] = [destination.name]
+                    self.plan.append(entry)
+                    print(f"Deleted orphan: {rel_path} ({destination.name})")
+    
+    def _select_files(self, files):
+        """Keep at most max_files_per_run files, oldest or newest first."""
+        max_files = int(self.config.get('max_files_per_run') or 0)
+        if max_files <= 0:
+            return files
+        
+        # Only the selected files are held in memory, however many the source has
+        pick = heapq.nlargest if self.config.get('file_selection_order') == 'newest' else heapq.nsmallest
+        total = 0
+        
+        def counted():
+            nonlocal total
+            for remote_file in files:
+                total += 1
+                yield remote_file
+        
+        selected = pick(max_files, counted(), key=attrgetter('mtime'))
+        self.deferred_count = total - len(selected)
+        return selected
+    
+    def _skip_delivered(self, files, manifest):
+        """Drop files whose size and mtime match what the manifest says was delivered."""
+        for remote_file in files:
+            delivered = manifest.get(remote_file.path)
+            if delivered and delivered[1] == remote_file.size and delivered[2] == remote_file.mtime:
+                self.skipped_files.append(remote_file.rel_path)
+                if self.plan and self.plan[-1]['file'] == remote_file.rel_path:
+                    # The destination comparison planned this file; record why it was not moved after all
+                    self.plan[-1] = {'file': remote_file.rel_path, 'action': 'skip', 'reason': 'previously delivered'}
+            else:
+                yield remote_file
+    
+    def _record_manifest(self, delivered_files, manifest):
+        """Store the delivered files in the manifest in one bulk write."""
+        entries = [
+            {
+                'remote_path': remote_file.path,
+                'size': remote_file.size,
+                'mtime': remote_file.mtime,
+                'checksum': self.checksums.get(remote_file.rel_path),
+                'tail_digest': self.tail_digests.get(remote_file.path)
+            }
+            for remote_file in delivered_files
+        ]
+        try:
+            TransferManifest.record_deliveries(self.job.id, entries, manifest)
+        except SQLAlchemyError as e:
+            # Called on the way out of a run; a failed write must not hide how the transfer went
+            print(f"Could not record {len(entries)} delivered files in the manifest: {str(e)}")
+    
+    def _copy_on_server(self, files, dest_path, transfer_mode):
+        """Copy each file within the server shared by source and destination, or move it if sources are deleted.
+        
+        No data passes through the worker. Files the server cannot copy itself
+        are streamed afterwards in the job's transfer mode.
+        """
+        copier = ServerSideCopier()
+        move = self._source_remover is not None
+        fallback = []
+        
+        def copy(remote_file):
+            sftp = sessions.get()
+            dest_filename, dest_remote_path = self._dest_path_for(sftp, remote_file, dest_path)
+            
+            # A move is a single rename, which also takes care of deleting the source
+            method = copier.move(sftp, remote_file.path, dest_remote_path) if move else None
+            if method:
+                self.moved_files.append(remote_file.rel_path)
+                digest = self.remote_hasher.digest(sftp, dest_remote_path) if self.remote_hasher else None
+            else:
+                upload_path = self._upload_path(dest_remote_path)
+                method = copier.copy(sftp, remote_file.path, upload_path)
+                if not method:
+                    fallback.append(remote_file)
+                    return None
+                try:
+                    # The copy runs out of sight on the server, so check it produced the whole file
+                    copied_size = sftp.stat(upload_path).st_size
+                    if copied_size != remote_file.size:
+                        raise IOError(f"Size mismatch after server-side copy: expected {remote_file.size} bytes, destination has {copied_size}")
+                    digest = self._verify_ranged(sftp, remote_file.path, sftp, upload_path)
+                    self._commit_upload(sftp, upload_path, dest_remote_path)
+                except Exception:
+                    self._discard_upload(sftp, upload_path, dest_remote_path)
+                    raise
+                if move:
+                    self._source_remover.remove(remote_file.path)
+            
+            if digest:
+                self.checksums[remote_file.rel_path] = digest
+            self._preserve_timestamp(sftp, dest_remote_path, remote_file)
+            print(f"Copied file on server: {remote_file.rel_path} ({self._format_size(remote_file.size)}) using {method}")
+            return remote_file.rel_path, dest_filename, remote_file.size
+        
+        def tracked(remote_file):
+            # Files left for streaming are counted when they are streamed
+            try:
+                result = copy(remote_file)
+            except Exception:
+                self.progress.file_failed()
+                raise
+            if result is not None:
+                self.progress.add_bytes(remote_file.size)
+                self.progress.file_done()
+            return result
+        
+        try:
+            with sftp_pool.sftp_session(*self.dest_session) as sftp:
+                # Ensure destination directory exists
+                self._ensure_dest_dir(sftp, dest_path)
+            
+            with self._open_sessions(self.dest_session, 'max_destination_connections') as sessions:
+                results = run_parallel(tracked, files, self._max_workers())
         except SSHException as e:
             raise RuntimeError(f"SFTP connection error: {str(e)}")
         
-        return source_files
+        copied = [(remote_file, result, error) for remote_file, result, error in results if result is not None or error is not None]
+        try:
+            if fallback:
+                print(f"Streaming {len(fallback)} files the server could not copy itself")
+                if transfer_mode == 'staged':
+                    self._stage_files(fallback, dest_path)
+                else:
+                    self._relay_files(fallback, dest_path)
+        finally:
+            self._record_results(copied)
+        return self.delivered_files
     
-    def _upload_to_destination(self, temp_dir, dest_path, filenames, file_rename_pattern=None):
-        """Upload files from local temp directory to destination SFTP."""
-        dest_creds = self.destination_credential.get_credentials()
+    def _tail_files(self, files, dest_path, transfer_mode, manifest):
+        """Send each file's bytes past the size it was last delivered at, for sources that only ever grow.
         
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None  # Disable host key checking - not recommended for production
+        The new bytes are appended to the destination file in place, or with
+        tail_delivery 'delta' written to a separate file named after the byte
+        range it covers. A file is copied in full, in the job's transfer mode,
+        when it was never delivered, has shrunk, or no longer has the bytes it was
+        delivered with (rotated or rewritten), or when an appended-to destination
+        file is missing or short.
+        """
+        delivery = self.config.get('tail_delivery') or 'append'
+        chunk_size = int(self.config.get('relay_chunk_size') or DEFAULT_CHUNK_SIZE)
+        buffer_chunks = int(self.config.get('relay_buffer_chunks') or DEFAULT_BUFFER_CHUNKS)
+        full_copies = []
         
-        # Setup connection parameters
-        conn_params = {
-            'host': dest_creds.get('host'),
-            'port': dest_creds.get('port', 22),
-            'username': dest_creds.get('username'),
-            'cnopts': cnopts
-        }
+        def tail(remote_file):
+            filename = remote_file.rel_path
+            source_sftp = source_sessions.get()
+            dest_sftp = dest_sessions.get()
+            dest_filename, dest_remote_path = self._dest_path_for(dest_sftp, remote_file, dest_path)
+            
+            offset = self._tail_offset(source_sftp, dest_sftp, remote_file, dest_remote_path,
+                                       manifest.get(remote_file.path), delivery)
+            # The next run checks the bytes this delivery ends with, however the file is sent
+            self.tail_digests[remote_file.path] = self._tail_digest(source_sftp, remote_file.path, remote_file.size)
+            if offset is None:
+                full_copies.append(remote_file)
+                return None
+            
+            length = remote_file.size - offset
+            self.progress.add_bytes(offset)
+            if not length:
+                # Touched but not grown; there is nothing to send
+                return filename, dest_filename, 0
+            if delivery == 'delta':
+                target_name = f"{dest_filename}.{offset}-{remote_file.size}"
+                target_path = f"{dest_remote_path}.{offset}-{remote_file.size}"
+                write_path = self._upload_path(target_path)
+            else:
+                target_name, target_path = dest_filename, dest_remote_path
+                write_path = dest_remote_path
+            
+            with source_sftp.open(remote_file.path, 'rb') as source_file, \
+                    dest_sftp.open(write_path, 'wb' if delivery == 'delta' else 'r+b') as dest_file:
+                if delivery != 'delta':
+                    # Drop anything an earlier, failed append left past the delivered size
+                    dest_file.truncate(offset)
+                    dest_file.seek(offset)
+                source_file.seek(offset)
+                source_file.prefetch(remote_file.size)
+                dest_file.set_pipelined(True)
+                reader = LimitedReader(throttled_reader(self.progress.reader(source_file), self.source_limiter), length)
+                relay_stream(reader, throttled_writer(dest_file, self.dest_limiter), chunk_size, buffer_chunks)
+            
+            if delivery == 'delta':
+                try:
+                    self._verify_delivery(dest_sftp, write_path, length, None)
+                    self._commit_upload(dest_sftp, write_path, target_path)
+                except Exception:
+                    self._discard_upload(dest_sftp, write_path, target_path)
+                    raise
+            else:
+                self._verify_delivery(dest_sftp, target_path, remote_file.size, None)
+                self._preserve_timestamp(dest_sftp, target_path, remote_file)
+            
+            self.appended_files.append(filename)
+            if self._source_remover is not None:
+                self._source_remover.remove(remote_file.path)
+            print(f"Transferred tail of file: {filename} ({self._format_size(length)} from offset {offset})")
+            return filename, target_name, length
         
-        # Add either password or private key
-        if dest_creds.get('password'):
-            conn_params['password'] = dest_creds.get('password')
-        elif dest_creds.get('private_key'):
-            private_key_file = os.path.join(temp_dir, 'dest_key')
-            with open(private_key_file, 'w') as f:
-                f.write(dest_creds.get('private_key'))
-            os.chmod(private_key_file, 0o600)
-            conn_params['private_key'] = private_key_file
-            if dest_creds.get('private_key_pass'):
-                conn_params['private_key_pass'] = dest_creds.get('private_key_pass')
+        def tracked(remote_file):
+            # Files copied in full are counted when they are copied
+            try:
+                result = tail(remote_file)
+            except Exception:
+                self.progress.file_failed()
+                raise
+            if result is not None:
+                self.progress.file_done()
+            return result
         
         try:
-            with pysftp.Connection(**conn_params) as sftp:
+            with sftp_pool.sftp_session(*self.dest_session) as dest_sftp:
                 # Ensure destination directory exists
-                if not sftp.exists(dest_path):
-                    sftp.makedirs(dest_path)
+                self._ensure_dest_dir(dest_sftp, dest_path)
+            
+            with self._open_sessions(self.source_session, 'max_source_connections') as source_sessions, \
+                    self._open_sessions(self.dest_session, 'max_destination_connections') as dest_sessions:
+                results = run_parallel(self._adapt_concurrency(tracked), files, self._max_workers())
+        except SSHException as e:
+            raise RuntimeError(f"SFTP connection error: {str(e)}")
+        
+        tailed = [(remote_file, result, error) for remote_file, result, error in results if result is not None or error is not None]
+        try:
+            if full_copies:
+                print(f"Copying {len(full_copies)} new, truncated or replaced files in full")
+                if transfer_mode == 'staged':
+                    self._stage_files(full_copies, dest_path)
+                else:
+                    self._relay_files(full_copies, dest_path)
+        finally:
+            self._record_results(tailed)
+        return self.delivered_files
+    
+    def _tail_offset(self, source_sftp, dest_sftp, remote_file, dest_remote_path, delivered, delivery):
+        """Offset to send a file from, or None if it has to be copied in full."""
+        if not delivered or not delivered[1] or not delivered[4]:
+            return None
+        delivered_size, tail_digest = delivered[1], delivered[4]
+        if remote_file.size < delivered_size:
+            print(f"File was truncated since it was last delivered: {remote_file.rel_path}")
+            return None
+        if self._tail_digest(source_sftp, remote_file.path, delivered_size) != tail_digest:
+            print(f"File was replaced since it was last delivered: {remote_file.rel_path}")
+            return None
+        if delivery != 'delta':
+            try:
+                dest_size = dest_sftp.stat(dest_remote_path).st_size
+            except IOError:
+                dest_size = None
+            if dest_size is None or dest_size < delivered_size:
+                print(f"Destination copy is missing or short, sending the whole file: {remote_file.rel_path}")
+                return None
+        return delivered_size
+    
+    def _tail_digest(self, sftp, remote_path, end):
+        """Digest of the bytes of a source file just before ``end``."""
+        start = max(0, end - TAIL_PROBE_BYTES)
+        with sftp.open(remote_path, 'rb') as source_file:
+            source_file.seek(start)
+            data = source_file.read(end - start)
+        return hashlib.sha256(data).hexdigest()
+    
+    def _same_server_account(self):
+        """Return True if the source and destination credentials log in as the same user on the same server."""
+        if self.source_credential.id == self.destination_credential.id:
+            return True
+        try:
+            with sftp_pool.sftp_session(*self.source_session) as source_sftp, \
+                    sftp_pool.sftp_session(*self.dest_session) as dest_sftp:
+                return same_server_account(source_sftp, dest_sftp, self.source_session[1].get('username'),
+                                           self.dest_session[1].get('username'))
+        except Exception as e:
+            print(f"Could not compare source and destination servers: {str(e)}")
+            return False
+    
+    def _bundle_files(self, files, dest_path):
+        """Pack the files into tar.gz or zip archives written straight to the destination.
+        
+        Files up to the prefetch size are read from the source in parallel and
+        held in memory until their turn; larger ones are streamed in when they are
+        reached. A single thread writes the archive in listing order. With a volume
+        size set, a new volume is started before a file that would take the current
+        one past it. Each volume is written under a temporary name, and its files
+        count as delivered once it is in place. The run result lists the files in
+        every volume.
+        """
+        level = self.config.get('compression_level')
+        volume_limit = int(self.config.get('bundle_volume_mb') or 0) * 1024 * 1024
+        extension = ARCHIVE_EXTENSIONS[self.bundle_format]
+        base_name = self._bundle_base_name(extension)
+        results = []
+        
+        def fetch(remote_file):
+            if remote_file.size > DEFAULT_BUNDLE_PREFETCH_BYTES:
+                return None
+            buffer = io.BytesIO()
+            size = source_sessions.get().getfo(remote_file.path, throttled_writer(buffer, self.source_limiter))
+            if size != remote_file.size:
+                raise IOError(f"Size mismatch after download: expected {remote_file.size} bytes, got {size}")
+            buffer.seek(0)
+            return buffer
+        
+        def open_volume():
+            index = len(self.bundles) + 1
+            name = f"{base_name}.{index:03d}{extension}" if volume_limit else base_name + extension
+            remote_path = os.path.join(dest_path, name).replace('\\', '/')
+            upload_path = self._upload_path(remote_path)
+            hasher = new_hasher(self.checksum_algorithm)
+            handle = dest_sftp.open(upload_path, 'wb')
+            handle.set_pipelined(True)
+            archive = ArchiveStream(throttled_writer(handle, self.dest_limiter), self.bundle_format, level,
+                                    hasher.update if hasher is not None else None)
+            return BundleVolume(name, remote_path, upload_path, handle, archive, hasher, [])
+        
+        def close_volume(volume):
+            size = volume.archive.close()
+            volume.handle.close()
+            digest = format_digest(volume.hasher)
+            self._verify_delivery(dest_sftp, volume.upload_path, size, digest)
+            self._commit_upload(dest_sftp, volume.upload_path, volume.path)
+            if digest:
+                self.checksums[volume.name] = digest
+            self.bundles.append({
+                'name': volume.name,
+                'size': size,
+                'checksum': digest,
+                'files': [{'file': remote_file.rel_path, 'size': remote_file.size, 'mtime': remote_file.mtime}
+                          for remote_file in volume.files]
+            })
+            for remote_file in volume.files:
+                self.transferred_files.append(f"{remote_file.rel_path} → {volume.name} ({self._format_size(remote_file.size)})")
+                self.delivered_files.append(remote_file)
+                if self._source_remover is not None:
+                    self._source_remover.remove(remote_file.path)
+            print(f"Transferred bundle: {volume.name} ({self._format_size(size)}, {len(volume.files)} files)")
+        
+        volume = None
+        try:
+            with sftp_pool.sftp_session(*self.dest_session) as dest_sftp, \
+                    sftp_pool.sftp_session(*self.source_session) as source_sftp:
+                # Ensure destination directory exists
+                self._ensure_dest_dir(dest_sftp, dest_path)
                 
-                # Upload each file
-                for filename in filenames:
-                    local_path = os.path.join(temp_dir, filename)
-                    
-                    # Apply rename pattern if provided
-                    dest_filename = self._apply_rename_pattern(filename, file_rename_pattern)
-                    remote_path = os.path.join(dest_path, dest_filename).replace('\\', '/')
-                    
-                    # Get file size for logging
-                    file_size = os.path.getsize(local_path)
-                    
-                    # Log the transfer
-                    if filename != dest_filename and file_rename_pattern:
-                        print(f"Transferring file: {filename} as {dest_filename} ({self._format_size(file_size)})")
-                        self.transferred_files.append(f"{filename} → {dest_filename} ({self._format_size(file_size)})")
-                    else:
-                        print(f"Transferring file: {filename} ({self._format_size(file_size)})")
-                        self.transferred_files.append(f"{filename} ({self._format_size(file_size)})")
-                    
-                    # Upload the file
-                    sftp.put(local_path, remote_path)
-                    
+                with self._open_sessions(self.source_session, 'max_source_connections') as source_sessions:
+                    try:
+                        for remote_file, buffer, error in iter_parallel(fetch, files, self._max_workers()):
+                            if error is not None:
+                                # A file that could not be read is left out; the volume itself is still good
+                                results.append((remote_file, None, error))
+                                self.progress.file_failed()
+                                continue
+                            
+                            if volume is not None and volume_limit and volume.files \
+                                    and volume.archive.size + remote_file.size > volume_limit:
+                                close_volume(volume)
+                                volume = None
+                            if volume is None:
+                                volume = open_volume()
+                            
+                            member_name = self._dest_name(remote_file)
+                            if buffer is not None:
+                                volume.archive.add(member_name, remote_file.size, remote_file.mtime, self.progress.reader(buffer))
+                            else:
+                                with source_sftp.open(remote_file.path, 'rb') as source_file:
+                                    source_file.prefetch(remote_file.size)
+                                    reader = throttled_reader(self.progress.reader(source_file), self.source_limiter)
+                                    volume.archive.add(member_name, remote_file.size, remote_file.mtime, reader)
+                            volume.files.append(remote_file)
+                            results.append((remote_file, member_name, None))
+                            self.progress.file_done()
+                        
+                        if volume is not None:
+                            close_volume(volume)
+                            volume = None
+                    except Exception as e:
+                        # A volume cut short is not a valid archive, so none of its files were delivered
+                        if volume is not None:
+                            volume.handle.close()
+                            self._discard_upload(dest_sftp, volume.upload_path, volume.path)
+                            raise RuntimeError(f"Failed to write bundle {volume.name}: {str(e)}")
+                        raise
         except SSHException as e:
             raise RuntimeError(f"SFTP connection error: {str(e)}")
+        
+        self._raise_for_failures(results, 'bundle')
+        return self.delivered_files
+    
+    def _bundle_base_name(self, extension):
+        """Name of this run's bundle without the archive extension, from the job's bundle name pattern."""
+        pattern = self.config.get('bundle_name') or DEFAULT_BUNDLE_NAME
+        if pattern.endswith(extension):
+            pattern = pattern[:-len(extension)]
+        # Same clock as the run's file names, so a bundle and its members share one {timestamp}
+        plan = RenamePlan(pattern, now=self.rename_plan.now)
+        return plan.apply(self.job.name) if plan.active else pattern
     
-    def _delete_source_files(self, source_path):
-        """Delete files from source SFTP after successful transfer."""
-        source_creds = self.source_credential.get_credentials()
+    def _stage_files(self, files, dest_path):
+        """Download each file into local staging, then upload it to the destination from there.
         
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None  # Disable host key checking - not recommended for production
+        Files below the memory threshold are staged in memory and larger ones are
+        spooled to the staging directory. Disk and memory use are capped per worker;
+        a file waits for space to free up rather than failing when the cap is reached.
+        """
+        staging = self._staging_area()
         
-        # Setup connection parameters
-        conn_params = {
-            'host': source_creds.get('host'),
-            'port': source_creds.get('port', 22),
-            'username': source_creds.get('username'),
-            'cnopts': cnopts
-        }
+        def stage(remote_file):
+            source_sftp = source_sessions.get()
+            dest_sftp = dest_sessions.get()
+            with staging.stage(remote_file.size) as staged:
+                self._download_from_source(source_sftp, remote_file, staged.fileobj)
+                staged.fileobj.seek(0)
+                return self._upload_to_destination(dest_sftp, staged.fileobj, remote_file, dest_path)
         
-        # Add either password or private key
-        if source_creds.get('password'):
-            conn_params['password'] = source_creds.get('password')
-        elif source_creds.get('private_key'):
-            with tempfile.NamedTemporaryFile(mode='w', delete=False) as key_file:
-                key_file.write(source_creds.get('private_key'))
-                key_path = key_file.name
-            os.chmod(key_path, 0o600)
-            conn_params['private_key'] = key_path
-            if source_creds.get('private_key_pass'):
-                conn_params['private_key_pass'] = source_creds.get('private_key_pass')
-        
-        try:
-            with pysftp.Connection(**conn_params) as sftp:
-                # Delete each transferred file
-                for filename in self.transferred_files:
-                    if sftp.isdir(source_path):
-                        remote_path = os.path.join(source_path, filename).replace('\\', '/')
-                    else:
-                        remote_path = source_path
-                    
-                    if sftp.exists(remote_path):
-                        sftp.remove(remote_path)
+        try:
+            with sftp_pool.sftp_session(*self.dest_session) as sftp:
+                # Ensure destination directory exists
+                self._ensure_dest_dir(sftp, dest_path)
+            
+            # Stage files in parallel, each worker holding one source and one destination session
+            with self._open_sessions(self.source_session, 'max_source_connections') as source_sessions, \
+                    self._open_sessions(self.dest_session, 'max_destination_connections') as dest_sessions:
+                results = run_parallel(self._track_progress(self._adapt_concurrency(self._then_delete_source(stage))), files, self._max_workers())
         except SSHException as e:
-            raise RuntimeError(f"SFTP connection error during cleanup: {str(e)}")
-        finally:
-            # Clean up temp key file if it was created
-            if source_creds.get('private_key') and 'key_path' in locals():
-                os.unlink(key_path)
-    
-    def _apply_rename_pattern(self, filename, rename_pattern):
-        """Apply rename pattern to filename."""
-        if not rename_pattern:
-            return filename
-            
-        # Get file parts
-        basename, extension = os.path.splitext(filename)
-        
-        # Define replacement variables
-        replacements = {
-            '{filename}': filename,
-            '{basename}': basename,
-            '{ext}': extension,
-            '{timestamp}': datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
-            '{date}': datetime.datetime.now().strftime('%Y%m%d'),
-            '{time}': datetime.datetime.now().strftime('%H%M%S'),
-            '{uuid}': str(uuid.uuid4()),
-            '{random}': ''.join(random.choices('0123456789abcdef', k=8))
-        }
+            raise RuntimeError(f"SFTP connection error: {str(e)}")
+        
+        return self._record_results(results)
+    
+    def _staging_area(self):
+        """Staging area for this job: the job's staging directory if set, else the worker's."""
+        spool_dir = self.config.get('staging_dir') or Config.STAGING_DIR
+        threshold_mb = self.config.get('staging_memory_threshold_mb')
+        if threshold_mb is None or threshold_mb == '':
+            threshold_mb = Config.STAGING_MEMORY_THRESHOLD_MB
+        return get_staging_area(spool_dir, int(threshold_mb) * 1024 * 1024,
+                                Config.STAGING_MEMORY_BUDGET_MB * 1024 * 1024,
+                                Config.STAGING_DISK_BUDGET_MB * 1024 * 1024)
+    
+    def _download_from_source(self, sftp, remote_file, local_file):
+        """Download a source file into a local file object."""
+        # Hash the bytes as they arrive instead of reading the file again later
+        hasher = new_hasher(self.checksum_algorithm)
+        writer = HashingWriter(throttled_writer(local_file, self.source_limiter), hasher)
+        if self.tail_mode:
+            # A tailed file may still be growing; copy only the bytes that were listed
+            with sftp.open(remote_file.path, 'rb') as source_file:
+                source_file.prefetch(remote_file.size)
+                size = relay_stream(LimitedReader(source_file, remote_file.size), writer)
+        else:
+            size = sftp.getfo(remote_file.path, writer)
+        if size != remote_file.size:
+            raise IOError(f"Size mismatch after download: expected {remote_file.size} bytes, got {size}")
+        if hasher is not None:
+            self.checksums[remote_file.rel_path] = format_digest(hasher)
+    
+    def _upload_to_destination(self, sftp, local_file, remote_file, dest_path):
+        """Upload a staged file object to destination SFTP."""
+        filename = remote_file.rel_path
+        
+        # Apply rename pattern if provided, keeping the file's subdirectory
+        dest_filename, remote_path = self._dest_path_for(sftp, remote_file, dest_path)
+        
+        file_size = remote_file.size
+        print(f"Transferring file: {filename} ({self._format_size(file_size)})")
+        
+        # Write under a temporary name so nobody picks up a half-written file
+        upload_path = self._upload_path(remote_path)
+        if self.compression:
+            # Compress on a separate thread while uploading; the digest then covers the compressed bytes
+            file_size = self._upload_compressed(sftp, self.progress.reader(local_file), upload_path, filename)
+            self._verify_delivery(sftp, upload_path, file_size, self.checksums.get(filename))
+        else:
+            # Upload the file; putfo() confirms the remote size
+            reader = throttled_reader(self.progress.reader(local_file), self.dest_limiter)
+            sftp.putfo(reader, upload_path, file_size=file_size)
+            self._verify_delivery(sftp, upload_path, None, self.checksums.get(filename))
+        self._commit_upload(sftp, upload_path, remote_path)
+        self._preserve_timestamp(sftp, remote_path, remote_file)
+        return filename, dest_filename, file_size
+    
+    def _upload_compressed(self, sftp, local_file, remote_path, filename):
+        """Stream a local file object to the destination through the compressor; returns the compressed size."""
+        chunk_size = int(self.config.get('relay_chunk_size') or DEFAULT_CHUNK_SIZE)
+        buffer_chunks = int(self.config.get('relay_buffer_chunks') or DEFAULT_BUFFER_CHUNKS)
+        hasher = new_hasher(self.checksum_algorithm)
+        compressor = new_compressor(self.compression, self.config.get('compression_level'))
+        
+        with sftp.open(remote_path, 'wb') as remote_file:
+            remote_file.set_pipelined(True)
+            on_chunk = hasher.update if hasher is not None else None
+            writer = throttled_writer(remote_file, self.dest_limiter)
+            file_size = relay_stream(local_file, writer, chunk_size, buffer_chunks, on_chunk, compressor)
+        
+        if hasher is not None:
+            self.checksums[filename] = format_digest(hasher)
+        return file_size
+    
+    def _relay_files(self, files, dest_path):
+        """Stream files from source SFTP to destination SFTP without staging them on disk."""
+        chunk_size = int(self.config.get('relay_chunk_size') or DEFAULT_CHUNK_SIZE)
+        buffer_chunks = int(self.config.get('relay_buffer_chunks') or DEFAULT_BUFFER_CHUNKS)
+        multistream_threshold = int(self.config.get('multistream_threshold_mb') or 0) * 1024 * 1024
+        multistream_streams = int(self.config.get('multistream_streams') or DEFAULT_MULTISTREAM_STREAMS)
+        checkpoints = self.checkpoints
+        
+        def relay(remote_file):
+            filename, source_remote_path = remote_file.rel_path, remote_file.path
+            source_sftp = source_sessions.get()
+            dest_sftp = dest_sessions.get()
+            dest_filename, dest_remote_path = self._dest_path_for(dest_sftp, remote_file, dest_path)
+            
+            # Skip files an interrupted run already completed, resume partial ones
+            checkpoint = checkpoints.get(remote_file, dest_remote_path)
+            if checkpoint and checkpoint.get('done'):
+                print(f"Already transferred in an earlier attempt: {filename}")
+                if checkpoint.get('checksum'):
+                    self.checksums[filename] = checkpoint['checksum']
+                self.progress.add_bytes(remote_file.size)
+                return filename, dest_filename, remote_file.size
+            
+            # Split very large files into byte ranges moved over separate channels;
+            # a compressed stream cannot be split, so compressed files always use one
+            if (multistream_threshold and multistream_streams > 1 and remote_file.size >= multistream_threshold
+                    and not self.compression):
+                file_size, streams = self._relay_ranged(source_sftp, dest_sftp, source_remote_path, dest_remote_path,
+                                                        remote_file.size, multistream_streams, chunk_size, buffer_chunks)
+                # Ranges are written out of order, so only server-side hashes can be compared
+                digest = self._verify_ranged(source_sftp, source_remote_path, dest_sftp, dest_remote_path)
+                if digest:
+                    self.checksums[filename] = digest
+                self._preserve_timestamp(dest_sftp, dest_remote_path, remote_file)
+                checkpoints.mark_done(remote_file, dest_remote_path, digest)
+                print(f"Transferred file: {filename} ({self._format_size(file_size)}) over {streams} streams")
+                return filename, dest_filename, file_size
+            
+            # Write under a temporary name so nobody picks up a half-written file; resume continues that file
+            upload_path = self._upload_path(dest_remote_path)
+            
+            # A compressed stream cannot be continued mid-way, so compressed files start over
+            offset = 0 if self.compression else self._resume_offset(dest_sftp, upload_path, checkpoint)
+            hasher = new_hasher(self.checksum_algorithm)
+            if offset and hasher is not None:
+                # The digest must cover the bytes delivered by the earlier attempt too
+                self._hash_prefix(source_sftp, source_remote_path, offset, hasher, chunk_size)
+            
+            with source_sftp.open(source_remote_path, 'rb') as source_file, \
+                    dest_sftp.open(upload_path, 'r+b' if offset else 'wb') as dest_file:
+                if offset:
+                    # Drop any unconfirmed bytes past the checkpoint and continue from there
+                    dest_file.truncate(offset)
+                    source_file.seek(offset)
+                    dest_file.seek(offset)
+                    print(f"Resuming file: {filename} at {self._format_size(offset)}")
+                    self.progress.add_bytes(offset)
+                
+                # Pipeline requests in both directions instead of waiting on each round trip
+                source_file.prefetch(remote_file.size)
+                dest_file.set_pipelined(True)
+                tracker = checkpoints.tracker(remote_file, dest_remote_path, offset)
+                
+                def on_chunk(chunk):
+                    # Hash each chunk as it is written, so the data is only read once
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    tracker(chunk)
+                
+                compressor = new_compressor(self.compression, self.config.get('compression_level'))
+                reader = throttled_reader(self.progress.reader(source_file), self.source_limiter)
+                if self.tail_mode:
+                    # A tailed file may still be growing; copy only the bytes that were listed
+                    reader = LimitedReader(reader, remote_file.size - offset)
+                writer = throttled_writer(dest_file, self.dest_limiter)
+                file_size = offset + relay_stream(reader, writer, chunk_size, buffer_chunks, on_chunk, compressor)
+            
+            # The digest covers the bytes as stored on the destination
+            digest = format_digest(hasher)
+            self._verify_delivery(dest_sftp, upload_path, file_size if self.compression else remote_file.size, digest)
+            self._commit_upload(dest_sftp, upload_path, dest_remote_path)
+            if digest:
+                self.checksums[filename] = digest
+            self._preserve_timestamp(dest_sftp, dest_remote_path, remote_file)
+            checkpoints.mark_done(remote_file, dest_remote_path, digest)
+            print(f"Transferred file: {filename} ({self._format_size(file_size)})")
+            return filename, dest_filename, file_size
+        
+        try:
+            with sftp_pool.sftp_session(*self.dest_session) as dest_sftp:
+                # Ensure destination directory exists
+                self._ensure_dest_dir(dest_sftp, dest_path)
+            
+            # Relay files in parallel, each worker holding one source and one destination session
+            with self._open_sessions(self.source_session, 'max_source_connections') as source_sessions, \
+                    self._open_sessions(self.dest_session, 'max_destination_connections') as dest_sessions:
+                results = run_parallel(self._track_progress(self._adapt_concurrency(self._then_delete_source(relay))), files, self._max_workers())
+        except SSHException as e:
+            raise RuntimeError(f"SFTP connection error: {str(e)}")
+        
+        delivered_files = self._record_results(results)
+        
+        # Whole batch delivered, nothing left to resume
+        checkpoints.clear()
+        return delivered_files
+    
+    def _fan_out_files(self, files):
+        """Read each source file once and stream it to every destination at the same time.
+        
+        Each destination writes from its own buffer over its own sessions and
+        bandwidth limit, so a slow one only holds the others back once its buffer
+        is full. Outcomes are tracked per destination in ``destination_results``;
+        a file counts as delivered once every destination that needed it has it.
+        Fanned-out files are neither resumed nor split into byte ranges.
+        """
+        chunk_size = int(self.config.get('relay_chunk_size') or DEFAULT_CHUNK_SIZE)
+        buffer_chunks = int(self.config.get('relay_buffer_chunks') or DEFAULT_BUFFER_CHUNKS)
+        results_lock = threading.Lock()
+        unavailable = {}
+        for destination in self.destinations:
+            self.destination_results[destination.name] = {'delivered': [], 'failed': {}}
+        
+        def fan_out(remote_file):
+            filename = remote_file.rel_path
+            dest_filename = self._dest_name(remote_file)
+            needed = self._dest_targets.get(remote_file.path)
+            
+            # Open the upload on every destination that needs this file
+            targets, errors, delivered = [], {}, []
+            for destination, sessions in zip(self.destinations, dest_sessions):
+                if needed is not None and destination.name not in needed:
+                    continue
+                if destination.name in unavailable:
+                    errors[destination.name] = unavailable[destination.name]
+                    continue
+                try:
+                    dest_sftp = sessions.get()
+                    _, dest_remote_path = self._dest_path_for(dest_sftp, remote_file, destination.path, destination.dirs)
+                    upload_path = self._upload_path(dest_remote_path)
+                    dest_file = dest_sftp.open(upload_path, 'wb')
+                except Exception as e:
+                    errors[destination.name] = e
+                    continue
+                dest_file.set_pipelined(True)
+                targets.append((destination, dest_sftp, dest_remote_path, upload_path, dest_file))
+            
+            hasher = new_hasher(self.checksum_algorithm)
+            outcomes = []
+            if targets:
+                try:
+                    with source_sessions.get().open(remote_file.path, 'rb') as source_file:
+                        source_file.prefetch(remote_file.size)
+                        reader = throttled_reader(self.progress.reader(source_file), self.source_limiter)
+                        writers = [throttled_writer(target[4], target[0].limiter) for target in targets]
+                        on_chunk = hasher.update if hasher is not None else None
+                        compressor = new_compressor(self.compression, self.config.get('compression_level'))
+                        outcomes = fan_out_stream(reader, writers, chunk_size, buffer_chunks, on_chunk, compressor)
+                except Exception as e:
+                    # Without the source nothing can be delivered anywhere
+                    outcomes = [(0, e)] * len(targets)
+            
+            # The digest covers the bytes as stored on every destination
+            digest = format_digest(hasher)
+            file_size = remote_file.size
+            for (destination, dest_sftp, dest_remote_path, upload_path, dest_file), (written, error) in zip(targets, outcomes):
+                try:
+                    dest_file.close()
+                    if error is not None:
+                        raise error
+                    file_size = written if self.compression else remote_file.size
+                    self._verify_delivery(dest_sftp, upload_path, file_size, digest)
+                    self._commit_upload(dest_sftp, upload_path, dest_remote_path)
+                    self._preserve_timestamp(dest_sftp, dest_remote_path, remote_file)
+                    delivered.append(destination.name)
+                except Exception as e:
+                    errors[destination.name] = error or e
+                    self._discard_upload(dest_sftp, upload_path, dest_remote_path)
+            
+            with results_lock:
+                for name in delivered:
+                    self.destination_results[name]['delivered'].append(filename)
+                for name, error in errors.items():
+                    self.destination_results[name]['failed'][filename] = error
+            if errors:
+                raise RuntimeError('; '.join(f"{name}: {str(error)}" for name, error in errors.items()))
+            
+            if digest:
+                self.checksums[filename] = digest
+            print(f"Transferred file: {filename} ({self._format_size(file_size)}) to {len(delivered)} destinations")
+            return filename, dest_filename, file_size
         
-        # Apply replacements
-        new_filename = rename_pattern
-        for key, value in replacements.items():
-            new_filename = new_filename.replace(key, value)
+        try:
+            for destination in self.destinations:
+                try:
+                    with sftp_pool.sftp_session(*destination.session) as dest_sftp:
+                        # Ensure destination directory exists
+                        self._ensure_dest_dir(dest_sftp, destination.path, destination.dirs)
+                except (IOError, SSHException) as e:
+                    # Keep delivering to the other destinations; every file fails for this one
+                    unavailable[destination.name] = e
             
-        # If the pattern didn't result in any changes, return original
-        if new_filename == rename_pattern:
-            return filename
+            # Each worker holds one source session and one session per destination
+            with ExitStack() as stack:
+                source_sessions = stack.enter_context(self._open_sessions(self.source_session, 'max_source_connections'))
+                dest_sessions = [
+                    # Separate caps per destination so a worker never waits on its own sessions
+                    # when two destinations are on the same host
+                    stack.enter_context(self._open_sessions(destination.session, 'max_destination_connections',
+                                                            role=f'destination-{index}' if index else None))
+                    for index, destination in enumerate(self.destinations)
+                ]
+                results = run_parallel(self._track_progress(self._adapt_concurrency(self._then_delete_source(fan_out))), files, self._max_workers())
+        except SSHException as e:
+            raise RuntimeError(f"SFTP connection error: {str(e)}")
+        
+        delivered_files = self._record_results(results)
+        
+        # Nothing left to resume from an earlier single-destination run
+        self.checkpoints.clear()
+        return delivered_files
+    
+    def _hash_prefix(self, source_sftp, source_remote_path, length, hasher, chunk_size):
+        """Feed the first ``length`` bytes of a source file into ``hasher``."""
+        with source_sftp.open(source_remote_path, 'rb') as source_file:
+            source_file.prefetch(length)
+            reader = LimitedReader(throttled_reader(source_file, self.source_limiter), length)
+            while True:
+                chunk = reader.read(chunk_size)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+    
+    def _verify_delivery(self, dest_sftp, dest_remote_path, expected_size, digest):
+        """Check the delivered file's size and, if enabled, its hash on the destination server."""
+        if expected_size is not None:
+            dest_size = dest_sftp.stat(dest_remote_path).st_size
+            if dest_size != expected_size:
+                raise IOError(f"Size mismatch after upload: expected {expected_size} bytes, destination has {dest_size}")
+        if self.remote_hasher is not None and digest:
+            verify_digest(digest, self.remote_hasher.digest(dest_sftp, dest_remote_path), dest_remote_path)
+    
+    def _verify_ranged(self, source_sftp, source_remote_path, dest_sftp, dest_remote_path):
+        """Compare server-side hashes of a file copied in ranges; returns the digest, or None if unavailable."""
+        if self.remote_hasher is None:
+            return None
+        source_digest = self.remote_hasher.digest(source_sftp, source_remote_path)
+        if not source_digest:
+            return None
+        verify_digest(source_digest, self.remote_hasher.digest(dest_sftp, dest_remote_path), dest_remote_path)
+        return source_digest
+    
+    def _upload_path(self, dest_remote_path):
+        """Name a file is written under while it uploads."""
+        return part_path(dest_remote_path) if self.atomic_uploads else dest_remote_path
+    
+    def _commit_upload(self, dest_sftp, upload_path, dest_remote_path):
+        """Move a fully written and verified upload to its final name in one rename."""
+        if upload_path != dest_remote_path:
+            sftp_replace(dest_sftp, upload_path, dest_remote_path)
+    
+    def _discard_upload(self, dest_sftp, upload_path, dest_remote_path):
+        """Remove the part file of an upload that will not be resumed."""
+        if upload_path == dest_remote_path:
+            return
+        try:
+            dest_sftp.remove(upload_path)
+        except IOError:
+            pass
+    
+    def _cleanup_stale_parts(self):
+        """Remove part files abandoned by earlier runs from the destination directories this run used."""
+        max_age = float(self.config.get('stale_part_hours') or DEFAULT_STALE_PART_HOURS) * 3600
+        for destination in self.destinations:
+            try:
+                with sftp_pool.sftp_session(*destination.session) as sftp:
+                    for remote_dir in sorted(destination.dirs):
+                        for path in sftp_cleanup_parts(sftp, remote_dir, max_age):
+                            print(f"Removed stale part file: {path}")
+            except Exception as e:
+                # Cleanup is best effort and must not hide the transfer result
+                print(f"Could not clean up stale part files on {destination.name}: {str(e)}")
+    
+    def _resume_offset(self, dest_sftp, dest_remote_path, checkpoint):
+        """Byte offset to resume a partial file from, confirmed against the destination."""
+        if not checkpoint or not checkpoint.get('offset'):
+            return 0
+        try:
+            dest_size = dest_sftp.stat(dest_remote_path).st_size
+        except IOError:
+            return 0
+        # Never trust bytes beyond either the checkpoint or what actually landed
+        return min(checkpoint['offset'], dest_size)
+    
+    def _relay_ranged(self, source_sftp, dest_sftp, source_remote_path, dest_remote_path, file_size, streams,
+                      chunk_size, buffer_chunks):
+        """Relay one large file as parallel byte ranges, each over its own source and destination channel.
+        
+        The first range uses the worker's own channels. Each further stream needs
+        a free source and destination slot under the per-host connection caps;
+        when none is free the file is split over fewer streams instead of waiting.
+        Returns the file size and the number of streams used.
+        """
+        partial_path = part_path(dest_remote_path)
+        
+        # Create the partial file up front so every stream can open it for update
+        with dest_sftp.open(partial_path, 'wb'):
+            pass
+        
+        def copy_range(work):
+            (offset, length), (range_source, range_dest) = work
+            with range_source.open(source_remote_path, 'rb') as source_file, \
+                    range_dest.open(partial_path, 'r+b') as dest_file:
+                source_file.seek(offset)
+                dest_file.seek(offset)
+                # Prefetch only this stream's range
+                source_file.prefetch(offset + length)
+                dest_file.set_pipelined(True)
+                reader = LimitedReader(throttled_reader(self.progress.reader(source_file), self.source_limiter), length)
+                writer = throttled_writer(dest_file, self.dest_limiter)
+                copied = relay_stream(reader, writer, chunk_size, buffer_chunks)
+            if copied != length:
+                raise IOError(f"Range at offset {offset} copied {copied} of {length} bytes")
+            return copied
+        
+        source_slots = self._session_limiter(self.source_session, 'max_source_connections')
+        dest_slots = self._session_limiter(self.dest_session, 'max_destination_connections')
+        channels = [(source_sftp, dest_sftp)]
+        with ExitStack() as extra:
+            while len(channels) < streams and source_slots.try_acquire():
+                extra.callback(source_slots.release)
+                if not dest_slots.try_acquire():
+                    break
+                extra.callback(dest_slots.release)
+                range_source = sftp_pool.open_sftp_with(*self.source_session)
+                extra.callback(range_source.close)
+                range_dest = sftp_pool.open_sftp_with(*self.dest_session)
+                extra.callback(range_dest.close)
+                channels.append((range_source, range_dest))
+            
+            ranges = split_ranges(file_size, len(channels))
+            results = run_parallel(copy_range, list(zip(ranges, channels)), len(channels))
+        
+        try:
+            self._raise_for_failures(results, 'copy')
             
-        return new_filename
+            # Only commit the file under its final name once every byte is accounted for
+            written_size = dest_sftp.stat(partial_path).st_size
+            if written_size != file_size:
+                raise IOError(f"Size mismatch after ranged transfer: expected {file_size} bytes, found {written_size}")
+        except Exception:
+            try:
+                dest_sftp.remove(partial_path)
+            except IOError:
+                pass
+            raise
+        
+        sftp_replace(dest_sftp, partial_path, dest_remote_path)
+        return file_size, len(ranges)
+    
+    def _dest_name(self, remote_file):
+        """Renamed destination path relative to the destination directory, worked out once per file."""
+        dest_name = self._dest_names.get(remote_file.path)
+        if dest_name is None:
+            rel_dir = os.path.dirname(remote_file.rel_path)
+            dest_filename = compressed_name(self.rename_plan.apply(remote_file.name), self.compression)
+            dest_name = os.path.join(rel_dir, dest_filename).replace('\\', '/')
+            self._dest_names[remote_file.path] = dest_name
+        return dest_name
+    
+    def _dest_path_for(self, sftp, remote_file, dest_path, known_dirs=None):
+        """Return the renamed file's relative and full destination paths, mirroring its source subdirectory."""
+        rel_dir = os.path.dirname(remote_file.rel_path)
+        dest_filename = self._dest_name(remote_file)
+        if rel_dir:
+            self._ensure_dest_dir(sftp, os.path.join(dest_path, rel_dir).replace('\\', '/'), known_dirs)
+        return dest_filename, os.path.join(dest_path, dest_filename).replace('\\', '/')
+    
+    def _preserve_timestamp(self, sftp, remote_path, remote_file):
+        """Give the uploaded file the source file's modification time, if configured."""
+        if not self.preserve_timestamps or remote_file.mtime is None:
+            return
+        try:
+            sftp.utime(remote_path, (remote_file.mtime, remote_file.mtime))
+        except IOError as e:
+            # Some servers refuse setstat; the file itself was delivered
+            print(f"Could not preserve timestamp on {remote_path}: {str(e)}")
+    
+    def _ensure_dest_dir(self, sftp, remote_dir, known_dirs=None):
+        """Create a destination directory, checking each directory only once per run.
+        
+        ``known_dirs`` is the set of directories already created on this
+        destination; the job's own destination is used by default.
+        """
+        known_dirs = self._dest_dirs if known_dirs is None else known_dirs
+        with self._dest_dirs_lock:
+            if remote_dir in known_dirs:
+                return
+        if not sftp_exists(sftp, remote_dir):
+            sftp_makedirs(sftp, remote_dir)
+        with self._dest_dirs_lock:
+            known_dirs.add(remote_dir)
+    
+    def _load_extra_destinations(self):
+        """Destinations besides the job's own that the same files are fanned out to."""
+        destinations = []
+        for index, entry in enumerate(self.config.get('extra_destinations') or [], start=1):
+            credential = Credential.query.get(entry.get('credential_id'))
+            path = entry.get('path')
+            if credential is None or not path:
+                raise ValueError(f"Extra destination {index} has no credential or path")
+            session = (credential_pool_key(credential), credential.get_credentials())
+            # Relayed bytes already count against the job's limit as they are read
+            destinations.append(Destination(f"{credential.name}:{path}", session, path, limiter_for([credential]), set()))
+        return destinations
+    
+    def _get_adaptive_limiters(self):
+        """Adaptive limiters for the source host and every destination host, each host once.
+        
+        They are always taken in the same order, so two workers never hold slots the other is waiting on.
+        """
+        hosts = set()
+        for _, params in [self.source_session] + [destination.session for destination in self.destinations]:
+            hosts.add((str(params.get('host')), int(params.get('port') or 22)))
+        return [get_adaptive_limiter(host, port, self._adaptive_max_parallel()) for host, port in sorted(hosts)]
+    
+    def _adaptive_max_parallel(self):
+        ceiling = int(self.config.get('adaptive_max_parallel') or DEFAULT_ADAPTIVE_MAX_PARALLEL)
+        # Each worker holds a source and a destination channel; keep half the pool free for listing and other jobs
+        return max(1, min(ceiling, sftp_pool.max_size * sftp_pool.max_channels // 4))
+    
+    def _max_workers(self):
+        """Number of files moved at once, bounded by the per-host session caps.
+        
+        With adaptive concurrency the adaptive limiters decide how many are busy, up to their own ceiling.
+        A shared host cap set by another job also bounds it, since each worker holds a session to every host.
+        """
+        if self.adaptive_limiters:
+            workers = self._adaptive_max_parallel()
+        else:
+            parallel_files = int(self.config.get('parallel_files') or DEFAULT_PARALLEL_FILES)
+            source_limit = int(self.config.get('max_source_connections') or DEFAULT_HOST_CONNECTIONS)
+            dest_limit = int(self.config.get('max_destination_connections') or DEFAULT_HOST_CONNECTIONS)
+            workers = min(parallel_files, source_limit, dest_limit)
+        shared = [self._session_limiter(self.source_session, 'max_source_connections').limit]
+        shared += [self._session_limiter(destination.session, 'max_destination_connections',
+                                         f'destination-{index}' if index else None).limit
+                   for index, destination in enumerate(self.destinations)]
+        return max(1, min([workers] + shared))
+    
+    def _open_sessions(self, session, limit_key, role=None):
+        """Create per-worker pooled SFTP channels, capped per remote host by the given config key."""
+        key, params = session
+        sessions = ThreadSessions(lambda: sftp_pool.open_sftp_with(key, params), self._session_limiter(session, limit_key, role))
+        self._host_sessions.setdefault(adaptive_key(params.get('host'), params.get('port')), []).append(sessions)
+        return sessions
+    
+    def _session_limiter(self, session, limit_key, role=None):
+        """Shared limiter capping sessions to a session's host at the given config key, registered once per run."""
+        params = session[1]
+        role = role or ('source' if limit_key == 'max_source_connections' else 'destination')
+        key = (role, params.get('host'), int(params.get('port') or 22))
+        limiter = self._host_limiters.get(key)
+        if limiter is None:
+            limit = int(self.config.get(limit_key) or DEFAULT_HOST_CONNECTIONS)
+            if self.adaptive_limiters:
+                # The fixed caps would otherwise hold adaptive workers below their ceiling
+                limit = max(limit, self._adaptive_max_parallel())
+            limiter = self._host_limiters[key] = get_host_limiter(params.get('host'), params.get('port'), limit, role)
+        return limiter
+    
+    def _raise_for_failures(self, results, action):
+        """Raise a single error describing every file that failed."""
+        failures = [(item, error) for item, _, error in results if error is not None]
+        if not failures:
+            return
+        
+        lines = []
+        for item, error in failures:
+            name = item[0] if isinstance(item, tuple) else item
+            lines.append(f"{name}: {str(error)}")
+        raise RuntimeError(f"Failed to {action} {len(failures)} of {len(results)} files:\n" + '\n'.join(lines))
+    
+    def _record_results(self, results):
+        """Add per-file results to transferred_files in listing order and return the delivered files."""
+        for remote_file, result, error in results:
+            if error is not None:
+                continue
+            filename, dest_filename, file_size = result
+            if filename != dest_filename:
+                self.transferred_files.append(f"{filename} → {dest_filename} ({self._format_size(file_size)})")
+            else:
+                self.transferred_files.append(f"{filename} ({self._format_size(file_size)})")
+            self.delivered_files.append(remote_file)
+        
+        self._raise_for_failures(results, 'transfer')
+        return self.delivered_files
+    
+    def _then_delete_source(self, transfer):
+        """Wrap a per-file transfer so the source file is queued for deletion once it has been delivered."""
+        if self._source_remover is None:
+            return transfer
+        
+        def transfer_then_delete(remote_file):
+            result = transfer(remote_file)
+            self._source_remover.remove(remote_file.path)
+            return result
+        return transfer_then_delete
+    
+    def _adapt_concurrency(self, transfer):
+        """Wrap a per-file transfer so it holds a slot on each host's adaptive limiter and reports how it went."""
+        if not self.adaptive_limiters:
+            return transfer
+        
+        def adaptive(remote_file):
+            with ExitStack() as slots:
+                for limiter in self.adaptive_limiters:
+                    slots.enter_context(limiter)
+                try:
+                    result = transfer(remote_file)
+                except Exception as e:
+                    if is_congestion_error(e):
+                        # Only hosts whose session on this worker failed back off; a lone host is always the one
+                        blamed = [limiter for limiter in self.adaptive_limiters
+                                  if any(sessions.broken() for sessions in self._host_sessions.get(limiter.key, ()))]
+                        if not blamed and len(self.adaptive_limiters) == 1:
+                            blamed = self.adaptive_limiters
+                        for limiter in blamed:
+                            limiter.record_failure()
+                    raise
+                for limiter in self.adaptive_limiters:
+                    limiter.record_success(remote_file.size or 0)
+                return result
+        return adaptive
+    
+    def _track_progress(self, transfer):
+        """Wrap a per-file transfer so finished and failed files are counted in the published progress."""
+        def tracked(remote_file):
+            try:
+                result = transfer(remote_file)
+            except Exception:
+                self.progress.file_failed()
+                raise
+            self.progress.file_done()
+            return result
+        return tracked
+    
+    def _summarize_skips(self):
+        """One line per reason files were left alone."""
+        lines = []
+        if self.skipped_files:
+            lines.append(f"Skipped {len(self.skipped_files)} previously delivered files")
+        if self.unsettled_count:
+            lines.append(f"Left {self.unsettled_count} files that are still changing for a later run")
+        for reason, label in (('exists', 'already on the destination'), ('unchanged', 'unchanged on the destination')):
+            count = sum(1 for entry in self.plan if entry['reason'] == reason)
+            if count:
+                lines.append(f"Skipped {count} files {label}")
+        return '\n'.join(lines)
+    
+    def _format_plan(self):
+        """Render the destination comparison plan for the run details."""
+        if not self.plan:
+            return ''
+        lines = [f"{entry['action']} ({entry['reason']}): {entry['file']}" for entry in self.plan]
+        return '\n\nTransfer plan:\n' + '\n'.join(lines)
     
     def _format_size(self, size_bytes):
         """Format file size in human-readable format"""
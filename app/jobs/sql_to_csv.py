@@ -1,10 +1,16 @@
 import os
 import csv
 import pymssql
-import pysftp
 import tempfile
 import pandas as pd
 from paramiko.ssh_exception import SSHException
+from app.utils.sftp_pool import sftp_pool
+from app.utils.sftp_utils import sftp_exists, sftp_makedirs, sftp_replace, part_path
+from app.utils.checksum_utils import new_hasher, format_digest, HashingReader, RemoteHasher, verify_digest
+from app.utils.compression_utils import normalize_compression, compressed_name, new_compressor
+from app.utils.stream_utils import relay_stream
+from app.utils.progress_utils import TransferProgress, DEFAULT_PROGRESS_INTERVAL_MS
+from app.utils.bandwidth_utils import limiter_for, throttled_reader, throttled_writer
 
 class SqlToCsv:
     """Handler for SQL query to CSV file export and SFTP upload."""
@@ -15,9 +21,24 @@ class SqlToCsv:
         self.destination_credential = destination_credential
         self.config = job.get_config()
         self.csv_file = None
+        self.checksum = None
+        self.compression = None
+        self.limiter = None
+        self.progress = TransferProgress(job.id, self.config.get('progress_interval_ms') or DEFAULT_PROGRESS_INTERVAL_MS)
         
     def execute(self):
-        """Execute the SQL to CSV job."""
+        """Execute the SQL to CSV job, publishing its progress while it runs."""
+        self.progress.start('querying')
+        try:
+            result = self._execute()
+        except Exception:
+            self.progress.finish('failed')
+            raise
+        self.progress.finish()
+        return result
+    
+    def _execute(self):
+        """Run the export and upload and build the job result."""
         # Get configuration
         sql_query = self.config.get('sql_query')
         output_file = self.config.get('output_file')
@@ -28,17 +49,33 @@ class SqlToCsv:
         if not sql_query or not output_file or not dest_path:
             raise ValueError("SQL query, output file, or destination path not specified")
         
+        # Optional compression applied while the CSV is uploaded
+        self.compression = normalize_compression(self.config.get('compression'))
+        remote_file = compressed_name(output_file, self.compression)
+        
+        # Uploads draw on the destination credential's and this job's bandwidth limits
+        self.limiter = limiter_for([self.destination_credential], self.job)
+        
         # Create temporary directory for file transfer
         with tempfile.TemporaryDirectory() as temp_dir:
             # Execute SQL query and save as CSV
             local_csv_path = self._execute_sql_query(sql_query, temp_dir, output_file, csv_delimiter, include_headers)
             
             # Upload CSV to destination SFTP
-            self._upload_to_sftp(local_csv_path, dest_path, output_file)
+            self.progress.add_total(1, os.path.getsize(local_csv_path))
+            self.progress.complete_listing()
+            self.progress.set_state('uploading')
+            self._upload_to_sftp(local_csv_path, dest_path, remote_file)
+            self.progress.file_done()
+        
+        details = f'File: {remote_file}, Destination: {dest_path}'
+        if self.checksum:
+            details += f', Checksum: {self.checksum}'
         
         return {
             'message': f'Successfully exported SQL query to CSV and uploaded to SFTP',
-            'details': f'File: {output_file}, Destination: {dest_path}'
+            'details': details,
+            'checksums': {remote_file: self.checksum} if self.checksum else {}
         }
     
     def _execute_sql_query(self, sql_query, temp_dir, output_file, csv_delimiter, include_headers):
@@ -89,41 +126,56 @@ class SqlToCsv:
     
     def _upload_to_sftp(self, local_file_path, dest_path, filename):
         """Upload CSV file to destination SFTP server."""
-        dest_creds = self.destination_credential.get_credentials()
-        temp_dir = os.path.dirname(local_file_path)
-        
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None  # Disable host key checking - not recommended for production
-        
-        # Setup connection parameters
-        conn_params = {
-            'host': dest_creds.get('host'),
-            'port': dest_creds.get('port', 22),
-            'username': dest_creds.get('username'),
-            'cnopts': cnopts
-        }
-        
-        # Add either password or private key
-        if dest_creds.get('password'):
-            conn_params['password'] = dest_creds.get('password')
-        elif dest_creds.get('private_key'):
-            private_key_file = os.path.join(temp_dir, 'dest_key')
-            with open(private_key_file, 'w') as f:
-                f.write(dest_creds.get('private_key'))
-            os.chmod(private_key_file, 0o600)
-            conn_params['private_key'] = private_key_file
-            if dest_creds.get('private_key_pass'):
-                conn_params['private_key_pass'] = dest_creds.get('private_key_pass')
-        
         try:
-            with pysftp.Connection(**conn_params) as sftp:
+            # Borrow a pooled connection to the destination server
+            with sftp_pool.sftp(self.destination_credential) as sftp:
                 # Ensure destination directory exists
-                if not sftp.exists(dest_path):
-                    sftp.makedirs(dest_path)
+                if not sftp_exists(sftp, dest_path):
+                    sftp_makedirs(sftp, dest_path)
                 
-                # Upload the CSV file
                 remote_path = os.path.join(dest_path, filename).replace('\\', '/')
-                sftp.put(local_file_path, remote_path)
+                
+                # Write under a temporary name so nobody picks up a half-written file
+                upload_path = part_path(remote_path) if self.config.get('atomic_uploads', True) else remote_path
+                try:
+                    hasher = new_hasher(self.config.get('checksum_algorithm', 'sha256'))
+                    if self.compression:
+                        self._upload_compressed(sftp, local_file_path, upload_path, hasher)
+                    else:
+                        # Upload the CSV file, hashing it as it is read; putfo() confirms the remote size
+                        with open(local_file_path, 'rb') as local_file:
+                            reader = throttled_reader(HashingReader(self.progress.reader(local_file), hasher), self.limiter)
+                            sftp.putfo(reader, upload_path, file_size=os.path.getsize(local_file_path))
+                    self.checksum = format_digest(hasher)
+                    
+                    # Compare against a hash computed by the server, where it can
+                    if self.config.get('verify_remote_checksum', False) and self.checksum:
+                        remote_digest = RemoteHasher(self.config.get('checksum_algorithm', 'sha256')).digest(sftp, upload_path)
+                        verify_digest(self.checksum, remote_digest, remote_path)
+                except Exception:
+                    if upload_path != remote_path:
+                        # Nothing resumes an export, so don't leave the part file behind
+                        try:
+                            sftp.remove(upload_path)
+                        except IOError:
+                            pass
+                    raise
+                
+                if upload_path != remote_path:
+                    sftp_replace(sftp, upload_path, remote_path)
                 
         except SSHException as e:
             raise RuntimeError(f"SFTP connection error: {str(e)}")
+    
+    def _upload_compressed(self, sftp, local_file_path, remote_path, hasher):
+        """Compress the CSV on a separate thread while uploading it, hashing the compressed bytes."""
+        compressor = new_compressor(self.compression, self.config.get('compression_level'))
+        with open(local_file_path, 'rb') as local_file, sftp.open(remote_path, 'wb') as remote_file:
+            remote_file.set_pipelined(True)
+            on_chunk = hasher.update if hasher is not None else None
+            writer = throttled_writer(remote_file, self.limiter)
+            written = relay_stream(self.progress.reader(local_file), writer, on_chunk=on_chunk, transform=compressor)
+        
+        remote_size = sftp.stat(remote_path).st_size
+        if remote_size != written:
+            raise IOError(f"Size mismatch after upload: expected {written} bytes, destination has {remote_size}")
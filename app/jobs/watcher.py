@@ -0,0 +1,189 @@
+from app import scheduler, celery
+from app.models.job import Job
+from app.models.credential import Credential
+from app.models.log import Log
+from app.jobs.sftp_transfer import watch_settle_seconds
+from app.utils.concurrency_utils import ThreadSessions, get_host_limiter
+from app.utils.rule_utils import FileFilter
+from app.utils.sftp_pool import sftp_pool, credential_pool_key
+from app.utils.sftp_utils import is_part_file
+from app.utils.sftp_walk import RemoteTreeWalker
+from datetime import datetime, timedelta
+import hashlib
+import posixpath
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Default seconds between two listings of a watched source directory
+DEFAULT_WATCH_INTERVAL_SECONDS = 15
+
+# A dispatched run that has not started after this long is assumed lost, and the watcher may dispatch again
+_DISPATCH_START_TIMEOUT = timedelta(minutes=10)
+
+# Sessions a watcher may hold open to one source host while listing
+_WATCH_CONNECTIONS = 2
+
+
+def listing_fingerprint(entries):
+    """Digest of a ``{rel_path: (size, mtime)}`` listing; it changes whenever any file does."""
+    digest = hashlib.sha1()
+    for rel_path in sorted(entries):
+        size, mtime = entries[rel_path]
+        digest.update(f"{rel_path}\0{size}\0{mtime}\n".encode())
+    return digest.hexdigest()
+
+
+class WatchState:
+    """What the watcher has seen of one job's source directory across polls.
+
+    A file is ready once its size and mtime have stayed the same for the settle
+    time, so files still being written are left alone. Files already handed to a
+    run are not dispatched again unless they change. When a listing has the same
+    fingerprint as the last one and nothing is waiting to settle, the poll stops
+    there.
+    """
+
+    def __init__(self):
+        self.fingerprint = None
+        # rel_path -> ((size, mtime), when that signature was first seen)
+        self.observed = {}
+        # rel_path -> (size, mtime) as last dispatched
+        self.dispatched = {}
+        self.pending = False
+        # When the last run was dispatched (UTC), until the job shows it has started and finished
+        self.dispatched_at = None
+
+    def update(self, entries, settle_seconds, now=None):
+        """Record a listing and return the new or changed paths that have settled."""
+        now = time.monotonic() if now is None else now
+        fingerprint = listing_fingerprint(entries)
+        if fingerprint == self.fingerprint and not self.pending:
+            return []
+        self.fingerprint = fingerprint
+
+        for rel_path, signature in entries.items():
+            seen = self.observed.get(rel_path)
+            if seen is None or seen[0] != signature:
+                self.observed[rel_path] = (signature, now)
+        for rel_path in set(self.observed) - set(entries):
+            del self.observed[rel_path]
+            self.dispatched.pop(rel_path, None)
+
+        changed = [rel_path for rel_path, (signature, _) in self.observed.items()
+                   if self.dispatched.get(rel_path) != signature]
+        self.pending = bool(changed)
+        return [rel_path for rel_path in changed if now - self.observed[rel_path][1] >= settle_seconds]
+
+    def awaiting_run(self, last_run, now=None):
+        """True while the last dispatched run has not finished and may not have started yet."""
+        if self.dispatched_at is None:
+            return False
+        now = datetime.utcnow() if now is None else now
+        if (last_run is not None and last_run >= self.dispatched_at) or now - self.dispatched_at > _DISPATCH_START_TIMEOUT:
+            self.dispatched_at = None
+            return False
+        return True
+
+    def settled(self, settle_seconds, now=None):
+        """Return ``{rel_path: (size, mtime)}`` for every listed file that has stopped changing."""
+        now = time.monotonic() if now is None else now
+        return {rel_path: signature for rel_path, (signature, seen_at) in self.observed.items()
+                if now - seen_at >= settle_seconds}
+
+    def mark_dispatched(self, rel_paths):
+        self.dispatched_at = datetime.utcnow()
+        for rel_path in rel_paths:
+            self.dispatched[rel_path] = self.observed[rel_path][0]
+        self.pending = any(self.dispatched.get(rel_path) != signature
+                           for rel_path, (signature, _) in self.observed.items())
+
+
+# Watch state per job, kept for the life of the scheduler process
+_watch_states = {}
+_watch_states_lock = threading.Lock()
+
+
+def reset_watch_state(job_id):
+    """Forget what was seen for a job, e.g. after its configuration changed."""
+    with _watch_states_lock:
+        _watch_states.pop(job_id, None)
+
+
+def _get_watch_state(job_id):
+    with _watch_states_lock:
+        state = _watch_states.get(job_id)
+        if state is None:
+            state = _watch_states[job_id] = WatchState()
+        return state
+
+
+def list_watched_files(credential, config):
+    """Return ``{rel_path: (size, mtime)}`` for the source files a transfer job would pick up.
+
+    Listings go over the shared connection pool, so the SSH transport stays
+    open between polls instead of being set up for each one.
+    """
+    source_path = config.get('source_directory') or config.get('source_path')
+    file_filter = FileFilter.from_config(config)
+    recursive = bool(config.get('recursive', False))
+    max_age_days = int(config.get('max_file_age_days') or 0)
+    cutoff = time.time() - max_age_days * 86400 if max_age_days > 0 else None
+
+    key, params = credential_pool_key(credential), credential.get_credentials()
+    limiter = get_host_limiter(params.get('host'), params.get('port'), _WATCH_CONNECTIONS, 'watch')
+    entries = {}
+    try:
+        with ThreadSessions(lambda: sftp_pool.open_sftp_with(key, params), limiter) as sessions:
+            walker = RemoteTreeWalker(sessions, source_path, recursive, min(_WATCH_CONNECTIONS, limiter.limit),
+                                      match=lambda rel_dir, attr: not is_part_file(attr.filename) and file_filter.matches(attr.filename, rel_dir))
+            for rel_dir, attr in walker:
+                if cutoff is not None and attr.st_mtime < cutoff:
+                    continue
+                entries[posixpath.join(rel_dir, attr.filename)] = (attr.st_size, attr.st_mtime)
+    finally:
+        limiter.unregister()
+
+    if walker.errors:
+        # A partial listing would look like deleted files, so skip this poll
+        path, error = walker.errors[0]
+        raise IOError(f"Could not list {path}: {str(error)}")
+    return entries
+
+
+def poll_watched_job(job_id):
+    """List a watched job's source and dispatch a run once new or changed files have settled."""
+    with scheduler.app.app_context():
+        job = Job.query.get(job_id)
+        if not job or not job.is_active:
+            return
+        credential = Credential.query.get(job.source_credential_id)
+        if not credential:
+            logger.error(f"Watched job {job_id} has no source credential")
+            return
+        config = job.get_config()
+        settle_seconds = watch_settle_seconds(config)
+
+        try:
+            entries = list_watched_files(credential, config)
+        except Exception as e:
+            logger.warning(f"Watch poll failed for job {job.name} (ID: {job_id}): {str(e)}")
+            return
+
+        state = _get_watch_state(job_id)
+        ready = state.update(entries, settle_seconds)
+        if not ready:
+            return
+        if job.last_status == 'running' or state.awaiting_run(job.last_run):
+            # Leave the files pending; they are dispatched once the current or queued run ends
+            logger.info(f"Job {job.name} (ID: {job_id}) has a run in progress; holding {len(ready)} new file(s)")
+            return
+
+        # The run only takes files the watcher has seen settle, never ones still being written
+        settled = {rel_path: list(signature) for rel_path, signature in state.settled(settle_seconds).items()}
+        celery.send_task('execute_job', args=[job_id], kwargs={'settled_files': settled})
+        state.mark_dispatched(ready)
+        logger.info(f"Dispatched job {job.name} (ID: {job_id}) for {len(ready)} new or changed file(s)")
+        Log.create_log(job_id, 'info', f"Watcher found {len(ready)} new or changed file(s); run dispatched")
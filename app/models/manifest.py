@@ -0,0 +1,79 @@
+from app import db
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+class TransferManifest(db.Model):
+    """Record of a source file delivered by a transfer job."""
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id'), nullable=False, index=True)
+    remote_path = db.Column(db.String(1024), nullable=False)
+    size = db.Column(db.BigInteger)
+    mtime = db.Column(db.Integer)
+    checksum = db.Column(db.String(128))
+    # Digest of the bytes just before ``size``, used to tell an appended-to file from a replaced one
+    tail_digest = db.Column(db.String(64))
+    delivered_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('job_id', 'remote_path', name='uq_transfer_manifest_job_path'),
+    )
+    
+    def __repr__(self):
+        return f'<TransferManifest {self.job_id}:{self.remote_path}>'
+    
+    @staticmethod
+    def load_for_job(job_id):
+        """Return {remote_path: (id, size, mtime, checksum, tail_digest)} for a job in a single query."""
+        rows = db.session.query(
+            TransferManifest.id,
+            TransferManifest.remote_path,
+            TransferManifest.size,
+            TransferManifest.mtime,
+            TransferManifest.checksum,
+            TransferManifest.tail_digest
+        ).filter(TransferManifest.job_id == job_id).all()
+        return {row.remote_path: (row.id, row.size, row.mtime, row.checksum, row.tail_digest) for row in rows}
+    
+    @staticmethod
+    def record_deliveries(job_id, entries, existing=None):
+        """Insert or update manifest rows for delivered files in bulk.
+        
+        ``entries`` is a list of dicts with remote_path, size, mtime, checksum and tail_digest;
+        ``existing`` is the mapping returned by ``load_for_job``. If another run of the job
+        recorded some of the paths since ``existing`` was loaded, the rows are reloaded and
+        written again as updates.
+        """
+        if not entries:
+            return
+        existing = existing if existing is not None else TransferManifest.load_for_job(job_id)
+        try:
+            TransferManifest._write_deliveries(job_id, entries, existing)
+        except IntegrityError:
+            db.session.rollback()
+            try:
+                TransferManifest._write_deliveries(job_id, entries, TransferManifest.load_for_job(job_id))
+            except SQLAlchemyError:
+                db.session.rollback()
+                raise
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+    
+    @staticmethod
+    def _write_deliveries(job_id, entries, existing):
+        now = datetime.utcnow()
+        inserts = []
+        updates = []
+        for entry in entries:
+            row = dict(entry, job_id=job_id, delivered_at=now)
+            if entry['remote_path'] in existing:
+                row['id'] = existing[entry['remote_path']][0]
+                updates.append(row)
+            else:
+                inserts.append(row)
+        
+        if inserts:
+            db.session.bulk_insert_mappings(TransferManifest, inserts)
+        if updates:
+            db.session.bulk_update_mappings(TransferManifest, updates)
+        db.session.commit()
@@ -9,6 +9,7 @@ from loguru import logger
 # Import the utility clients, with fallbacks if dependencies are not installed
 try:
     from app.utils.sftp_utils import SftpClient
+    from app.utils.sftp_pool import credential_pool_key
 except ImportError:
     logger.warning("Could not import SftpClient - SFTP functionality will be limited")
     SftpClient = None
@@ -58,7 +59,8 @@ def create():
                 'private_key': getattr(sftp_form, 'private_key', {}).data if hasattr(sftp_form, 'private_key') else '',
                 'private_key_passphrase': getattr(sftp_form, 'private_key_passphrase', {}).data if hasattr(sftp_form, 'private_key_passphrase') else '',
                 'base_dir': getattr(sftp_form, 'base_dir', {}).data if hasattr(sftp_form, 'base_dir') else '',
-                'disable_host_key_checking': getattr(sftp_form, 'disable_host_key_checking', {}).data if hasattr(sftp_form, 'disable_host_key_checking') else False
+                'disable_host_key_checking': getattr(sftp_form, 'disable_host_key_checking', {}).data if hasattr(sftp_form, 'disable_host_key_checking') else False,
+                'bandwidth_limit_kbps': sftp_form.bandwidth_limit_kbps.data or 0
             }
             
             credential.set_credentials(sftp_config)
@@ -218,6 +220,7 @@ def edit(credential_id):
             form.username.data = config.get('username', '')
             form.base_dir.data = config.get('base_dir', '/')
             form.disable_host_key_checking.data = config.get('disable_host_key_checking', False)
+            form.bandwidth_limit_kbps.data = config.get('bandwidth_limit_kbps', 0)
             # Don't populate password or private key for security
             
         if form.validate_on_submit():
@@ -233,6 +236,7 @@ def edit(credential_id):
             config['username'] = form.username.data
             config['base_dir'] = form.base_dir.data
             config['disable_host_key_checking'] = form.disable_host_key_checking.data
+            config['bandwidth_limit_kbps'] = form.bandwidth_limit_kbps.data or 0
             
             # Only update password if provided
             if form.password.data:
@@ -403,8 +407,9 @@ def test(credential_id):
                 username=config.get('username'),
                 password=config.get('password'),
                 private_key=config.get('private_key'),
-                private_key_passphrase=config.get('private_key_passphrase'),
-                disable_host_key_checking=config.get('disable_host_key_checking', False)
+                private_key_passphrase=config.get('private_key_passphrase') or config.get('private_key_pass'),
+                disable_host_key_checking=config.get('disable_host_key_checking', False),
+                pool_key=credential_pool_key(credential)
             )
             
             success, message = client.test_connection()
@@ -4,8 +4,12 @@ from app import db, scheduler
 from app.models.job import Job
 from app.models.credential import Credential
 from app.models.log import Log
+from app.models.manifest import TransferManifest
+from app.utils.progress_utils import load_progress
+from app.utils.rule_utils import parse_rules
 from app.forms.job import JobForm, SftpTransferConfigForm, SqlToCsvConfigForm
 from app.jobs.executor import execute_job
+from app.jobs.scheduler import update_job_schedule
 from sqlalchemy import desc
 import json
 from datetime import datetime
@@ -46,15 +50,51 @@ def create():
                 'source_directory': form.source_directory.data or '',
                 'destination_directory': form.destination_directory.data or '',
                 'file_pattern': form.file_pattern.data or '*',
+                'include_patterns': [],
+                'exclude_patterns': [],
                 'file_rename_pattern': '',
+                'file_rename_match': '',
                 'recursive': False,
                 'create_directories': True,
                 'overwrite_existing': False,
+                'atomic_uploads': True,
+                'sync_mode': False,
+                'sync_delete_orphans': False,
                 'delete_after_download': False,
                 'max_file_age_days': 0,
                 'max_files_per_run': 0,
+                'file_selection_order': 'oldest',
                 'fail_on_empty': False,
-                'preserve_timestamps': True
+                'preserve_timestamps': True,
+                'skip_unchanged': True,
+                'watch_mode': False,
+                'watch_interval_seconds': 15,
+                'watch_settle_seconds': 30,
+                'transfer_mode': 'relay',
+                'server_side_copy': True,
+                'tail_mode': False,
+                'tail_delivery': 'append',
+                'bundle_format': 'none',
+                'bundle_name': '',
+                'bundle_volume_mb': 0,
+                'parallel_files': 4,
+                'max_source_connections': 4,
+                'max_destination_connections': 4,
+                'adaptive_concurrency': False,
+                'adaptive_max_parallel': 8,
+                'multistream_threshold_mb': 0,
+                'multistream_streams': 4,
+                'max_retries': 0,
+                'retry_delay_seconds': 60,
+                'checkpoint_interval_mb': 8,
+                'compression': 'none',
+                'compression_level': None,
+                'checksum_algorithm': 'sha256',
+                'verify_remote_checksum': False,
+                'bandwidth_limit_kbps': 0,
+                'extra_destinations': [],
+                'staging_memory_threshold_mb': None,
+                'staging_dir': ''
             }
         elif form.job_type.data == 'sql_to_csv':
             config = {
@@ -106,35 +146,124 @@ def configure(job_id):
             form.source_directory.data = config.get('source_directory', '')
             form.destination_directory.data = config.get('destination_directory', '')
             form.file_pattern.data = config.get('file_pattern', '*')
+            form.include_patterns.data = '\n'.join(parse_rules(config.get('include_patterns')))
+            form.exclude_patterns.data = '\n'.join(parse_rules(config.get('exclude_patterns')))
             form.file_rename_pattern.data = config.get('file_rename_pattern', '')
+            form.file_rename_match.data = config.get('file_rename_match', '')
             form.recursive.data = config.get('recursive', False)
             form.create_directories.data = config.get('create_directories', True)
             form.overwrite_existing.data = config.get('overwrite_existing', False)
+            form.atomic_uploads.data = config.get('atomic_uploads', True)
+            form.sync_mode.data = config.get('sync_mode', False)
+            form.sync_delete_orphans.data = config.get('sync_delete_orphans', False)
+            # Show the saved extra destinations followed by blank rows to add more
+            while form.extra_destinations.entries:
+                form.extra_destinations.pop_entry()
+            for destination in config.get('extra_destinations') or []:
+                form.extra_destinations.append_entry(destination)
+            while len(form.extra_destinations.entries) < form.extra_destinations.min_entries:
+                form.extra_destinations.append_entry()
             form.delete_after_download.data = config.get('delete_after_download', False)
             form.max_file_age_days.data = config.get('max_file_age_days', 0)
             form.max_files_per_run.data = config.get('max_files_per_run', 0)
+            form.file_selection_order.data = config.get('file_selection_order', 'oldest')
             form.fail_on_empty.data = config.get('fail_on_empty', False)
             form.preserve_timestamps.data = config.get('preserve_timestamps', True)
+            form.skip_unchanged.data = config.get('skip_unchanged', True)
+            form.watch_mode.data = config.get('watch_mode', False)
+            form.watch_interval_seconds.data = config.get('watch_interval_seconds', 15)
+            form.watch_settle_seconds.data = config.get('watch_settle_seconds', 30)
+            form.transfer_mode.data = config.get('transfer_mode', 'relay')
+            form.server_side_copy.data = config.get('server_side_copy', True)
+            form.tail_mode.data = config.get('tail_mode', False)
+            form.tail_delivery.data = config.get('tail_delivery', 'append')
+            form.bundle_format.data = config.get('bundle_format', 'none')
+            form.bundle_name.data = config.get('bundle_name', '')
+            form.bundle_volume_mb.data = config.get('bundle_volume_mb', 0)
+            form.parallel_files.data = config.get('parallel_files', 4)
+            form.max_source_connections.data = config.get('max_source_connections', 4)
+            form.max_destination_connections.data = config.get('max_destination_connections', 4)
+            form.adaptive_concurrency.data = config.get('adaptive_concurrency', False)
+            form.adaptive_max_parallel.data = config.get('adaptive_max_parallel', 8)
+            form.multistream_threshold_mb.data = config.get('multistream_threshold_mb', 0)
+            form.multistream_streams.data = config.get('multistream_streams', 4)
+            form.staging_memory_threshold_mb.data = config.get('staging_memory_threshold_mb')
+            form.staging_dir.data = config.get('staging_dir', '')
+            form.max_retries.data = config.get('max_retries', 0)
+            form.retry_delay_seconds.data = config.get('retry_delay_seconds', 60)
+            form.checkpoint_interval_mb.data = config.get('checkpoint_interval_mb', 8)
+            form.compression.data = config.get('compression', 'none')
+            form.compression_level.data = config.get('compression_level')
+            form.checksum_algorithm.data = config.get('checksum_algorithm', 'sha256')
+            form.verify_remote_checksum.data = config.get('verify_remote_checksum', False)
+            form.bandwidth_limit_kbps.data = config.get('bandwidth_limit_kbps', 0)
+        
+        for destination in form.extra_destinations:
+            destination.credential_id.choices = [(0, '-- None --')] + credential_choices
         
         if form.validate_on_submit():
-            config = {
+            # Keep settings that are not on the form (e.g. task history, tuning options)
+            config = job.get_config()
+            config.update({
                 'source_credential_id': form.source_credential_id.data,
                 'destination_credential_id': form.destination_credential_id.data,
                 'source_directory': form.source_directory.data,
                 'destination_directory': form.destination_directory.data,
                 'file_pattern': form.file_pattern.data,
+                'include_patterns': parse_rules(form.include_patterns.data),
+                'exclude_patterns': parse_rules(form.exclude_patterns.data),
                 'file_rename_pattern': form.file_rename_pattern.data,
+                'file_rename_match': form.file_rename_match.data,
                 'recursive': form.recursive.data,
                 'create_directories': form.create_directories.data,
                 'overwrite_existing': form.overwrite_existing.data,
+                'atomic_uploads': form.atomic_uploads.data,
+                'sync_mode': form.sync_mode.data,
+                'sync_delete_orphans': form.sync_delete_orphans.data,
+                'extra_destinations': [
+                    {'credential_id': destination.credential_id.data, 'path': destination.path.data}
+                    for destination in form.extra_destinations
+                    if destination.credential_id.data and destination.path.data
+                ],
                 'delete_after_download': form.delete_after_download.data,
                 'max_file_age_days': form.max_file_age_days.data,
                 'max_files_per_run': form.max_files_per_run.data,
+                'file_selection_order': form.file_selection_order.data,
                 'fail_on_empty': form.fail_on_empty.data,
-                'preserve_timestamps': form.preserve_timestamps.data
-            }
+                'preserve_timestamps': form.preserve_timestamps.data,
+                'skip_unchanged': form.skip_unchanged.data,
+                'watch_mode': form.watch_mode.data,
+                'watch_interval_seconds': form.watch_interval_seconds.data or 15,
+                'watch_settle_seconds': form.watch_settle_seconds.data if form.watch_settle_seconds.data is not None else 30,
+                'transfer_mode': form.transfer_mode.data,
+                'server_side_copy': form.server_side_copy.data,
+                'tail_mode': form.tail_mode.data,
+                'tail_delivery': form.tail_delivery.data,
+                'bundle_format': form.bundle_format.data,
+                'bundle_name': form.bundle_name.data,
+                'bundle_volume_mb': form.bundle_volume_mb.data or 0,
+                'parallel_files': form.parallel_files.data,
+                'max_source_connections': form.max_source_connections.data,
+                'max_destination_connections': form.max_destination_connections.data,
+                'adaptive_concurrency': form.adaptive_concurrency.data,
+                'adaptive_max_parallel': form.adaptive_max_parallel.data or 8,
+                'multistream_threshold_mb': form.multistream_threshold_mb.data,
+                'multistream_streams': form.multistream_streams.data,
+                'staging_memory_threshold_mb': form.staging_memory_threshold_mb.data,
+                'staging_dir': form.staging_dir.data,
+                'max_retries': form.max_retries.data,
+                'retry_delay_seconds': form.retry_delay_seconds.data or 60,
+                'checkpoint_interval_mb': form.checkpoint_interval_mb.data or 8,
+                'compression': form.compression.data,
+                'compression_level': form.compression_level.data,
+                'checksum_algorithm': form.checksum_algorithm.data,
+                'verify_remote_checksum': form.verify_remote_checksum.data,
+                'bandwidth_limit_kbps': form.bandwidth_limit_kbps.data or 0
+            })
             job.set_config(config)
             db.session.commit()
+            # Switch between the cron schedule and watching the source
+            update_job_schedule(job.id)
             flash('Job configuration updated successfully!', 'success')
             return redirect(url_for('jobs.index'))
         
@@ -176,6 +305,12 @@ def configure(job_id):
             form.destination_path.data = config.get('destination_path', '')
             form.csv_delimiter.data = config.get('csv_delimiter', ',')
             form.include_headers.data = config.get('include_headers', True)
+            form.atomic_uploads.data = config.get('atomic_uploads', True)
+            form.compression.data = config.get('compression', 'none')
+            form.compression_level.data = config.get('compression_level')
+            form.checksum_algorithm.data = config.get('checksum_algorithm', 'sha256')
+            form.verify_remote_checksum.data = config.get('verify_remote_checksum', False)
+            form.bandwidth_limit_kbps.data = config.get('bandwidth_limit_kbps', 0)
         
         if form.validate_on_submit():
             config = {
@@ -185,7 +320,13 @@ def configure(job_id):
                 'output_file': form.output_file.data,
                 'destination_path': form.destination_path.data,
                 'csv_delimiter': form.csv_delimiter.data,
-                'include_headers': form.include_headers.data
+                'include_headers': form.include_headers.data,
+                'atomic_uploads': form.atomic_uploads.data,
+                'compression': form.compression.data,
+                'compression_level': form.compression_level.data,
+                'checksum_algorithm': form.checksum_algorithm.data,
+                'verify_remote_checksum': form.verify_remote_checksum.data,
+                'bandwidth_limit_kbps': form.bandwidth_limit_kbps.data or 0
             }
             job.set_config(config)
             db.session.commit()
@@ -259,8 +400,9 @@ def delete(job_id):
         flash('You do not have permission to access this job', 'danger')
         return redirect(url_for('jobs.index'))
     
-    # Delete associated logs
+    # Delete associated logs and delivery records
     Log.query.filter_by(job_id=job.id).delete()
+    TransferManifest.query.filter_by(job_id=job.id).delete()
     
     # Delete job
     db.session.delete(job)
@@ -366,7 +508,7 @@ def job_status(job_id):
     """API endpoint to get the current status of a job for dynamic updates"""
     job = Job.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
     
-    # Return job status as JSON
+    # Return job status as JSON, with the progress published by the running (or last) transfer
     return jsonify({
         'status': job.last_status or 'unknown',
         'last_run': job.last_run.strftime('%Y-%m-%d %H:%M:%S') if job.last_run else None,
@@ -376,7 +518,8 @@ def job_status(job_id):
             'failure': 'bg-danger',
             'running': 'bg-warning',
             'unknown': 'bg-secondary'
-        }.get(job.last_status, 'bg-secondary')
+        }.get(job.last_status, 'bg-secondary'),
+        'progress': load_progress([job.id]).get(job.id)
     })
 
 @jobs_bp.route('/api/statuses')
@@ -384,6 +527,7 @@ def job_status(job_id):
 def job_statuses():
     """API endpoint to get the current status of all jobs for dynamic updates"""
     jobs = Job.query.filter_by(user_id=current_user.id).all()
+    progress = load_progress(job.id for job in jobs)
     
     # Return all job statuses as JSON
     result = {}
@@ -397,7 +541,8 @@ def job_statuses():
                 'failure': 'bg-danger',
                 'running': 'bg-warning',
                 'unknown': 'bg-secondary'
-            }.get(job.last_status, 'bg-secondary')
+            }.get(job.last_status, 'bg-secondary'),
+            'progress': progress.get(job.id)
         }
     
     return jsonify(result)
@@ -42,12 +42,14 @@ except Exception as e:
     print(traceback.format_exc())
 
 @celery_app.task(bind=True, name='execute_job')
-def execute_job(self, job_id):
+def execute_job(self, job_id, settled_files=None):
     """
     Execute a job by ID. This task runs in a separate process from the main application.
     
     Args:
         job_id (int): The ID of the job to execute
+        settled_files (dict): For runs dispatched by the watcher, {rel_path: [size, mtime]} of the
+            source files it saw settle; only those are transferred
         
     Returns:
         dict: A dictionary containing the job execution results
@@ -145,7 +147,7 @@ def execute_job(self, job_id):
                 job_logger.debug(f"Source path: {job.get_config().get('source_directory', '/')}")
                 job_logger.debug(f"Destination path: {job.get_config().get('destination_directory', '/')}")
                 job_logger.debug(f"File pattern: {job.get_config().get('file_pattern', '*')}")
-                executor = SftpTransfer(job, source_cred, dest_cred)
+                executor = SftpTransfer(job, source_cred, dest_cred, settled_files)
                 execution_result = executor.execute()
                 job_logger.info(f"SFTP transfer complete: {execution_result['message']}")
             elif job.job_type == 'sql_to_csv':
@@ -188,6 +190,8 @@ def execute_job(self, job_id):
                 # Add execution details to result
                 result['message'] = message
                 result['details'] = details
+                if execution_result.get('plan'):
+                    result['plan'] = execution_result['plan']
             else:
                 Log.create_log(job.id, 'success', 'Job completed successfully')
                 job_logger.info("Job completed successfully")
@@ -202,6 +206,18 @@ def execute_job(self, job_id):
             job_logger.error(f"Job execution failed: {error_message}")
             job_logger.error(error_details)
             
+            # Retry if configured; the next attempt resumes from saved transfer checkpoints
+            if 'job' in locals() and job is not None:
+                max_retries = int(job.get_config().get('max_retries') or 0)
+                if self.request.retries < max_retries:
+                    retry_delay = int(job.get_config().get('retry_delay_seconds') or 60)
+                    job_logger.info(f"Retrying job in {retry_delay}s (attempt {self.request.retries + 1} of {max_retries})")
+                    try:
+                        Log.create_log(job_id, 'warning', f"Job failed, retrying in {retry_delay}s (attempt {self.request.retries + 1} of {max_retries}): {error_message}")
+                    except Exception as log_error:
+                        job_logger.error(f"Failed to log to database: {str(log_error)}")
+                    raise self.retry(exc=e, countdown=retry_delay, max_retries=max_retries)
+            
             try:
                 # Log to database if possible
                 Log.create_log(job_id, 'failure', f"Job failed: {error_message}", error_details)
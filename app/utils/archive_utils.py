@@ -0,0 +1,118 @@
+import tarfile
+import time
+import zipfile
+from app.utils.compression_utils import new_compressor
+
+# File extension of each archive format
+ARCHIVE_EXTENSIONS = {
+    'tar.gz': '.tar.gz',
+    'zip': '.zip',
+}
+
+# Bytes copied into an archive member at a time
+_COPY_CHUNK_SIZE = 256 * 1024
+
+# Zip cannot store modification times before 1980
+_ZIP_EPOCH = time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1))
+
+
+def normalize_archive_format(archive_format):
+    """Return 'tar.gz', 'zip' or None for a configured archive format."""
+    archive_format = (archive_format or 'none').lower()
+    if archive_format in ('none', ''):
+        return None
+    if archive_format not in ARCHIVE_EXTENSIONS:
+        raise ValueError(f"Unsupported archive format: {archive_format}")
+    return archive_format
+
+
+class _CountingWriter:
+    """Passes writes through to a file object, counting the bytes and handing each chunk to ``on_chunk``."""
+
+    def __init__(self, fileobj, on_chunk=None):
+        self.fileobj = fileobj
+        self.on_chunk = on_chunk
+        self.written = 0
+
+    def write(self, data):
+        if data:
+            self.fileobj.write(data)
+            self.written += len(data)
+            if self.on_chunk is not None:
+                self.on_chunk(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class _GzipWriter:
+    """Gzip-compresses everything written to it into another writer."""
+
+    def __init__(self, writer, level=None):
+        self.writer = writer
+        self.compressor = new_compressor('gzip', level)
+
+    def write(self, data):
+        self.writer.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        self.writer.write(self.compressor.flush())
+
+
+class ArchiveStream:
+    """Writes files into a tar.gz or zip archive on a write-only stream, one member at a time.
+
+    The archive is never seeked, so it can be written straight into a remote
+    file handle. ``size`` is the number of archive bytes written so far; with
+    tar.gz it trails the data added by whatever the compressor still buffers.
+    """
+
+    def __init__(self, fileobj, archive_format, level=None, on_chunk=None):
+        self.archive_format = archive_format
+        self._out = _CountingWriter(fileobj, on_chunk)
+        if archive_format == 'tar.gz':
+            self._gzip = _GzipWriter(self._out, level)
+            self._archive = tarfile.open(fileobj=self._gzip, mode='w|', format=tarfile.PAX_FORMAT)
+        else:
+            self._gzip = None
+            level = min(max(int(level or 6), 1), 9)
+            self._archive = zipfile.ZipFile(self._out, 'w', zipfile.ZIP_DEFLATED, compresslevel=level)
+
+    @property
+    def size(self):
+        return self._out.written
+
+    def add(self, name, size, mtime, fileobj):
+        """Add ``size`` bytes read from ``fileobj`` as the member ``name``."""
+        mtime = time.time() if mtime is None else mtime
+        if self._gzip is not None:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(mtime)
+            info.mode = 0o644
+            # Raises if the file object runs out before size bytes
+            self._archive.addfile(info, fileobj)
+            return
+
+        info = zipfile.ZipInfo(name, date_time=time.localtime(max(mtime, _ZIP_EPOCH))[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.file_size = size
+        copied = 0
+        with self._archive.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+            while copied < size:
+                chunk = fileobj.read(min(_COPY_CHUNK_SIZE, size - copied))
+                if not chunk:
+                    break
+                member.write(chunk)
+                copied += len(chunk)
+        if copied != size:
+            raise IOError(f"Unexpected end of data in {name}: expected {size} bytes, got {copied}")
+
+    def close(self):
+        """Finish the archive and return its size in bytes."""
+        self._archive.close()
+        if self._gzip is not None:
+            self._gzip.close()
+        return self.size
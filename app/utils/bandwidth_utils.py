@@ -0,0 +1,184 @@
+import threading
+import time
+import redis
+from loguru import logger
+from app.utils.redis_utils import get_redis
+
+# Bytes taken from a bucket per round trip; smaller leases track the limit
+# more closely, larger ones cost fewer Redis calls
+DEFAULT_LEASE_BYTES = 256 * 1024
+
+# Reserves tokens from a bucket and returns how long the caller must wait, in ms.
+# The bucket may go into debt so one large request is paced rather than refused;
+# it holds at most one second of tokens so idle time cannot be saved up.
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local requested = tonumber(ARGV[2])
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil or ts == nil then
+    tokens = rate
+    ts = now
+end
+
+tokens = math.min(rate, tokens + (now - ts) * rate / 1000)
+tokens = tokens - requested
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], 60000)
+
+if tokens >= 0 then
+    return 0
+end
+return math.ceil(-tokens * 1000 / rate)
+"""
+
+
+def credential_bucket(credential_id):
+    return f"transferwizard:bandwidth:credential:{credential_id}"
+
+
+def job_bucket(job_id):
+    return f"transferwizard:bandwidth:job:{job_id}"
+
+
+def kbps_to_bytes(value):
+    """Convert a configured KB/s limit to bytes/sec; 0 or empty means unlimited."""
+    try:
+        value = int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+    return max(0, value) * 1024
+
+
+class _LocalBucket:
+    """In-process token bucket used when Redis is not reachable."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.ts = time.monotonic()
+
+    def reserve(self, requested):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        self.tokens -= requested
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+# Fallback buckets are shared by all jobs in this worker process
+_local_buckets = {}
+_local_buckets_lock = threading.Lock()
+
+
+class BandwidthLimiter:
+    """Paces traffic against one or more shared token buckets.
+
+    ``buckets`` is a list of ``(key, bytes_per_sec)``; buckets with no rate are
+    ignored. The buckets live in Redis so every Celery worker draining the same
+    credential or job shares one limit. Bytes are taken in leases of
+    ``lease_bytes`` so a stream of small chunks costs one Redis call per lease
+    rather than per chunk. Without Redis each process enforces the limits on
+    its own.
+    """
+
+    def __init__(self, buckets, lease_bytes=DEFAULT_LEASE_BYTES):
+        self.buckets = [(key, int(rate)) for key, rate in buckets if rate and int(rate) > 0]
+        self._lock = threading.Lock()
+        self._redis = get_redis() if self.buckets else None
+        self._script = self._redis.register_script(_TOKEN_BUCKET_SCRIPT) if self._redis else None
+        # Keep leases well under a second of the slowest bucket so pacing stays smooth
+        slowest = min((rate for _, rate in self.buckets), default=0)
+        self.lease_bytes = max(1, min(lease_bytes, slowest // 4 or lease_bytes))
+        self._leased = 0
+
+    @property
+    def enabled(self):
+        return bool(self.buckets)
+
+    def consume(self, nbytes):
+        """Account for ``nbytes`` of traffic, sleeping as needed to stay under every limit."""
+        if not self.buckets or nbytes <= 0:
+            return
+        with self._lock:
+            if nbytes <= self._leased:
+                self._leased -= nbytes
+                return
+            needed = nbytes - self._leased
+            lease = max(needed, self.lease_bytes)
+            self._leased = lease - needed
+            wait = max(self._reserve(key, rate, lease) for key, rate in self.buckets)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _reserve(self, key, rate, nbytes):
+        if self._script is not None:
+            try:
+                return int(self._script(keys=[key], args=[rate, nbytes])) / 1000.0
+            except redis.RedisError as e:
+                logger.warning(f"Bandwidth bucket {key} unavailable, limiting locally: {str(e)}")
+                self._script = None
+        with _local_buckets_lock:
+            bucket = _local_buckets.get(key)
+            if bucket is None or bucket.rate != rate:
+                bucket = _local_buckets[key] = _LocalBucket(rate)
+            return bucket.reserve(nbytes)
+
+
+def limiter_for(credentials=(), job=None):
+    """Build a limiter drawing on each credential's bucket and, if given, the job's bucket.
+
+    Limits are read from ``bandwidth_limit_kbps`` in the credential settings and
+    the job configuration.
+    """
+    buckets = [
+        (credential_bucket(credential.id), kbps_to_bytes(credential.get_credentials().get('bandwidth_limit_kbps')))
+        for credential in credentials
+    ]
+    if job is not None:
+        buckets.append((job_bucket(job.id), kbps_to_bytes(job.get_config().get('bandwidth_limit_kbps'))))
+    return BandwidthLimiter(buckets)
+
+
+class ThrottledReader:
+    """Wraps a readable file object and paces reads through a ``BandwidthLimiter``."""
+
+    def __init__(self, fileobj, limiter):
+        self.fileobj = fileobj
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.limiter.consume(len(data))
+        return data
+
+
+class ThrottledWriter:
+    """Wraps a writable file object and paces writes through a ``BandwidthLimiter``."""
+
+    def __init__(self, fileobj, limiter):
+        self.fileobj = fileobj
+        self.limiter = limiter
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        return self.fileobj.write(data)
+
+
+def throttled_reader(fileobj, limiter):
+    """Return ``fileobj`` wrapped for pacing, or unchanged if ``limiter`` has no limits."""
+    if limiter is None or not limiter.enabled:
+        return fileobj
+    return ThrottledReader(fileobj, limiter)
+
+
+def throttled_writer(fileobj, limiter):
+    """Return ``fileobj`` wrapped for pacing, or unchanged if ``limiter`` has no limits."""
+    if limiter is None or not limiter.enabled:
+        return fileobj
+    return ThrottledWriter(fileobj, limiter)
@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+from loguru import logger
+import redis
+from app.utils.redis_utils import get_redis
+
+# Checkpoints for abandoned batches expire after a week
+CHECKPOINT_TTL = 7 * 24 * 3600
+
+
+class TransferCheckpoints:
+    """Per-file progress checkpoints for one job, stored in a Redis hash.
+
+    Each source path maps to the identity of the file being copied (size,
+    mtime and destination path) plus the last byte offset written and
+    whether the file completed. A retried run uses them to resume partial
+    files and skip completed ones. If Redis is unavailable, checkpointing
+    is silently disabled.
+    """
+
+    def __init__(self, job_id, interval_bytes=8 * 1024 * 1024):
+        self.key = f"transferwizard:checkpoints:{job_id}"
+        self.interval_bytes = interval_bytes
+        self.redis = get_redis()
+        self._states = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.redis is not None
+
+    def load(self):
+        """Fetch every checkpoint for the job in one round trip."""
+        if not self.enabled:
+            return
+        try:
+            raw = self.redis.hgetall(self.key)
+        except redis.RedisError as e:
+            logger.warning(f"Could not load transfer checkpoints: {str(e)}")
+            return
+        self._states = {k.decode('utf-8'): json.loads(v) for k, v in raw.items()}
+
+    def get(self, remote_file, dest_path):
+        """Return the saved state for a file if it still refers to the same source and destination."""
+        state = self._states.get(remote_file.path)
+        if not state:
+            return None
+        if (state.get('size'), state.get('mtime'), state.get('dest')) != (remote_file.size, remote_file.mtime, dest_path):
+            return None
+        return state
+
+    def tracker(self, remote_file, dest_path, start_offset=0):
+        """Return an ``on_chunk`` callback that checkpoints progress every ``interval_bytes``."""
+        progress = {'offset': start_offset, 'saved': start_offset}
+
+        def on_chunk(chunk):
+            progress['offset'] += len(chunk)
+            if progress['offset'] - progress['saved'] >= self.interval_bytes:
+                # The previous checkpoint's bytes have been acknowledged by now
+                self._save(remote_file, dest_path, progress['saved'], False)
+                progress['saved'] = progress['offset']
+
+        return on_chunk
+
+    def mark_done(self, remote_file, dest_path, checksum=None):
+        self._save(remote_file, dest_path, remote_file.size, True, checksum)
+
+    def clear(self):
+        """Forget all checkpoints once the whole batch has completed."""
+        if not self.enabled:
+            return
+        try:
+            self.redis.delete(self.key)
+        except redis.RedisError as e:
+            logger.warning(f"Could not clear transfer checkpoints: {str(e)}")
+
+    def _save(self, remote_file, dest_path, offset, done, checksum=None):
+        if not self.enabled:
+            return
+        state = {
+            'size': remote_file.size,
+            'mtime': remote_file.mtime,
+            'dest': dest_path,
+            'offset': offset,
+            'done': done,
+            'checksum': checksum,
+            'updated': int(time.time())
+        }
+        try:
+            with self._lock:
+                pipe = self.redis.pipeline()
+                pipe.hset(self.key, remote_file.path, json.dumps(state))
+                pipe.expire(self.key, CHECKPOINT_TTL)
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Could not save transfer checkpoint for {remote_file.path}: {str(e)}")
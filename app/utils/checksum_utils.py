@@ -0,0 +1,132 @@
+import hashlib
+import shlex
+import threading
+from loguru import logger
+
+try:
+    import xxhash
+except ImportError:  # optional, only needed for the xxhash algorithms
+    xxhash = None
+
+# Algorithms that can be computed while data streams through
+_XXHASH_ALGORITHMS = ('xxh64', 'xxh3_64', 'xxh3_128')
+
+# Remote commands used to hash a file on the server, by algorithm
+_REMOTE_HASH_COMMANDS = {
+    'sha256': 'sha256sum',
+}
+
+
+def new_hasher(algorithm='sha256'):
+    """Return a hash object for ``algorithm``, or None if checksums are disabled."""
+    algorithm = (algorithm or 'sha256').lower()
+    if algorithm == 'none':
+        return None
+    if algorithm in _XXHASH_ALGORITHMS:
+        if xxhash is None:
+            logger.warning(f"xxhash is not installed; using sha256 instead of {algorithm}")
+            return hashlib.sha256()
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def format_digest(hasher):
+    """Digest in the ``algorithm:hex`` form stored in results and the manifest."""
+    if hasher is None:
+        return None
+    return f"{hasher.name.lower()}:{hasher.hexdigest()}"
+
+
+class HashingReader:
+    """Wraps a readable file object and hashes everything read through it."""
+
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data and self.hasher is not None:
+            self.hasher.update(data)
+        return data
+
+
+class HashingWriter:
+    """Wraps a writable file object and hashes everything written through it."""
+
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+
+    def write(self, data):
+        if self.hasher is not None:
+            self.hasher.update(data)
+        return self.fileobj.write(data)
+
+
+class RemoteHasher:
+    """Hashes files on an SFTP server without transferring them.
+
+    Tries the ``check-file`` SFTP extension first and falls back to running
+    ``sha256sum`` over an exec channel. Whatever a server turns out not to
+    support is remembered for the rest of the run, so unsupported servers cost
+    one failed attempt rather than one per file.
+    """
+
+    def __init__(self, algorithm='sha256'):
+        self.algorithm = (algorithm or 'sha256').lower()
+        self._unsupported = set()
+        self._lock = threading.Lock()
+
+    def digest(self, sftp, path):
+        """Return ``algorithm:hex`` for a remote file, or None if the server cannot hash it."""
+        host = self._host_key(sftp)
+        for method in (self._check_file, self._exec_hash):
+            with self._lock:
+                if (host, method.__name__) in self._unsupported:
+                    continue
+            try:
+                hex_digest = method(sftp, path)
+            except Exception as e:
+                logger.debug(f"Remote {self.algorithm} via {method.__name__} unavailable on {host}: {str(e)}")
+                hex_digest = None
+            if hex_digest:
+                return f"{self.algorithm}:{hex_digest}"
+            with self._lock:
+                self._unsupported.add((host, method.__name__))
+        return None
+
+    def _check_file(self, sftp, path):
+        with sftp.open(path, 'rb') as remote_file:
+            # A block size of 0 asks for a single hash over the whole file
+            return remote_file.check(self.algorithm, 0, 0, 0).hex()
+
+    def _exec_hash(self, sftp, path):
+        command = _REMOTE_HASH_COMMANDS.get(self.algorithm)
+        if not command:
+            return None
+        channel = sftp.get_channel().get_transport().open_session()
+        try:
+            channel.settimeout(300)
+            channel.exec_command(f"{command} -- {shlex.quote(path)}")
+            output = channel.makefile('rb').read().decode('utf-8', 'replace')
+            if channel.recv_exit_status() != 0:
+                return None
+        finally:
+            channel.close()
+        hex_digest = output.split()[0] if output.split() else ''
+        return hex_digest.lstrip('\\').lower() or None
+
+    def _host_key(self, sftp):
+        try:
+            return sftp.get_channel().get_transport().getpeername()
+        except Exception:
+            return None
+
+
+def verify_digest(expected, actual, path):
+    """Raise if a remote digest of the same algorithm was obtained and does not match the expected one."""
+    if not expected or not actual or expected.split(':', 1)[0] != actual.split(':', 1)[0]:
+        return
+    if expected != actual:
+        raise IOError(f"Checksum mismatch for {path}: expected {expected}, found {actual}")
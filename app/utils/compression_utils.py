@@ -0,0 +1,55 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for zstd compression
+    zstandard = None
+
+# File extension added to the destination name, by compression format
+COMPRESSION_EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Level used when the job does not set one, by compression format
+DEFAULT_COMPRESSION_LEVELS = {
+    'gzip': 6,
+    'zstd': 3,
+}
+
+# Valid level range, by compression format
+_COMPRESSION_LEVEL_RANGES = {
+    'gzip': (1, 9),
+    'zstd': (1, 22),
+}
+
+
+def normalize_compression(compression):
+    """Return 'gzip', 'zstd' or None for a configured compression value."""
+    compression = (compression or 'none').lower()
+    if compression in ('none', ''):
+        return None
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError(f"Unsupported compression format: {compression}")
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+    return compression
+
+
+def compressed_name(filename, compression):
+    """Destination filename for a file compressed with ``compression``."""
+    if not compression:
+        return filename
+    return filename + COMPRESSION_EXTENSIONS[compression]
+
+
+def new_compressor(compression, level=None):
+    """Return a streaming compressor with ``compress(data)`` and ``flush()``, or None if ``compression`` is off."""
+    if not compression:
+        return None
+    low, high = _COMPRESSION_LEVEL_RANGES[compression]
+    level = min(max(int(level or DEFAULT_COMPRESSION_LEVELS[compression]), low), high)
+    if compression == 'gzip':
+        # wbits 16 + MAX_WBITS writes a gzip header and trailer
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zstandard.ZstdCompressor(level=level).compressobj()
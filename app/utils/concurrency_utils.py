@@ -0,0 +1,408 @@
+import errno
+import socket
+import threading
+import time
+import redis
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from loguru import logger
+from paramiko.ssh_exception import SSHException
+from app.utils.redis_utils import get_redis
+
+# Concurrency an adaptive limiter starts from when nothing has been learned for the host yet
+DEFAULT_ADAPTIVE_START = 2
+
+# An added stream is kept only if it raises throughput by at least this fraction
+_ADAPTIVE_MIN_GAIN = 0.05
+
+# Failures this soon after a decrease count as the same congestion event
+_ADAPTIVE_BACKOFF_SECONDS = 5
+
+# Learned limits are forgotten if they have not changed for this long
+_ADAPTIVE_TTL = 30 * 86400
+
+# Errors that point at an overloaded host rather than a problem with one file
+_CONGESTION_ERRNOS = {errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE, errno.ETIMEDOUT}
+_CONGESTION_MESSAGES = ('connection reset by peer', 'server connection dropped', 'socket is closed', 'timed out')
+
+
+class HostLimiter:
+    """Caps the number of concurrent sessions opened against one remote host.
+
+    Jobs sharing the limiter ``register`` the cap they want. The first cap
+    registered while nobody uses the limiter is kept until every user has
+    unregistered, so a running job never sees its cap lowered under it; later
+    users get the cap in force and size their workers by it.
+    """
+
+    def __init__(self, limit):
+        self._cond = threading.Condition()
+        self.limit = max(1, int(limit))
+        self.active = 0
+        self.users = 0
+
+    def register(self, limit):
+        """Join the limiter asking for ``limit``; returns the cap in force."""
+        with self._cond:
+            if not self.users:
+                self.limit = max(1, int(limit))
+                self._cond.notify_all()
+            self.users += 1
+            return self.limit
+
+    def unregister(self):
+        with self._cond:
+            self.users = max(0, self.users - 1)
+
+    def acquire(self):
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def try_acquire(self):
+        """Take a slot if one is free right now; returns False instead of waiting."""
+        with self._cond:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active = max(0, self.active - 1)
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+# Process-wide registry so concurrent jobs in one worker share the same caps
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+
+def get_host_limiter(host, port, limit, role='default'):
+    """Return the shared limiter for host:port, registered as a user asking for ``limit``.
+
+    The caller must ``unregister()`` when done, and should run no more workers
+    than ``limiter.limit``, which may be another job's cap. Limiters are kept
+    separately per ``role`` (e.g. source/destination) so a worker holding a
+    source slot never waits on its own destination slots when both sides are
+    the same host.
+    """
+    key = (role, host, int(port or 22))
+    with _host_limiters_lock:
+        limiter = _host_limiters.get(key)
+        if limiter is None:
+            limiter = HostLimiter(limit)
+            _host_limiters[key] = limiter
+        limiter.register(limit)
+        return limiter
+
+
+def adaptive_key(host, port):
+    return f"transferwizard:concurrency:{host}:{int(port or 22)}"
+
+
+def is_congestion_error(error):
+    """Return True for errors that suggest the remote host is overloaded, such as reset connections."""
+    if isinstance(error, (SSHException, EOFError, socket.timeout)):
+        return True
+    if isinstance(error, OSError) and error.errno in _CONGESTION_ERRNOS:
+        return True
+    message = str(error).lower()
+    return any(text in message for text in _CONGESTION_MESSAGES)
+
+
+class AdaptiveLimiter(HostLimiter):
+    """A ``HostLimiter`` whose cap is tuned at runtime by additive increase, multiplicative decrease.
+
+    Each slot is held for one file. Once a full round of files (one per slot)
+    has finished, the aggregate throughput of that round is compared with the
+    previous one: the cap grows by one, unless the last extra slot did not pay
+    off, in which case it is taken back. A congestion error halves the cap.
+    The cap stays between 1 and the highest maximum of the jobs using the
+    limiter, and is saved to Redis whenever it changes, so later runs on any
+    worker start from the learned value.
+    """
+
+    def __init__(self, host, port, limit, maximum):
+        self.maximum = max(1, int(maximum))
+        self._maxima = []
+        super().__init__(min(int(limit), self.maximum))
+        self.name = f"{host}:{int(port or 22)}"
+        self.key = adaptive_key(host, port)
+        self._last_rate = None
+        self._last_change = 0
+        self._last_decrease = 0.0
+        self._reset_window(time.monotonic())
+
+    def add_user(self, maximum):
+        """Register a job using the limiter with its own maximum; one job never lowers another's."""
+        with self._cond:
+            self._maxima.append(max(1, int(maximum)))
+            self.maximum = max(self._maxima)
+            self.limit = min(self.limit, self.maximum)
+            self._cond.notify_all()
+
+    def remove_user(self, maximum):
+        """Unregister a job added with ``add_user``."""
+        with self._cond:
+            maximum = max(1, int(maximum))
+            if maximum in self._maxima:
+                self._maxima.remove(maximum)
+            if self._maxima:
+                self.maximum = max(self._maxima)
+                self.limit = min(self.limit, self.maximum)
+
+    def restart(self, limit):
+        """Start over from ``limit``; only used while no slot is held."""
+        with self._cond:
+            self.limit = min(max(1, int(limit)), self.maximum)
+            self._last_rate = None
+            self._last_change = 0
+            self._reset_window(time.monotonic())
+            self._cond.notify_all()
+
+    def record_success(self, nbytes):
+        """Count a finished file and adjust the cap at the end of each round."""
+        with self._cond:
+            self._window_bytes += nbytes
+            self._window_files += 1
+            if self._window_files < self.limit:
+                return
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            rate = self._window_bytes / elapsed if elapsed > 0 else 0.0
+            if self._last_rate is not None and self._last_change > 0 and rate < self._last_rate * (1 + _ADAPTIVE_MIN_GAIN):
+                change = -1
+            else:
+                change = 1
+            self._last_rate = rate
+            self._reset_window(now)
+            changed = self._change(self.limit + change, change)
+        if changed:
+            self._save()
+
+    def record_failure(self):
+        """Halve the cap after a congestion error."""
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease < _ADAPTIVE_BACKOFF_SECONDS:
+                return
+            self._last_decrease = now
+            self._last_rate = None
+            self._reset_window(now)
+            changed = self._change(self.limit // 2, -1)
+        if changed:
+            self._save()
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_files = 0
+
+    def _change(self, limit, direction):
+        # Called with the lock held
+        self._last_change = direction
+        limit = min(max(1, limit), self.maximum)
+        if limit == self.limit:
+            return False
+        logger.info(f"Concurrency for {self.name} {'raised' if limit > self.limit else 'lowered'} from {self.limit} to {limit}")
+        self.limit = limit
+        self._cond.notify_all()
+        return True
+
+    def _save(self):
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            client.set(self.key, self.limit, ex=_ADAPTIVE_TTL)
+        except redis.RedisError as e:
+            logger.warning(f"Could not save learned concurrency for {self.name}: {str(e)}")
+
+
+def _load_learned_limit(key):
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        value = client.get(key)
+    except redis.RedisError as e:
+        logger.warning(f"Could not load learned concurrency for {key}: {str(e)}")
+        return None
+    return int(value) if value else None
+
+
+# Adaptive limiters are per host, whatever role it plays in a job
+_adaptive_limiters = {}
+_adaptive_limiters_lock = threading.Lock()
+
+
+def get_adaptive_limiter(host, port, maximum, start=DEFAULT_ADAPTIVE_START):
+    """Return the shared adaptive limiter for host:port, registering a job that may use up to ``maximum``.
+
+    The caller must hand the same ``maximum`` to ``remove_user`` when the job
+    is done. An idle limiter picks up the value last learned by any worker, so
+    each job starts near the best level found so far.
+    """
+    key = adaptive_key(host, port)
+    with _adaptive_limiters_lock:
+        limiter = _adaptive_limiters.get(key)
+        if limiter is None:
+            limiter = AdaptiveLimiter(host, port, _load_learned_limit(key) or start, maximum)
+            _adaptive_limiters[key] = limiter
+        limiter.add_user(maximum)
+        if not limiter.active:
+            limiter.restart(_load_learned_limit(key) or limiter.limit)
+        return limiter
+
+
+class ThreadSessions:
+    """Opens one session per worker thread on demand and closes them all at the end.
+
+    ``connect`` is called with no arguments and must return an object with a
+    ``close()`` method. When a ``limiter`` is given, each open session holds one
+    of its slots until ``close_all()`` is called.
+    """
+
+    def __init__(self, connect, limiter=None):
+        self._connect = connect
+        self._limiter = limiter
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def get(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            if self._limiter:
+                self._limiter.acquire()
+            self._local.failed = False
+            try:
+                session = self._connect()
+            except Exception:
+                self._local.failed = True
+                if self._limiter:
+                    self._limiter.release()
+                raise
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def broken(self):
+        """True if the calling thread's session failed to open, or its SSH connection has since dropped."""
+        if self._closed:
+            return False
+        if getattr(self._local, 'failed', False):
+            return True
+        session = getattr(self._local, 'session', None)
+        channel = getattr(session, 'sock', None)
+        if channel is None:
+            return False
+        transport = channel.get_transport()
+        return channel.closed or transport is None or not transport.is_active()
+
+    def close_all(self):
+        with self._lock:
+            self._closed = True
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
+            finally:
+                if self._limiter:
+                    self._limiter.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close_all()
+
+
+def run_parallel(func, items, max_workers):
+    """Apply ``func`` to every item on a thread pool.
+
+    ``items`` may be any iterable, including a generator that is still
+    producing work; it is consumed lazily so that no more than about twice
+    ``max_workers`` items are queued ahead of the workers. Returns a list of
+    ``(item, result, error)`` tuples in input order; a failing item does not
+    stop the others.
+    """
+    results = []
+
+    if max_workers <= 1:
+        for item in items:
+            try:
+                results.append((item, func(item), None))
+            except Exception as e:
+                results.append((item, None, e))
+        return results
+
+    indexed = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='transfer') as executor:
+        pending = set()
+        for item in items:
+            future = executor.submit(func, item)
+            indexed.append((item, future))
+            pending.add(future)
+            # Apply backpressure on the producer instead of queueing everything up front
+            if len(pending) >= max_workers * 2:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    for item, future in indexed:
+        try:
+            results.append((item, future.result(), None))
+        except Exception as e:
+            results.append((item, None, e))
+
+    return results
+
+
+def iter_parallel(func, items, max_workers):
+    """Apply ``func`` to every item on a thread pool, yielding results as they are needed.
+
+    Yields ``(item, result, error)`` tuples in input order, like
+    ``run_parallel``, but as a generator: no more than about twice
+    ``max_workers`` items are worked on ahead of the consumer, so results that
+    are large, such as file contents, are only held for that window.
+    """
+    if max_workers <= 1:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='transfer') as executor:
+        window = deque()
+        items = iter(items)
+        try:
+            while True:
+                for item in items:
+                    window.append((item, executor.submit(func, item)))
+                    if len(window) >= max_workers * 2:
+                        break
+                if not window:
+                    return
+                item, future = window.popleft()
+                try:
+                    yield item, future.result(), None
+                except Exception as e:
+                    yield item, None, e
+        finally:
+            # The consumer stopped early; drop the work it will never ask for
+            for _, future in window:
+                future.cancel()
@@ -0,0 +1,193 @@
+import threading
+import time
+import redis
+from loguru import logger
+from app.utils.redis_utils import get_redis
+
+# Minimum time between two progress updates written to Redis
+DEFAULT_PROGRESS_INTERVAL_MS = 1000
+
+# Weight given to the latest interval when smoothing the throughput
+_THROUGHPUT_SMOOTHING = 0.3
+
+# Progress of a running job expires if nothing updates it for this long; finished runs are kept for a day
+_RUNNING_TTL = 3600
+_FINISHED_TTL = 86400
+
+_INT_FIELDS = ('files_done', 'files_failed', 'files_total', 'bytes_done', 'bytes_total', 'throughput_bps')
+_FLOAT_FIELDS = ('eta_seconds', 'started_at', 'updated_at')
+
+
+def progress_key(job_id):
+    return f"transferwizard:progress:{job_id}"
+
+
+class TransferProgress:
+    """Publishes a running job's progress to a Redis hash.
+
+    Counters are updated in memory on every chunk and written out at most once
+    per ``interval_ms``, so tracking costs one Redis call per interval rather
+    than per chunk. Totals may keep growing while the listing is still
+    streaming; ``listing_complete`` says when they are final. Without Redis the
+    progress is simply not published.
+    """
+
+    def __init__(self, job_id, interval_ms=DEFAULT_PROGRESS_INTERVAL_MS):
+        self.key = progress_key(job_id)
+        self.interval = max(0, int(interval_ms)) / 1000.0
+        self._redis = get_redis()
+        self._lock = threading.Lock()
+        self.state = 'starting'
+        self.files_done = 0
+        self.files_failed = 0
+        self.files_total = 0
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.listing_complete = False
+        self.throughput = 0.0
+        self.started_at = time.time()
+        self._last_publish = 0.0
+        self._last_bytes = 0
+        self._last_time = time.monotonic()
+
+    def start(self, state='running'):
+        """Clear the previous run's progress and publish this run's first update."""
+        if self._redis is not None:
+            try:
+                self._redis.delete(self.key)
+            except redis.RedisError as e:
+                logger.warning(f"Could not reset progress for {self.key}: {str(e)}")
+        self.set_state(state)
+
+    def set_state(self, state):
+        with self._lock:
+            self.state = state
+            self._publish(force=True)
+
+    def add_total(self, files=0, nbytes=0):
+        with self._lock:
+            self.files_total += files
+            self.bytes_total += nbytes
+            self._publish()
+
+    def complete_listing(self):
+        with self._lock:
+            self.listing_complete = True
+            self._publish(force=True)
+
+    def track(self, files):
+        """Pass files through unchanged, adding each one to the totals."""
+        for remote_file in files:
+            self.add_total(1, remote_file.size or 0)
+            yield remote_file
+        self.complete_listing()
+
+    def add_bytes(self, nbytes):
+        with self._lock:
+            self.bytes_done += nbytes
+            self._publish()
+
+    def file_done(self):
+        with self._lock:
+            self.files_done += 1
+            self._publish()
+
+    def file_failed(self):
+        with self._lock:
+            self.files_failed += 1
+            self._publish()
+
+    def finish(self, state='finished'):
+        with self._lock:
+            self.state = state
+            self.listing_complete = True
+            self._publish(force=True, ttl=_FINISHED_TTL)
+
+    def reader(self, fileobj):
+        """Wrap a readable file object so bytes read through it count as done."""
+        return ProgressReader(fileobj, self)
+
+    def snapshot(self):
+        """Current progress as the dict stored in Redis."""
+        remaining = max(0, self.bytes_total - self.bytes_done)
+        eta = remaining / self.throughput if self.throughput > 0 and self.listing_complete else None
+        return {
+            'state': self.state,
+            'files_done': self.files_done,
+            'files_failed': self.files_failed,
+            'files_total': self.files_total,
+            'bytes_done': self.bytes_done,
+            'bytes_total': self.bytes_total,
+            'throughput_bps': int(self.throughput),
+            'eta_seconds': round(eta, 1) if eta is not None else '',
+            'listing_complete': int(self.listing_complete),
+            'started_at': self.started_at,
+            'updated_at': time.time(),
+        }
+
+    def _publish(self, force=False, ttl=_RUNNING_TTL):
+        # Called with the lock held
+        now = time.monotonic()
+        if not force and now - self._last_publish < self.interval:
+            return
+        elapsed = now - self._last_time
+        if elapsed > 0:
+            rate = (self.bytes_done - self._last_bytes) / elapsed
+            self.throughput = rate if not self._last_bytes else (
+                _THROUGHPUT_SMOOTHING * rate + (1 - _THROUGHPUT_SMOOTHING) * self.throughput)
+            self._last_bytes = self.bytes_done
+            self._last_time = now
+        self._last_publish = now
+        if self._redis is None:
+            return
+        try:
+            pipe = self._redis.pipeline()
+            pipe.hset(self.key, mapping=self.snapshot())
+            pipe.expire(self.key, ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Could not publish progress for {self.key}: {str(e)}")
+            self._redis = None
+
+
+class ProgressReader:
+    """Wraps a readable file object and reports the bytes read through it to a ``TransferProgress``."""
+
+    def __init__(self, fileobj, progress):
+        self.fileobj = fileobj
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.progress.add_bytes(len(data))
+        return data
+
+
+def _decode_progress(raw):
+    if not raw:
+        return None
+    progress = {key.decode(): value.decode() for key, value in raw.items()}
+    for field in _INT_FIELDS:
+        progress[field] = int(progress.get(field) or 0)
+    for field in _FLOAT_FIELDS:
+        progress[field] = float(progress[field]) if progress.get(field) else None
+    progress['listing_complete'] = progress.get('listing_complete') == '1'
+    return progress
+
+
+def load_progress(job_ids):
+    """Return {job_id: progress dict} for the given jobs that have published progress."""
+    client = get_redis()
+    job_ids = list(job_ids)
+    if client is None or not job_ids:
+        return {}
+    try:
+        pipe = client.pipeline()
+        for job_id in job_ids:
+            pipe.hgetall(progress_key(job_id))
+        raw = pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not load job progress: {str(e)}")
+        return {}
+    return {job_id: progress for job_id, progress in zip(job_ids, map(_decode_progress, raw)) if progress}
@@ -0,0 +1,28 @@
+import os
+import redis
+from loguru import logger
+
+_client = None
+_client_pid = None
+
+
+def get_redis():
+    """Return a shared Redis client for this process, or None if Redis is unreachable.
+
+    Uses REDIS_URL when set, otherwise the Celery broker URL.
+    """
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        return _client
+
+    url = os.environ.get('REDIS_URL') or os.environ.get('CELERY_BROKER_URL', 'redis://redis:6379/0')
+    try:
+        client = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5)
+        client.ping()
+    except redis.RedisError as e:
+        logger.warning(f"Redis is not available at {url}: {str(e)}")
+        return None
+
+    _client = client
+    _client_pid = os.getpid()
+    return _client
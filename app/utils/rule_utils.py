@@ -0,0 +1,179 @@
+import datetime
+import fnmatch
+import os
+import posixpath
+import random
+import re
+import uuid
+
+# Prefix marking a filter rule as a regular expression rather than a glob
+REGEX_PREFIX = 're:'
+
+# Tokens in a rename pattern, e.g. {basename} or {1}
+_TOKEN_RE = re.compile(r'\{(\w+)\}')
+
+# Kinds of compiled rename parts
+_LITERAL, _FIELD, _GROUP, _GENERATED = range(4)
+
+# Tokens generated afresh for every file
+_GENERATORS = {
+    'uuid': lambda: str(uuid.uuid4()),
+    'random': lambda: f"{random.getrandbits(32):08x}",
+}
+
+
+def parse_rules(rules):
+    """Return filter rules as a list, from a list or from text with one rule per line."""
+    if isinstance(rules, (list, tuple)):
+        return [rule.strip() for rule in rules if rule and rule.strip()]
+    return [line.strip() for line in (rules or '').splitlines() if line.strip()]
+
+
+def _compile_rule(rule):
+    try:
+        if rule.startswith(REGEX_PREFIX):
+            return re.compile(rule[len(REGEX_PREFIX):])
+        # Anchor the glob at the start too, since rules are applied with search()
+        return re.compile(r'\A' + fnmatch.translate(rule))
+    except re.error as e:
+        raise ValueError(f"Invalid filter rule {rule!r}: {str(e)}")
+
+
+class _RuleSet:
+    """Glob and regex rules compiled one by one, split into rules for names and rules for relative paths.
+
+    Rules are kept apart rather than joined into one regex, since a rule that
+    is valid alone (inline flags, named groups) may not be valid in a join.
+    """
+
+    def __init__(self, rules):
+        self._names, self._paths = [], []
+        for rule in rules:
+            (self._paths if '/' in rule else self._names).append(_compile_rule(rule))
+
+    def __bool__(self):
+        return bool(self._names or self._paths)
+
+    def matches(self, name, rel_dir=''):
+        if any(pattern.search(name) for pattern in self._names):
+            return True
+        if self._paths:
+            rel_path = posixpath.join(rel_dir, name) if rel_dir else name
+            return any(pattern.search(rel_path) for pattern in self._paths)
+        return False
+
+
+class FileFilter:
+    """Decides which source files a job picks up, compiled once per run.
+
+    A file must match ``pattern`` (a glob on the file name), at least one
+    ``include`` rule if there are any, and no ``exclude`` rule. Rules are globs,
+    or regular expressions when prefixed with ``re:``; rules containing a ``/``
+    are matched against the path relative to the source directory, the rest
+    against the file name.
+    """
+
+    def __init__(self, pattern='*', include=(), exclude=()):
+        self._pattern = re.compile(fnmatch.translate('*' if pattern is None else pattern))
+        self._include = _RuleSet(include)
+        self._exclude = _RuleSet(exclude)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('file_pattern', '*'),
+                   parse_rules(config.get('include_patterns')),
+                   parse_rules(config.get('exclude_patterns')))
+
+    def matches(self, name, rel_dir=''):
+        """Return True if the file ``name`` in ``rel_dir`` passes the filter."""
+        if not self._pattern.match(name):
+            return False
+        if self._include and not self._include.matches(name, rel_dir):
+            return False
+        return not self._exclude.matches(name, rel_dir)
+
+
+class RenamePlan:
+    """A rename pattern compiled once per run.
+
+    Supported tokens are {filename}, {basename}, {ext}, {timestamp}, {date},
+    {time}, {uuid} and {random}. With a ``match`` regex its capture groups are
+    available as {1}, {2}... or by name. Time tokens are frozen when the plan is
+    built, so every file in a run gets the same values. Unknown tokens are kept
+    as written; a pattern with no known tokens, or a name ``match`` does not
+    match, leaves the name unchanged.
+    """
+
+    def __init__(self, pattern, match=None, now=None):
+        self.pattern = pattern or ''
+        try:
+            self._match = re.compile(match) if match else None
+        except re.error as e:
+            raise ValueError(f"Invalid rename match {match!r}: {str(e)}")
+        now = now or datetime.datetime.now()
+        self.now = now
+        self._frozen = {
+            'timestamp': now.strftime('%Y%m%d%H%M%S'),
+            'date': now.strftime('%Y%m%d'),
+            'time': now.strftime('%H%M%S'),
+        }
+        self._parts, self.active = self._compile()
+
+    def _compile(self):
+        """Return the pattern as (kind, value) parts, and whether it has any known token."""
+        parts = []
+        position = 0
+        for token_match in _TOKEN_RE.finditer(self.pattern):
+            part = self._compile_token(token_match.group(1))
+            if part is None:
+                continue
+            parts.append((_LITERAL, self.pattern[position:token_match.start()]))
+            parts.append(part)
+            position = token_match.end()
+        parts.append((_LITERAL, self.pattern[position:]))
+
+        # Fold frozen values into the surrounding text so applying the plan only joins strings
+        merged = []
+        for kind, value in parts:
+            if kind == _LITERAL and merged and merged[-1][0] == _LITERAL:
+                merged[-1] = (_LITERAL, merged[-1][1] + value)
+            elif kind != _LITERAL or value:
+                merged.append((kind, value))
+        return merged, position > 0
+
+    def _compile_token(self, token):
+        if token in ('filename', 'basename', 'ext'):
+            return _FIELD, token
+        if token in self._frozen:
+            return _LITERAL, self._frozen[token]
+        if token in _GENERATORS:
+            return _GENERATED, _GENERATORS[token]
+        if self._match is not None:
+            if token.isdigit() and int(token) <= self._match.groups:
+                return _GROUP, int(token)
+            if token in self._match.groupindex:
+                return _GROUP, token
+        return None
+
+    def apply(self, filename):
+        """Return the new name for ``filename``."""
+        if not self.active:
+            return filename
+        groups = None
+        if self._match is not None:
+            groups = self._match.search(filename)
+            if groups is None:
+                return filename
+        basename, extension = os.path.splitext(filename)
+        fields = {'filename': filename, 'basename': basename, 'ext': extension}
+        result = []
+        for kind, value in self._parts:
+            if kind == _LITERAL:
+                result.append(value)
+            elif kind == _FIELD:
+                result.append(fields[value])
+            elif kind == _GROUP:
+                result.append(groups.group(value) or '')
+            else:
+                result.append(value())
+        return ''.join(result)
@@ -0,0 +1,312 @@
+import hashlib
+import io
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import paramiko
+from loguru import logger
+
+from config import Config
+
+# Key classes tried, in order, when loading a private key from its text
+_KEY_CLASSES = (paramiko.RSAKey, paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.DSSKey)
+
+# Parsed private keys kept per worker process, most recently used last
+_KEY_CACHE_SIZE = 128
+_key_cache = OrderedDict()
+_key_cache_lock = threading.Lock()
+
+
+def credential_pool_key(credential):
+    """Pool key for a stored credential; editing the credential changes the key."""
+    updated_at = credential.updated_at.isoformat() if getattr(credential, 'updated_at', None) else None
+    return (credential.id, updated_at)
+
+
+def load_private_key(private_key, passphrase=None):
+    """Parse a PEM/OpenSSH private key held in memory into a paramiko key."""
+    last_error = None
+    for key_class in _KEY_CLASSES:
+        try:
+            return key_class.from_private_key(io.StringIO(private_key), password=passphrase or None)
+        except paramiko.PasswordRequiredException:
+            raise
+        except (paramiko.SSHException, ValueError) as e:
+            last_error = e
+    raise paramiko.SSHException(f"Unsupported or invalid private key: {last_error}")
+
+
+def get_private_key(cache_key, private_key, passphrase=None):
+    """Return the parsed key for a credential, parsing it only on first use in this worker.
+
+    Parsing an encrypted key derives the passphrase key, which is slow, so parsed
+    keys are cached by ``cache_key`` (the credential's pool key, which changes when
+    the credential is edited). Without a cache key the key text itself is used.
+    """
+    if cache_key is None:
+        cache_key = hashlib.sha256(f"{private_key}\0{passphrase or ''}".encode()).hexdigest()
+    with _key_cache_lock:
+        pkey = _key_cache.get(cache_key)
+        if pkey is not None:
+            _key_cache.move_to_end(cache_key)
+            return pkey
+
+    pkey = load_private_key(private_key, passphrase)
+    with _key_cache_lock:
+        _key_cache[cache_key] = pkey
+        while len(_key_cache) > _KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+    return pkey
+
+
+class PooledSFTPClient(paramiko.SFTPClient):
+    """SFTP channel borrowed from the pool; ``close()`` hands the transport back."""
+
+    _pool = None
+    _entry = None
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            pool, entry = self._pool, self._entry
+            self._pool = self._entry = None
+            if pool is not None:
+                pool._release(entry)
+
+
+class _PoolEntry:
+    """One authenticated SSH transport and the number of channels open on it."""
+
+    def __init__(self, key, transport):
+        self.key = key
+        self.transport = transport
+        self.channels = 0
+        self.last_used = time.monotonic()
+        self.last_checked = self.last_used
+
+    def close(self):
+        try:
+            self.transport.close()
+        except Exception:
+            pass
+
+
+class SftpConnectionPool:
+    """Per-process pool of authenticated SSH transports keyed by credential.
+
+    Several SFTP channels can be multiplexed over one pooled transport, so
+    back-to-back and parallel sessions to the same host skip the TCP, key
+    exchange and authentication handshake. Transports that have been idle
+    longer than ``idle_timeout`` are closed, idle transports are probed before
+    reuse, and at most ``max_size`` transports are kept open at once.
+    """
+
+    def __init__(self, max_size=8, idle_timeout=300, max_channels=4, health_check_interval=30, connect_timeout=30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_channels = max_channels
+        self.health_check_interval = health_check_interval
+        self.connect_timeout = connect_timeout
+        self._cond = threading.Condition()
+        self._entries = []
+        self._connecting = 0
+        self._pid = os.getpid()
+
+    @contextmanager
+    def sftp(self, credential):
+        """Borrow an SFTP channel for a stored credential."""
+        client = self.open_sftp(credential)
+        try:
+            yield client
+        finally:
+            client.close()
+
+    @contextmanager
+    def sftp_session(self, key, params):
+        """Borrow an SFTP channel for raw connection parameters under an explicit pool key."""
+        client = self.open_sftp_with(key, params)
+        try:
+            yield client
+        finally:
+            client.close()
+
+    def open_sftp(self, credential):
+        """Open an SFTP channel for a stored credential; the caller must ``close()`` it."""
+        return self.open_sftp_with(credential_pool_key(credential), credential.get_credentials())
+
+    def open_sftp_with(self, key, params):
+        """Open an SFTP channel for connection parameters; the caller must ``close()`` it."""
+        # A transport can die between the health check and opening the channel; retry once
+        for attempt in range(2):
+            entry = self._acquire(key, params)
+            try:
+                client = PooledSFTPClient.from_transport(entry.transport)
+                if client is None:
+                    raise paramiko.SSHException("Unable to open SFTP channel")
+            except Exception:
+                self._discard(entry)
+                if attempt:
+                    raise
+                continue
+            client._pool = self
+            client._entry = entry
+            return client
+
+    def close_all(self):
+        """Close every pooled transport (e.g. on worker shutdown)."""
+        with self._cond:
+            entries, self._entries = self._entries, []
+            self._cond.notify_all()
+        for entry in entries:
+            entry.close()
+
+    def _acquire(self, key, params):
+        with self._cond:
+            self._reset_after_fork()
+            while True:
+                self._evict(key)
+                entry = self._find_reusable(key)
+                if entry is not None:
+                    entry.channels += 1
+                    entry.last_used = time.monotonic()
+                    return entry
+                if len(self._entries) + self._connecting < self.max_size or self._evict_lru_idle():
+                    self._connecting += 1
+                    break
+                # Pool is full of busy transports; wait for a channel or transport to free up
+                self._cond.wait(timeout=1.0)
+
+        try:
+            transport = self.connect_transport(key, params)
+        except Exception:
+            with self._cond:
+                self._connecting -= 1
+                self._cond.notify_all()
+            raise
+
+        entry = _PoolEntry(key, transport)
+        entry.channels = 1
+        with self._cond:
+            self._connecting -= 1
+            self._entries.append(entry)
+        return entry
+
+    def _release(self, entry):
+        with self._cond:
+            entry.channels = max(0, entry.channels - 1)
+            entry.last_used = time.monotonic()
+            if not entry.transport.is_active() and entry in self._entries:
+                self._entries.remove(entry)
+                entry.close()
+            self._cond.notify_all()
+
+    def _discard(self, entry):
+        with self._cond:
+            if entry in self._entries:
+                self._entries.remove(entry)
+            self._cond.notify_all()
+        entry.close()
+
+    def _find_reusable(self, key):
+        """Return a healthy transport for ``key`` with a free channel slot, if any."""
+        now = time.monotonic()
+        for entry in sorted(self._entries, key=lambda e: e.channels):
+            if entry.key != key or entry.channels >= self.max_channels:
+                continue
+            if not entry.transport.is_active():
+                continue
+            if entry.channels == 0 and now - entry.last_checked > self.health_check_interval:
+                try:
+                    # Cheap keepalive probe; fails if the peer has gone away
+                    entry.transport.send_ignore()
+                    entry.last_checked = now
+                except Exception:
+                    continue
+            return entry
+        return None
+
+    def _evict(self, current_key):
+        """Drop dead transports, idle ones past the timeout and ones for outdated credentials."""
+        now = time.monotonic()
+        keep = []
+        for entry in self._entries:
+            stale_credential = entry.key[0] == current_key[0] and entry.key != current_key
+            expired = entry.channels == 0 and now - entry.last_used > self.idle_timeout
+            if not entry.transport.is_active() or (entry.channels == 0 and stale_credential) or expired:
+                entry.close()
+            else:
+                keep.append(entry)
+        self._entries = keep
+
+    def _evict_lru_idle(self):
+        """Close the least recently used idle transport to make room; False if none is idle."""
+        idle = [e for e in self._entries if e.channels == 0]
+        if not idle:
+            return False
+        entry = min(idle, key=lambda e: e.last_used)
+        self._entries.remove(entry)
+        entry.close()
+        return True
+
+    def _reset_after_fork(self):
+        # Transports are not shared with forked Celery children
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._entries = []
+            self._connecting = 0
+
+    def connect_transport(self, key, params):
+        """Open and authenticate a new SSH transport outside the pool; the caller must close it."""
+        host = params.get('host')
+        port = int(params.get('port') or 22)
+        logger.debug(f"Opening pooled SSH transport to {host}:{port}")
+
+        sock = socket.create_connection((host, port), timeout=self.connect_timeout)
+        transport = paramiko.Transport(sock)
+        try:
+            transport.set_keepalive(30)
+            transport.start_client(timeout=self.connect_timeout)
+
+            # Job handlers have never checked host keys, and worker images ship no known_hosts,
+            # so only callers that ask for it (the credential test) verify the server's key
+            if params.get('verify_host_key'):
+                self._verify_host_key(transport, host, port)
+
+            # Use either password or private key, matching the job handlers
+            if params.get('password'):
+                transport.auth_password(params.get('username'), params.get('password'))
+            elif params.get('private_key'):
+                passphrase = params.get('private_key_pass') or params.get('private_key_passphrase')
+                pkey = get_private_key(key, params.get('private_key'), passphrase)
+                transport.auth_publickey(params.get('username'), pkey)
+            else:
+                raise ValueError("Either password or private key must be provided")
+        except Exception:
+            transport.close()
+            raise
+
+        return transport
+
+    def _verify_host_key(self, transport, host, port):
+        host_keys = paramiko.HostKeys()
+        known_hosts = os.path.expanduser('~/.ssh/known_hosts')
+        if os.path.exists(known_hosts):
+            host_keys.load(known_hosts)
+
+        server_key = transport.get_remote_server_key()
+        lookup = host if port == 22 else f"[{host}]:{port}"
+        if not host_keys.check(lookup, server_key):
+            raise paramiko.SSHException(f"Host key for {host} is not in known_hosts or does not match")
+
+
+# Shared pool for this worker process
+sftp_pool = SftpConnectionPool(
+    max_size=Config.SFTP_POOL_MAX_SIZE,
+    idle_timeout=Config.SFTP_POOL_IDLE_TIMEOUT,
+    max_channels=Config.SFTP_POOL_MAX_CHANNELS
+)
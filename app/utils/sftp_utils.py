@@ -1,9 +1,18 @@
-import pysftp
 import paramiko
 from loguru import logger
 import os
+import stat
 import socket
+import queue
+import threading
+import time
 import traceback
+import shlex
+from collections import deque
+from paramiko.sftp import (CMD_CLOSE, CMD_EXTENDED, CMD_HANDLE, CMD_NAME, CMD_OPENDIR, CMD_READDIR, CMD_REMOVE,
+                           CMD_STATUS, SFTPError, int64)
+from paramiko.sftp_attr import SFTPAttributes
+from app.utils.sftp_pool import sftp_pool
 
 def get_local_ip():
     """Get the local IP address of the machine"""
@@ -18,8 +27,327 @@ def get_local_ip():
         logger.error(f"Failed to get local IP address: {str(e)}")
         return "Unknown"
 
+def sftp_exists(sftp, path):
+    """Return True if the remote path exists"""
+    try:
+        sftp.stat(path)
+        return True
+    except IOError:
+        return False
+
+def sftp_isdir(sftp, path):
+    """Return True if the remote path is a directory"""
+    try:
+        return stat.S_ISDIR(sftp.stat(path).st_mode)
+    except IOError:
+        return False
+
+def sftp_makedirs(sftp, path, mode=0o777):
+    """Create a remote directory and any missing parents"""
+    if not path or path == '/' or sftp_isdir(sftp, path):
+        return
+    parent = os.path.dirname(path.rstrip('/'))
+    if parent and parent != path:
+        sftp_makedirs(sftp, parent, mode)
+    try:
+        sftp.mkdir(path, mode)
+    except IOError:
+        # Another worker may have created it in the meantime
+        if not sftp_isdir(sftp, path):
+            raise
+
+def sftp_replace(sftp, source_path, dest_path):
+    """Rename a remote file over an existing one, atomically where the server allows"""
+    try:
+        # posix-rename@openssh.com replaces the target in a single step
+        sftp.posix_rename(source_path, dest_path)
+        return
+    except IOError:
+        pass
+    
+    # Plain SFTP rename fails if the target exists, so remove it first
+    if sftp_exists(sftp, dest_path):
+        sftp.remove(dest_path)
+    sftp.rename(source_path, dest_path)
+
+def part_path(path):
+    """Hidden temporary name an upload is written to before being renamed into place"""
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, f".{filename}.part").replace('\\', '/')
+
+def is_part_file(filename):
+    """Return True for names produced by ``part_path``"""
+    return filename.startswith('.') and filename.endswith('.part')
+
+def sftp_cleanup_parts(sftp, remote_dir, max_age_seconds):
+    """Remove part files in a remote directory last written more than ``max_age_seconds`` ago; return their paths"""
+    cutoff = time.time() - max_age_seconds
+    removed = []
+    try:
+        entries = sftp.listdir_attr(remote_dir)
+    except IOError:
+        return removed
+    for attr in entries:
+        if not is_part_file(attr.filename) or stat.S_ISDIR(attr.st_mode or 0) or (attr.st_mtime or 0) >= cutoff:
+            continue
+        path = os.path.join(remote_dir, attr.filename).replace('\\', '/')
+        try:
+            sftp.remove(path)
+            removed.append(path)
+        except IOError as e:
+            logger.warning(f"Could not remove stale part file {path}: {str(e)}")
+    return removed
+
+class _Replies:
+    """Keeps the replies to pipelined requests until they are consumed"""
+    
+    def __init__(self):
+        self.received = {}
+    
+    def _async_response(self, t, msg, num):
+        # Called by paramiko for each reply it reads on our behalf
+        self.received[num] = (t, msg)
+    
+    def wait(self, sftp, num):
+        while num not in self.received:
+            sftp._read_response()
+        return self.received.pop(num)
+
+def sftp_listdir_iter(sftp, path, read_aheads=16):
+    """Yield a remote directory's entries as lists of SFTPAttributes, one list per batch the server returns
+    
+    Up to ``read_aheads`` READDIR requests are kept in flight, so the listing
+    streams without holding the whole directory in memory. The directory handle
+    is closed even when the caller stops early.
+    """
+    t, msg = sftp._request(CMD_OPENDIR, sftp._adjust_cwd(path))
+    if t != CMD_HANDLE:
+        raise SFTPError("Expected handle")
+    handle = msg.get_binary()
+    replies = _Replies()
+    pending = deque()
+    end_reached = False
+    try:
+        while True:
+            while not end_reached and len(pending) < read_aheads:
+                pending.append(sftp._async_request(replies, CMD_READDIR, handle))
+            if not pending:
+                return
+            t, msg = replies.wait(sftp, pending.popleft())
+            if t == CMD_STATUS:
+                try:
+                    sftp._convert_status(msg)
+                except EOFError:
+                    # Replies to requests sent after the end are drained the same way
+                    end_reached = True
+                    continue
+                raise SFTPError("Expected name or status reply to readdir")
+            if t != CMD_NAME:
+                raise SFTPError("Expected name reply to readdir")
+            batch = []
+            for _ in range(msg.get_int()):
+                filename = msg.get_text()
+                longname = msg.get_text()
+                attr = SFTPAttributes._from_msg(msg, filename, longname)
+                if filename not in ('.', '..'):
+                    batch.append(attr)
+            yield batch
+    finally:
+        try:
+            # Collect replies still in flight so the session can be reused, then release the handle
+            while pending:
+                replies.wait(sftp, pending.popleft())
+            sftp._request(CMD_CLOSE, handle)
+        except Exception as e:
+            logger.debug(f"Could not close directory handle for {path}: {str(e)}")
+
+class _RemoveReplies:
+    """Collects the status replies to pipelined remove requests"""
+    
+    def __init__(self, sftp):
+        self.sftp = sftp
+        self.pending = {}
+        self.errors = {}
+    
+    def _async_response(self, t, msg, num):
+        # Called by paramiko for each reply it reads on our behalf
+        path = self.pending.pop(num, None)
+        if t != CMD_STATUS:
+            self.errors[path] = SFTPError("Expected status reply to remove")
+            return
+        try:
+            self.sftp._convert_status(msg)
+        except (IOError, SFTPError) as e:
+            self.errors[path] = e
+
+def sftp_remove_many(sftp, paths, window=64):
+    """Remove remote files, keeping up to ``window`` requests in flight; return {path: error} for failures"""
+    replies = _RemoveReplies(sftp)
+    for path in paths:
+        num = sftp._async_request(replies, CMD_REMOVE, sftp._adjust_cwd(path))
+        replies.pending[num] = path
+        while len(replies.pending) >= window:
+            sftp._read_response()
+    while replies.pending:
+        sftp._read_response()
+    return replies.errors
+
+class PipelinedRemover:
+    """Deletes remote files on a background thread as soon as they are queued.
+    
+    Paths queued while a batch is in flight are sent together as one pipelined
+    batch over a single SFTP session opened with ``connect``. Call ``close()``
+    to wait for the queue to drain; it returns {path: error} for every file
+    that could not be deleted.
+    """
+    
+    def __init__(self, connect, window=64):
+        self._connect = connect
+        self.window = window
+        self.removed = []
+        self.errors = {}
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='sftp-remover', daemon=True)
+        self._thread.start()
+    
+    def remove(self, path):
+        self._queue.put(path)
+    
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        return self.errors
+    
+    def _run(self):
+        sftp = None
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while len(batch) < self.window:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                done = True
+                batch = [path for path in batch if path is not None]
+            if not batch:
+                continue
+            
+            try:
+                if sftp is None:
+                    sftp = self._connect()
+                errors = sftp_remove_many(sftp, batch, self.window)
+            except Exception as e:
+                # Session failed mid-batch; report the whole batch and reconnect for the next one
+                errors = {path: e for path in batch}
+                try:
+                    if sftp is not None:
+                        sftp.close()
+                except Exception:
+                    pass
+                sftp = None
+            
+            self.errors.update(errors)
+            self.removed.extend(path for path in batch if path not in errors)
+        
+        if sftp is not None:
+            sftp.close()
+
+class ServerSideCopier:
+    """Copies or moves files within one SFTP server without the data passing through the worker.
+    
+    Moves use ``posix-rename``; copies use the ``copy-data`` SFTP extension and
+    then ``cp`` over an exec channel. Methods a server turns out not to support
+    are remembered for the rest of the run, so an unsupported server costs one
+    failed attempt rather than one per file. Both calls return the name of the
+    method used, or None when the file has to be streamed instead.
+    """
+    
+    def __init__(self):
+        self._unsupported = set()
+        self._lock = threading.Lock()
+    
+    def move(self, sftp, source_path, dest_path):
+        """Rename ``source_path`` over ``dest_path``; the source is gone afterwards."""
+        if self._attempt(sftp, 'posix-rename', lambda: sftp.posix_rename(source_path, dest_path)):
+            return 'posix-rename'
+        return None
+    
+    def copy(self, sftp, source_path, dest_path):
+        """Copy ``source_path`` to ``dest_path`` on the server, replacing it."""
+        for method, func in (('copy-data', self._copy_data), ('cp', self._exec_cp)):
+            if self._attempt(sftp, method, lambda: func(sftp, source_path, dest_path)):
+                return method
+        return None
+    
+    def _attempt(self, sftp, method, func):
+        host = _peer(sftp)
+        with self._lock:
+            if (host, method) in self._unsupported:
+                return False
+        try:
+            func()
+            return True
+        except _Unsupported as e:
+            logger.debug(f"Server-side {method} unavailable on {host}: {str(e)}")
+            with self._lock:
+                self._unsupported.add((host, method))
+        except (IOError, SFTPError) as e:
+            # e.g. a rename across filesystems; the next method may still work for this file
+            logger.debug(f"Server-side {method} failed for this file on {host}: {str(e)}")
+        return False
+    
+    def _copy_data(self, sftp, source_path, dest_path):
+        with sftp.open(source_path, 'rb') as source_file, sftp.open(dest_path, 'wb') as dest_file:
+            try:
+                # A read length of 0 copies up to the end of the source file
+                sftp._request(CMD_EXTENDED, 'copy-data', source_file.handle, int64(0), int64(0),
+                              dest_file.handle, int64(0))
+            except IOError as e:
+                if 'unsupported' in str(e).lower():
+                    raise _Unsupported(str(e))
+                raise
+    
+    def _exec_cp(self, sftp, source_path, dest_path):
+        try:
+            channel = sftp.get_channel().get_transport().open_session()
+        except paramiko.SSHException as e:
+            raise _Unsupported(str(e))
+        try:
+            channel.settimeout(3600)
+            try:
+                channel.exec_command(f"cp -- {shlex.quote(source_path)} {shlex.quote(dest_path)}")
+            except paramiko.SSHException as e:
+                # SFTP-only accounts refuse exec requests
+                raise _Unsupported(str(e))
+            error = channel.makefile_stderr('rb').read().decode('utf-8', 'replace').strip()
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        if status in (126, 127):
+            raise _Unsupported(error or f"cp exited with status {status}")
+        if status != 0:
+            raise IOError(error or f"cp exited with status {status}")
+
+class _Unsupported(Exception):
+    """Raised when a server does not offer a server-side copy method at all"""
+
+def _peer(sftp):
+    try:
+        return sftp.get_channel().get_transport().getpeername()[:2]
+    except Exception:
+        return None
+
+def same_server_account(source_sftp, dest_sftp, source_username, dest_username):
+    """Return True if two SFTP sessions are logged in as the same user on the same server"""
+    if source_username != dest_username:
+        return False
+    source_peer = _peer(source_sftp)
+    return source_peer is not None and source_peer == _peer(dest_sftp)
+
 class SftpClient:
-    def __init__(self, host, port, username, password=None, private_key=None, private_key_passphrase=None, disable_host_key_checking=False):
+    def __init__(self, host, port, username, password=None, private_key=None, private_key_passphrase=None, disable_host_key_checking=False, pool_key=None):
         self.host = host
         self.port = port
         self.username = username
@@ -27,54 +355,33 @@ class SftpClient:
         self.private_key = private_key
         self.private_key_passphrase = private_key_passphrase
         self.disable_host_key_checking = disable_host_key_checking
+        self.pool_key = pool_key
         self.connection = None
+        self.transport = None
         self.local_ip = get_local_ip()
         
     def connect(self):
         """Establish a connection to the SFTP server"""
-        temp_key_file = None
         try:
             logger.debug(f"Attempting to connect to SFTP server: {self.host}:{self.port} with username: {self.username} from local IP: {self.local_ip}")
             
-            cnopts = pysftp.CnOpts()
             if self.disable_host_key_checking:
                 logger.warning(f"Host key checking disabled for {self.host}")
-                cnopts.hostkeys = None
-                
-            connect_kwargs = {
-                'host': self.host,
-                'port': self.port,
-                'username': self.username,
-                'cnopts': cnopts
-            }
             
             # Determine authentication method
             if self.private_key and self.private_key.strip():
+                # The key is parsed in memory and cached per worker, never written to disk
                 logger.debug("Using private key authentication")
-                
-                # Save the private key to a temporary file
-                temp_key_file = 'temp_key.pem'
-                with open(temp_key_file, 'w') as f:
-                    f.write(self.private_key)
-                os.chmod(temp_key_file, 0o600)  # Set secure permissions
-                
-                connect_kwargs['private_key'] = temp_key_file
-                if self.private_key_passphrase:
-                    connect_kwargs['private_key_pass'] = self.private_key_passphrase
             elif self.password:
                 logger.debug("Using password authentication")
-                connect_kwargs['password'] = self.password
             else:
                 logger.error("No authentication method provided")
                 raise ValueError("Either password or private key must be provided")
             
-            self.connection = pysftp.Connection(**connect_kwargs)
+            self.transport = sftp_pool.connect_transport(self.pool_key, self._pool_params())
+            self.connection = paramiko.SFTPClient.from_transport(self.transport)
             logger.info(f"Successfully connected to SFTP server: {self.host} from local IP: {self.local_ip}")
             
-            # Clean up key file if it exists
-            if temp_key_file and os.path.exists(temp_key_file):
-                os.remove(temp_key_file)
-                
             return True
         
         except paramiko.ssh_exception.SSHException as e:
@@ -91,10 +398,7 @@ class SftpClient:
                 logger.error(f"SSH error connecting to {self.host} from {self.local_ip}: {str(e)}")
             
             logger.debug(f"SSH Exception details: {traceback.format_exc()}")
-            
-            # Clean up key file if it exists
-            if temp_key_file and os.path.exists(temp_key_file):
-                os.remove(temp_key_file)
+
             raise
             
         except socket.error as e:
@@ -109,32 +413,50 @@ class SftpClient:
                 logger.error(f"Socket error connecting to {self.host} from {self.local_ip}: {str(e)}")
                 
             logger.debug(f"Socket Exception details: {traceback.format_exc()}")
-            
-            # Clean up key file if it exists
-            if temp_key_file and os.path.exists(temp_key_file):
-                os.remove(temp_key_file)
+
             raise
         
         except Exception as e:
             # Handle all other exceptions
             logger.error(f"Failed to connect to SFTP server: {self.host} from {self.local_ip}. Error: {str(e)}")
             logger.debug(f"Exception details: {traceback.format_exc()}")
-            
-            # Clean up key file if it exists
-            if temp_key_file and os.path.exists(temp_key_file):
-                os.remove(temp_key_file)
+
             raise
     
+    def _pool_params(self):
+        """Connection parameters in the form stored on SFTP credentials"""
+        return {
+            'host': self.host,
+            'port': self.port,
+            'username': self.username,
+            'password': self.password,
+            'private_key': self.private_key if self.private_key and self.private_key.strip() else None,
+            'private_key_pass': self.private_key_passphrase,
+            'disable_host_key_checking': self.disable_host_key_checking,
+            'verify_host_key': not self.disable_host_key_checking
+        }
+    
     def disconnect(self):
         """Close the SFTP connection"""
         if self.connection:
             logger.debug(f"Disconnecting from SFTP server: {self.host}")
             self.connection.close()
             self.connection = None
+        if self.transport:
+            self.transport.close()
+            self.transport = None
     
     def test_connection(self):
         """Test the SFTP connection by connecting and listing directory contents"""
         try:
+            if self.pool_key is not None:
+                # Borrow a pooled transport so a later job to this host can reuse it
+                with sftp_pool.sftp_session(self.pool_key, self._pool_params()) as sftp:
+                    logger.debug(f"Testing pooled connection by listing current directory on {self.host} from {self.local_ip}")
+                    dir_contents = sftp.listdir('.')
+                logger.debug(f"Directory listing successful: {len(dir_contents)} items found")
+                return True, f"Successfully connected to SFTP server from {self.local_ip}"
+            
             self.connect()
             logger.debug(f"Testing connection by listing current directory on {self.host} from {self.local_ip}")
             
@@ -0,0 +1,122 @@
+import posixpath
+import queue
+import stat
+import threading
+from app.utils.sftp_utils import sftp_listdir_iter
+
+# Sentinels passed between the listing threads and the consumer
+_DONE = object()
+_STOP = object()
+
+
+class RemoteTreeWalker:
+    """Lists a remote directory tree over several SFTP channels at once.
+
+    Iterating yields ``(relative_dir, SFTPAttributes)`` for every non-directory
+    entry as soon as the batch it came in has been read, so the caller can
+    start working on files before even one large directory is fully listed.
+    ``sessions`` is a ``ThreadSessions`` handing each listing thread its own
+    channel. If ``match`` is given, only entries for which
+    ``match(relative_dir, attr)`` is true are passed on; the rest are dropped
+    by the listing threads.
+
+    Directories waiting to be listed are kept depth-first; once more than
+    ``max_frontier`` are queued, a listing thread walks the extra ones itself
+    instead of queueing them. At most ``max_queued`` entries are buffered
+    ahead of the consumer. Directories that cannot be listed are recorded in
+    ``errors`` as ``(path, error)`` and the walk carries on.
+    """
+
+    def __init__(self, sessions, root, recursive=True, workers=4, max_frontier=256, max_queued=1024, match=None):
+        self.sessions = sessions
+        self.root = root
+        self.recursive = recursive
+        self.match = match
+        self.workers = max(1, int(workers))
+        self.max_frontier = max_frontier
+        self.max_queued = max_queued
+        self.errors = []
+
+    def __iter__(self):
+        self._frontier = queue.LifoQueue()
+        self._entries = queue.Queue(maxsize=max(1, self.max_queued))
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = 1
+        self._frontier.put('')
+
+        threads = [
+            threading.Thread(target=self._work, name=f'sftp-walk-{i}', daemon=True)
+            for i in range(self.workers if self.recursive else 1)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._entries.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # Also reached when the consumer stops early
+            self._stop.set()
+            for _ in threads:
+                self._frontier.put(_STOP)
+            for thread in threads:
+                thread.join()
+
+    def _work(self):
+        while not self._stop.is_set():
+            rel_dir = self._frontier.get()
+            if rel_dir is _STOP:
+                return
+            self._process(rel_dir)
+
+    def _process(self, rel_dir):
+        """List one directory, then mark it finished."""
+        path = posixpath.join(self.root, rel_dir) if rel_dir else self.root
+        try:
+            self._list(path, rel_dir)
+        except Exception as e:
+            with self._lock:
+                self.errors.append((path, e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+                finished = self._pending == 0
+            if finished:
+                self._put(_DONE)
+
+    def _list(self, path, rel_dir):
+        sftp = self.sessions.get()
+        for batch in sftp_listdir_iter(sftp, path):
+            for attr in batch:
+                if self._stop.is_set():
+                    return
+                if stat.S_ISDIR(attr.st_mode or 0):
+                    if self.recursive:
+                        self._push_dir(posixpath.join(rel_dir, attr.filename) if rel_dir else attr.filename)
+                elif self.match is not None and not self.match(rel_dir, attr):
+                    continue
+                elif not self._put((rel_dir, attr)):
+                    return
+
+    def _push_dir(self, rel_dir):
+        with self._lock:
+            self._pending += 1
+        if self._frontier.qsize() < self.max_frontier:
+            self._frontier.put(rel_dir)
+        else:
+            # Frontier is full; walk this branch on the current thread
+            self._process(rel_dir)
+
+    def _put(self, item):
+        # Retry with a timeout so a consumer that stopped early can end the walk
+        while not self._stop.is_set():
+            try:
+                self._entries.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
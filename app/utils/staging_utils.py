@@ -0,0 +1,125 @@
+import io
+import os
+import tempfile
+import threading
+from loguru import logger
+
+
+class StagingBudget:
+    """Caps the bytes staged at once; ``reserve()`` waits for space instead of failing."""
+
+    def __init__(self, limit):
+        self._cond = threading.Condition()
+        self.limit = max(0, int(limit))
+        self.used = 0
+
+    def try_reserve(self, nbytes):
+        """Reserve ``nbytes`` if they fit right now; returns whether they did."""
+        with self._cond:
+            if self.used + nbytes > self.limit:
+                return False
+            self.used += nbytes
+            return True
+
+    def reserve(self, nbytes):
+        """Reserve ``nbytes``, waiting until enough staged data has been released.
+
+        A request larger than the whole budget is let through once nothing else
+        is staged, so it waits its turn rather than forever.
+        """
+        with self._cond:
+            if self.used and self.used + nbytes > self.limit:
+                logger.info(f"Waiting for {nbytes} bytes of staging space ({self.used} of {self.limit} in use)")
+                while self.used and self.used + nbytes > self.limit:
+                    self._cond.wait()
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used = max(0, self.used - nbytes)
+            self._cond.notify_all()
+
+
+class StagedFile:
+    """A file held in memory or in an anonymous spool file while it is staged.
+
+    ``fileobj`` is readable and writable; ``close()`` discards the data and
+    returns its space to the budget it was taken from.
+    """
+
+    def __init__(self, fileobj, size, budget, in_memory):
+        self.fileobj = fileobj
+        self.size = size
+        self.in_memory = in_memory
+        self._budget = budget
+
+    def close(self):
+        try:
+            self.fileobj.close()
+        finally:
+            if self._budget is not None:
+                self._budget.release(self.size)
+                self._budget = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class StagingArea:
+    """Stages files between download and upload, in memory when small and on disk otherwise.
+
+    Files up to ``memory_threshold`` bytes are kept in memory while the
+    ``memory_budget`` allows; everything else is spooled to ``spool_dir`` and
+    counts against ``disk_budget``, waiting for space when it is used up.
+    Spool files are unlinked as soon as they are created, so nothing is left
+    behind if the worker dies.
+    """
+
+    def __init__(self, spool_dir, memory_threshold, memory_budget, disk_budget):
+        self.spool_dir = spool_dir
+        self.memory_threshold = memory_threshold
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+
+    def stage(self, size):
+        """Return an empty ``StagedFile`` with room for ``size`` bytes."""
+        size = max(0, int(size or 0))
+        if size <= self.memory_threshold and self.memory_budget.try_reserve(size):
+            return StagedFile(io.BytesIO(), size, self.memory_budget, True)
+
+        self.disk_budget.reserve(size)
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            fileobj = tempfile.TemporaryFile(dir=self.spool_dir, prefix='stage-')
+        except Exception:
+            self.disk_budget.release(size)
+            raise
+        return StagedFile(fileobj, size, self.disk_budget, False)
+
+
+# Process-wide budgets so concurrent jobs in one worker share them; disk budgets are per spool directory
+_staging_budgets = {}
+_staging_budgets_lock = threading.Lock()
+
+
+def _get_budget(key, limit):
+    with _staging_budgets_lock:
+        budget = _staging_budgets.get(key)
+        if budget is None:
+            budget = StagingBudget(limit)
+            _staging_budgets[key] = budget
+        return budget
+
+
+def get_staging_area(spool_dir, memory_threshold, memory_budget, disk_budget):
+    """Return a staging area drawing on this worker's shared memory and disk budgets."""
+    spool_dir = os.path.abspath(spool_dir)
+    return StagingArea(
+        spool_dir,
+        memory_threshold,
+        _get_budget(('memory',), memory_budget),
+        _get_budget(('disk', spool_dir), disk_budget),
+    )
@@ -0,0 +1,263 @@
+import queue
+import threading
+
+# Default chunk size for streamed copies (matches paramiko's max SFTP packet payload)
+DEFAULT_CHUNK_SIZE = 32768
+
+# Default number of chunks held in memory between the reader and the writer
+DEFAULT_BUFFER_CHUNKS = 64
+
+# Sentinel pushed by the reader thread when the source is exhausted
+_EOF = object()
+
+
+class LimitedReader:
+    """Wraps a file object so that at most ``length`` bytes can be read from it."""
+
+    def __init__(self, fileobj, length):
+        self.fileobj = fileobj
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def split_ranges(total_size, parts):
+    """Split ``total_size`` bytes into up to ``parts`` contiguous (offset, length) ranges."""
+    parts = max(1, min(int(parts), total_size or 1))
+    base, extra = divmod(total_size, parts)
+    ranges = []
+    offset = 0
+    for i in range(parts):
+        length = base + (1 if i < extra else 0)
+        if length:
+            ranges.append((offset, length))
+        offset += length
+    return ranges
+
+
+class _ReaderError:
+    """Wrapper used to hand a reader-thread exception to the writer."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def relay_stream(reader, writer, chunk_size=DEFAULT_CHUNK_SIZE, max_buffered_chunks=DEFAULT_BUFFER_CHUNKS, on_chunk=None, transform=None):
+    """Copy a readable file object into a writable one through a bounded buffer.
+
+    A background thread reads chunks from ``reader`` while the calling thread
+    writes them to ``writer``, so the download and the upload overlap. At most
+    ``max_buffered_chunks`` chunks are held in memory at any time. If given,
+    ``on_chunk`` is called with each chunk after it has been written.
+
+    ``transform`` is an optional streaming codec with ``compress(data)`` and
+    ``flush()`` methods (e.g. a zlib compressor). It runs on a third thread
+    between the reader and the writer, so CPU-heavy work overlaps with both
+    transfers, and the writer receives its output instead of the raw chunks.
+
+    Returns the number of bytes written.
+    """
+    stop = threading.Event()
+    read_buffer = queue.Queue(maxsize=max(1, max_buffered_chunks))
+    write_buffer = queue.Queue(maxsize=max(1, max_buffered_chunks)) if transform is not None else read_buffer
+
+    def _put(buffer, item):
+        # Retry with a timeout so a failed writer can stop the other threads
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(buffer):
+        while not stop.is_set():
+            try:
+                return buffer.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _EOF
+
+    def _read():
+        try:
+            while not stop.is_set():
+                chunk = reader.read(chunk_size)
+                if not chunk:
+                    break
+                if not _put(read_buffer, chunk):
+                    return
+            _put(read_buffer, _EOF)
+        except Exception as e:
+            _put(read_buffer, _ReaderError(e))
+
+    def _transform():
+        try:
+            while True:
+                item = _get(read_buffer)
+                if item is _EOF:
+                    tail = transform.flush()
+                    if tail:
+                        _put(write_buffer, tail)
+                    _put(write_buffer, _EOF)
+                    return
+                if isinstance(item, _ReaderError):
+                    _put(write_buffer, item)
+                    return
+                data = transform.compress(item)
+                if data and not _put(write_buffer, data):
+                    return
+        except Exception as e:
+            _put(write_buffer, _ReaderError(e))
+
+    threads = [threading.Thread(target=_read, name='relay-reader', daemon=True)]
+    if transform is not None:
+        threads.append(threading.Thread(target=_transform, name='relay-transform', daemon=True))
+    for thread in threads:
+        thread.start()
+
+    bytes_copied = 0
+    try:
+        while True:
+            item = write_buffer.get()
+            if item is _EOF:
+                break
+            if isinstance(item, _ReaderError):
+                raise item.error
+            writer.write(item)
+            bytes_copied += len(item)
+            if on_chunk is not None:
+                on_chunk(item)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    return bytes_copied
+
+
+def fan_out_stream(reader, writers, chunk_size=DEFAULT_CHUNK_SIZE, max_buffered_chunks=DEFAULT_BUFFER_CHUNKS, on_chunk=None, transform=None):
+    """Copy one readable file object into several writable ones at the same time.
+
+    The calling thread reads each chunk once and hands it to every writer. Each
+    writer runs on its own thread behind its own buffer of ``max_buffered_chunks``
+    chunks, so a slow writer only holds the others back once its buffer is full.
+    A writer that fails is dropped and the rest carry on. ``on_chunk`` is called
+    with each chunk as it is handed to the writers.
+
+    ``transform`` is an optional streaming codec as for ``relay_stream``. It runs
+    on its own thread between the reader and the writers, so compressing never
+    holds up reading.
+
+    Returns a list of ``(bytes_written, error)`` per writer, in the order given.
+    Raises if reading or the transform fails, after stopping every writer.
+    """
+    stop = threading.Event()
+    buffers = [queue.Queue(maxsize=max(1, max_buffered_chunks)) for _ in writers]
+    failed = [threading.Event() for _ in writers]
+    results = [[0, None] for _ in writers]
+    transform_buffer = queue.Queue(maxsize=max(1, max_buffered_chunks)) if transform is not None else None
+    transform_errors = []
+
+    def _put(index, item):
+        # Retry with a timeout so a writer that failed never blocks the reader
+        while not failed[index].is_set():
+            try:
+                buffers[index].put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _dispatch(item):
+        for index in range(len(writers)):
+            _put(index, item)
+
+    def _emit(data):
+        if on_chunk is not None:
+            on_chunk(data)
+        _dispatch(data)
+
+    def _hand_on(item):
+        # Chunks and end markers pass through the transform thread when there is one
+        if transform_buffer is None:
+            if item is _EOF or isinstance(item, _ReaderError):
+                _dispatch(item)
+            else:
+                _emit(item)
+            return
+        while not stop.is_set():
+            try:
+                transform_buffer.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _transform():
+        try:
+            while True:
+                item = transform_buffer.get()
+                if item is _EOF:
+                    tail = transform.flush()
+                    if tail:
+                        _emit(tail)
+                    _dispatch(_EOF)
+                    return
+                if isinstance(item, _ReaderError):
+                    _dispatch(item)
+                    return
+                data = transform.compress(item)
+                if data:
+                    _emit(data)
+        except Exception as e:
+            transform_errors.append(e)
+            stop.set()
+            _dispatch(_ReaderError(e))
+
+    def _write(index):
+        try:
+            while True:
+                item = buffers[index].get()
+                if item is _EOF:
+                    return
+                if isinstance(item, _ReaderError):
+                    results[index][1] = item.error
+                    return
+                writers[index].write(item)
+                results[index][0] += len(item)
+        except Exception as e:
+            results[index][1] = e
+            failed[index].set()
+
+    threads = [
+        threading.Thread(target=_write, args=(index,), name=f'fan-out-writer-{index}', daemon=True)
+        for index in range(len(writers))
+    ]
+    if transform is not None:
+        threads.append(threading.Thread(target=_transform, name='fan-out-transform', daemon=True))
+    for thread in threads:
+        thread.start()
+
+    try:
+        while not stop.is_set() and not all(event.is_set() for event in failed):
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            _hand_on(chunk)
+        _hand_on(_EOF)
+    except Exception as e:
+        _hand_on(_ReaderError(e))
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if transform_errors:
+        raise transform_errors[0]
+    return [tuple(result) for result in results]
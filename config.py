@@ -23,3 +23,14 @@ class Config:
     JOBS = []
     SCHEDULER_API_ENABLED = True
     SCHEDULER_TIMEZONE = "UTC"
+    
+    # SFTP connection pool (per worker process)
+    SFTP_POOL_MAX_SIZE = int(os.environ.get('SFTP_POOL_MAX_SIZE', 8))
+    SFTP_POOL_IDLE_TIMEOUT = int(os.environ.get('SFTP_POOL_IDLE_TIMEOUT', 300))
+    SFTP_POOL_MAX_CHANNELS = int(os.environ.get('SFTP_POOL_MAX_CHANNELS', 4))
+    
+    # Staging for staged transfers (per worker process)
+    STAGING_DIR = os.environ.get('STAGING_DIR') or TEMP_FOLDER
+    STAGING_MEMORY_THRESHOLD_MB = int(os.environ.get('STAGING_MEMORY_THRESHOLD_MB', 8))
+    STAGING_MEMORY_BUDGET_MB = int(os.environ.get('STAGING_MEMORY_BUDGET_MB', 256))
+    STAGING_DISK_BUDGET_MB = int(os.environ.get('STAGING_DISK_BUDGET_MB', 10240))